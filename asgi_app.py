@@ -0,0 +1,31 @@
+import os
+import sys
+
+project_dir = os.path.abspath(os.path.dirname(__file__))
+
+sys.path.insert(0, project_dir)
+os.chdir(project_dir)
+
+if not os.path.exists('logs'):
+    os.mkdir('logs')
+
+sys.stdout = open('logs/stdout.txt', 'a')
+sys.stderr = open('logs/stderr.txt', 'a')
+
+# Read by the configuration (config.py) when importing reliascheduler
+os.environ.setdefault('BACKGROUND_THREADS_ENABLED', '1')
+
+from reliascheduler import create_app
+from reliascheduler.asgi import create_asgi_app
+
+flask_application = create_app(os.environ['FLASK_CONFIG'])
+
+import logging
+
+file_handler = logging.FileHandler(filename='logs/errors.log')
+file_handler.setLevel(logging.INFO)
+flask_application.logger.addHandler(file_handler)
+
+# Device long-polls run in the event loop; everything else in the Flask app
+# (see reliascheduler/asgi.py). E.g.: uvicorn asgi_app:application
+application = create_asgi_app(flask_application)
@@ -9,11 +9,47 @@ class Config:
     SESSION_COOKIE_PATH = os.environ.get('SESSION_COOKIE_PATH') or '/'
     BASE_KEY = os.environ.get('BASE_KEY')
     MAX_PRIORITY_QUEUE = int(os.environ.get('MAX_PRIORITY_QUEUE') or '15')
+    # Order of the tasks with the same priority: 'fifo', or round-robin across
+    # authors ('fair-share-author') or sessions ('fair-share-session')
+    QUEUE_POLICY = os.environ.get('QUEUE_POLICY') or 'fifo'
     DEVICE_CREDENTIALS_FILENAME = os.environ.get('DEVICE_CREDENTIALS_FILENAME') or 'device-credentials.json'
     DEVICE_METADATA_FILENAME = os.environ.get('DEVICE_METADATA_FILENAME') or 'devices.yml'
+    DEVICE_METADATA_CHECK_INTERVAL = float(os.environ.get('DEVICE_METADATA_CHECK_INTERVAL') or '5')
     RELIA_BACKEND_TOKEN = os.environ.get('RELIA_BACKEND_TOKEN')
     MAX_TIME_RUNNING = float(os.environ.get('MAX_TIME_RUNNING') or '60')
     MAX_TIME_WITHOUT_POLLING = float(os.environ.get('MAX_TIME_WITHOUT_POLLING') or '10')
+    MAX_ERRORS_PER_USER = int(os.environ.get('MAX_ERRORS_PER_USER') or '20')
+    # Maximum (distinct) taskIdentifiers of the batch status and estimates requests
+    MAX_BATCH_TASKS = int(os.environ.get('MAX_BATCH_TASKS') or '100')
+    DEVICE_CREDENTIALS_CACHE_TTL = float(os.environ.get('DEVICE_CREDENTIALS_CACHE_TTL') or '300')
+    DEVICE_CREDENTIALS_VERSION_CHECK_INTERVAL = float(os.environ.get('DEVICE_CREDENTIALS_VERSION_CHECK_INTERVAL') or '5')
+    TASK_RETENTION = float(os.environ.get('TASK_RETENTION') or str(3 * 24 * 3600))
+    ERROR_RETENTION = float(os.environ.get('ERROR_RETENTION') or str(7 * 24 * 3600))
+    # Whether the app runs the garbage collector, the archiver and the reaper in background
+    # threads. Set by the servers (wsgi_app.py, asgi_app.py), not by the Flask CLI commands
+    # (export it for 'flask run')
+    BACKGROUND_THREADS_ENABLED = os.environ.get('BACKGROUND_THREADS_ENABLED', '0') in ('1', 'true', 'True')
+    # Seconds between runs of the garbage collector and the reaper (0 disables them)
+    GC_INTERVAL = float(os.environ.get('GC_INTERVAL') or '0')
+    GC_BATCH_SIZE = int(os.environ.get('GC_BATCH_SIZE') or '500')
+    REAPER_INTERVAL = float(os.environ.get('REAPER_INTERVAL') or '5')
+    # Threads of the ASGI app (see reliascheduler/asgi.py) for the requests other than the
+    # device long-polls and the task events streams
+    ASGI_THREADS = int(os.environ.get('ASGI_THREADS') or '64')
+    # Redis round-trips and latency per route, in /scheduler/metrics (see reliascheduler/metrics.py)
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') in ('1', 'true', 'True')
+    METRICS_DEBUG_HEADER = os.environ.get('METRICS_DEBUG_HEADER', '0') in ('1', 'true', 'True')
+    # If set, the requests are recorded in this file (see reliascheduler/recorder.py), e.g.: logs/requests-{pid}.jsonl.gz
+    REQUEST_TRACE_FILENAME = os.environ.get('REQUEST_TRACE_FILENAME')
+    REQUEST_TRACE_FLUSH_INTERVAL = float(os.environ.get('REQUEST_TRACE_FLUSH_INTERVAL') or '1')
+    # Approximate number of task lifecycle events kept in their stream (see reliascheduler/lifecycle.py); 0 disables it
+    LIFECYCLE_EVENTS_MAXLEN = int(os.environ.get('LIFECYCLE_EVENTS_MAXLEN') or '100000')
+    # If set, the tasks finished ARCHIVE_AFTER seconds ago are moved from Redis to segment files in this
+    # directory every ARCHIVE_INTERVAL seconds (see reliascheduler/archive.py). Keep ARCHIVE_AFTER below TASK_RETENTION
+    ARCHIVE_DIRECTORY = os.environ.get('ARCHIVE_DIRECTORY')
+    ARCHIVE_AFTER = float(os.environ.get('ARCHIVE_AFTER') or '3600')
+    ARCHIVE_INTERVAL = float(os.environ.get('ARCHIVE_INTERVAL') or '300')
+    ARCHIVE_SEGMENT_SIZE = int(os.environ.get('ARCHIVE_SEGMENT_SIZE') or str(64 * 1024 * 1024))
     
 
 class DevelopmentConfig(Config):
@@ -22,6 +58,7 @@ class DevelopmentConfig(Config):
     USE_FAKE_USERS = os.environ.get('USE_FAKE_USERS', '1') in ('1', 'true', 'True')
     BASE_KEY = os.environ.get('BASE_KEY') or 'uw-depl1'
     RELIA_BACKEND_TOKEN = os.environ.get('RELIA_BACKEND_TOKEN') or 'password'
+    METRICS_DEBUG_HEADER = os.environ.get('METRICS_DEBUG_HEADER', '1') in ('1', 'true', 'True')
 
 
 class StagingConfig(Config):
@@ -6,13 +6,15 @@ import string
 import getpass
 import hashlib
 
+import click
 from flask import Flask
 from flask_redis import FlaskRedis
 
 from config import configurations
+from reliascheduler.metrics import InstrumentedRedis
 
 # Plugins
-redis_store = FlaskRedis(decode_responses=True)
+redis_store = FlaskRedis.from_custom_provider(InstrumentedRedis, decode_responses=True)
 
 def create_app(config_name: str = 'default'):
 
@@ -32,6 +34,21 @@ def create_app(config_name: str = 'default'):
     # Initialize plugins
     redis_store.init_app(app)
 
+    from .metrics import init_metrics
+    init_metrics(app)
+
+    from .recorder import init_request_recorder
+    init_request_recorder(app)
+
+    from .store import init_stores
+    init_stores(app)
+
+    from .archive import init_archive
+    init_archive(app)
+
+    from .metadata import init_device_metadata
+    init_device_metadata(app)
+
     # Register views
     from .views.main import main_blueprint
     from .views.scheduler import scheduler_blueprint
@@ -44,23 +61,110 @@ def create_app(config_name: str = 'default'):
         "Manage tasks"
 
     @task_group.command('clean')
-    def tasks_clean():
-        "Remove all tasks"
-        from reliascheduler.keys import TaskKeys, DeviceKeys
-
-        redis_store.delete(TaskKeys.tasks())
-
-        for key in redis_store.keys(TaskKeys.identifier("*")):
-            redis_store.delete(key)
-
-        for key in redis_store.keys(TaskKeys.priority_queue("*")):
-            redis_store.delete(key)
-
-        redis_store.delete(TaskKeys.priorities())
-
-        for key in redis_store.keys(DeviceKeys.device_assignment("*")):
-            redis_store.delete(key)
-
+    @click.option('--status', default=None, help="Only remove the tasks with this status (e.g., queued)")
+    @click.option('--older-than', type=float, default=None, help="Only remove the tasks created more than these hours ago")
+    @click.option('--priority', type=int, default=None, help="Only remove the tasks with this priority")
+    @click.option('--batch-size', type=int, default=500, show_default=True, help="Keys scanned and removed per round-trip")
+    def tasks_clean(status, older_than, priority, batch_size):
+        "Remove all tasks (or only those matching the filters)"
+        from reliascheduler.admin import clean_all, clean_tasks
+
+        if status is None and older_than is None and priority is None:
+            removed = clean_all(batch_size, progress=print)
+            print(f"{removed} keys removed")
+        else:
+            removed = clean_tasks(batch_size, progress=print, status=status,
+                                  older_than=older_than * 3600 if older_than is not None else None,
+                                  priority=priority)
+            print(f"{removed} tasks removed")
+
+    @task_group.command('migrate-queues')
+    def tasks_migrate_queues():
+        "Move the tasks queued in the old lists per priority to the queue"
+        from reliascheduler.admin import migrate_priority_queues
+
+        moved = migrate_priority_queues(progress=print)
+        print(f"{moved} tasks moved to the queue")
+
+    @task_group.command('gc')
+    @click.option('--task-retention', type=float, default=None, help="Hours to keep finished tasks (default: TASK_RETENTION)")
+    @click.option('--error-retention', type=float, default=None, help="Hours to keep errors (default: ERROR_RETENTION)")
+    def tasks_gc(task_retention, error_retention):
+        "Remove finished tasks and errors older than the retention time"
+        from reliascheduler.collector import collect_garbage, get_collection_totals
+
+        stats = collect_garbage(
+            task_retention=task_retention * 3600 if task_retention is not None else None,
+            error_retention=error_retention * 3600 if error_retention is not None else None,
+        )
+        if stats is None:
+            print("Another process is already collecting garbage. Try again later")
+            return
+
+        print(f"{stats.tasks} tasks and {stats.errors} errors removed ({stats.keys} keys, approximately {stats.bytes} bytes)")
+        print(f"Totals: {get_collection_totals()}")
+
+    @task_group.command('archive')
+    @click.option('--after', type=float, default=None, help="Hours since the tasks finished (default: ARCHIVE_AFTER)")
+    def tasks_archive(after):
+        "Move the finished tasks from Redis to the archive (ARCHIVE_DIRECTORY)"
+        from reliascheduler.archive import archive_finished_tasks
+
+        if not app.config['ARCHIVE_DIRECTORY']:
+            print("ARCHIVE_DIRECTORY is not set")
+            return
+
+        archived = archive_finished_tasks(after=after * 3600 if after is not None else None)
+        if archived is None:
+            print("Another process is already archiving. Try again later")
+            return
+        print(f"{archived} tasks archived")
+
+    @task_group.command('reap')
+    def tasks_reap():
+        "Stop the tasks whose user is not polling anymore and those running for too long"
+        from reliascheduler.reaper import reap
+
+        stopped, timed_out = reap()
+        print(f"{len(stopped)} tasks stopped and {len(timed_out)} tasks timed out")
+
+    @app.cli.group('errors')
+    def errors_group():
+        "Manage error messages"
+
+    @errors_group.command('reindex')
+    @click.option('--batch-size', type=int, default=500, show_default=True, help="Keys scanned per round-trip")
+    def errors_reindex(batch_size):
+        "Rebuild the per-user error indexes from the stored tasks and errors"
+        from reliascheduler.admin import reindex_errors
+
+        indexed = reindex_errors(batch_size, progress=print)
+        print(f"{indexed} errors indexed")
+
+    @app.cli.group('events')
+    def events_group():
+        "Inspect the task lifecycle events"
+
+    @events_group.command('tail')
+    @click.option('--count', type=int, default=20, show_default=True, help="Events shown")
+    def events_tail(count):
+        "Show the last lifecycle events"
+        from reliascheduler.lifecycle import get_latest_events
+
+        for event in get_latest_events(count):
+            details = ' '.join(f"{name}={getattr(event, name)}" for name in ('priority', 'device', 'reason') if getattr(event, name) is not None)
+            print(f"{event.identifier} {event.event} {event.task} {details}")
+
+    @events_group.command('groups')
+    def events_groups():
+        "Show the consumer groups, with their pending events"
+        from reliascheduler.lifecycle import get_consumer_groups
+
+        groups = get_consumer_groups()
+        if not groups:
+            print("No consumer groups")
+        for group in groups:
+            print(f"{group['name']}: {group['consumers']} consumers, {group['pending']} pending, last delivered {group['last-delivered-id']}")
 
     @app.cli.group()
     def device_credentials():
@@ -115,14 +219,30 @@ def create_app(config_name: str = 'default'):
         from reliascheduler.keys import DeviceKeys
 
         existing_credentials = json.load(open(credentials_filename))
-
-        # In a single transaction, delete all the existing credentials and add all of them
+        stored_credentials = redis_store.hgetall(DeviceKeys.credentials())
+
+        # Only push the differences with what is already in Redis
+        removed_devices = [ device_identifier for device_identifier in stored_credentials if device_identifier not in existing_credentials ]
+        changed_credentials = {
+            device_identifier: salted_password
+            for device_identifier, salted_password in existing_credentials.items()
+            if stored_credentials.get(device_identifier) != salted_password
+        }
+
+        if not removed_devices and not changed_credentials:
+            print(f"{len(existing_credentials)} credentials already up to date in the Redis Server")
+            return
+
+        # In a single transaction, apply the changes and increase the version, so
+        # the workers discard the credentials they have verified and cached
         pipeline = redis_store.pipeline()
-        pipeline.delete(DeviceKeys.credentials())
-        for device_identifier, salted_password in existing_credentials.items():
-            pipeline.hset(DeviceKeys.credentials(), device_identifier, salted_password)
+        if removed_devices:
+            pipeline.hdel(DeviceKeys.credentials(), *removed_devices)
+        if changed_credentials:
+            pipeline.hset(DeviceKeys.credentials(), mapping=changed_credentials)
+        pipeline.incr(DeviceKeys.credentials_version())
         pipeline.execute()
-        print(f"{len(existing_credentials)} credentials pushed to the Redis Server")
+        print(f"{len(changed_credentials)} credentials pushed and {len(removed_devices)} removed in the Redis Server")
 
     @device_credentials.command("push")
     def push_to_redis():
@@ -158,6 +278,18 @@ def create_app(config_name: str = 'default'):
                 break
             print("Invalid password")
 
+    # Only in the processes serving requests (see BACKGROUND_THREADS_ENABLED): the commands
+    # run the same tasks on demand
+    if app.config['BACKGROUND_THREADS_ENABLED']:
+        from .collector import start_garbage_collector
+        start_garbage_collector(app)
+
+        from .archive import start_archiver
+        start_archiver(app)
+
+        from .reaper import start_reaper
+        start_reaper(app)
+
     if not 'device-credentials' in sys.argv:
         with app.app_context():
             _push_device_credentials_to_redis()
@@ -0,0 +1,158 @@
+"""
+Implementation of the maintenance commands ('flask tasks clean', 'flask errors reindex').
+
+They never use KEYS or delete keys one by one, since that blocks Redis (and
+every device waiting for a task) on a populated database: keys are found with
+SCAN / SSCAN and removed with pipelined UNLINKs in batches of batch_size, so
+they can be run while the scheduler is in use.
+"""
+from datetime import datetime
+from typing import Callable, Iterable, Iterator, List, Optional
+
+from reliascheduler import redis_store, scripts
+from reliascheduler.keys import ErrorKeys, TaskKeys, FileKeys, DeviceKeys
+from reliascheduler.errors import index_error
+from reliascheduler.schema import get_key_schema
+from reliascheduler.store import Task, get_task_store
+
+ProgressCallback = Callable[[str], None]
+
+def _batches(iterator: Iterable[str], batch_size: int) -> Iterator[List[str]]:
+    batch = []
+    for element in iterator:
+        batch.append(element)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _parse_time(value: Optional[str]) -> Optional[float]:
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+def clean_all(batch_size: int, progress: ProgressCallback) -> int:
+    """
+    Remove all the tasks, the queues, the files and the device assignments.
+
+    Return the number of keys removed.
+    """
+    keys = get_key_schema()
+    removed = 0
+
+    redis_store.unlink(keys.tasks, keys.queue, keys.queue_fair_share, keys.queue_wakeups, keys.priorities, keys.polling_deadlines, keys.running_deadlines)
+
+    for pattern in (TaskKeys.identifier("*"), TaskKeys.priority_queue("*"), DeviceKeys.device_assignment("*"), DeviceKeys.transmitter_handoff("*"), FileKeys.file("*")):
+        for batch in _batches(redis_store.scan_iter(match=pattern, count=batch_size), batch_size):
+            redis_store.unlink(*batch)
+            removed += len(batch)
+            progress(f"{pattern}: {removed} keys removed so far")
+
+    return removed
+
+def clean_tasks(batch_size: int, progress: ProgressCallback, status: Optional[str] = None, older_than: Optional[float] = None, priority: Optional[int] = None) -> int:
+    """
+    Remove the tasks with the provided status, created more than older_than seconds ago
+    and/or with the provided priority, removing them from their queue and releasing their files.
+
+    Return the number of tasks removed.
+    """
+    keys = get_key_schema()
+    tasks = get_task_store()
+    min_timestamp = datetime.now().timestamp() - older_than if older_than is not None else None
+
+    removed = 0
+    checked = 0
+    for batch in _batches(redis_store.sscan_iter(keys.tasks, count=batch_size), batch_size):
+        pipeline = redis_store.pipeline(transaction=False)
+        for task_identifier in batch:
+            pipeline.hmget(keys.task(task_identifier), TaskKeys.status, TaskKeys.startedTime, TaskKeys.priority, TaskKeys.author, TaskKeys.sessionId)
+        results = pipeline.execute()
+
+        selected = []
+        for task_identifier, (task_status, started_time, task_priority, author, session_id) in zip(batch, results):
+            if status is not None and task_status != status:
+                continue
+            if priority is not None and task_priority != str(priority):
+                continue
+            if min_timestamp is not None:
+                started_timestamp = _parse_time(started_time)
+                if started_timestamp is None or started_timestamp > min_timestamp:
+                    continue
+            selected.append(Task(identifier=task_identifier, author=author, session_id=session_id))
+
+        checked += len(batch)
+        if selected:
+            pipeline = redis_store.pipeline()
+            for task in selected:
+                tasks.release_files(task.identifier, pipeline=pipeline)
+            # Also gives the rounds of the queued tasks back to their owners
+            tasks.dequeue(selected, pipeline=pipeline)
+            pipeline.unlink(*[ keys.task(task.identifier) for task in selected ])
+            pipeline.srem(keys.tasks, *[ task.identifier for task in selected ])
+            scripts.execute_pipeline(pipeline)
+            removed += len(selected)
+
+        progress(f"{checked} tasks checked, {removed} removed so far")
+
+    return removed
+
+def reindex_errors(batch_size: int, progress: ProgressCallback) -> int:
+    """
+    Rebuild the per-user error indexes from the stored tasks and errors.
+
+    Return the number of errors indexed.
+    """
+    keys = get_key_schema()
+    indexed = 0
+    for set_key, key_function in [ (keys.tasks, keys.task), (keys.errors, keys.error) ]:
+        for batch in _batches(redis_store.sscan_iter(set_key, count=batch_size), batch_size):
+            error_keys = [ key_function(identifier) for identifier in batch ]
+
+            pipeline = redis_store.pipeline(transaction=False)
+            for error_key in error_keys:
+                pipeline.hmget(error_key, ErrorKeys.author, ErrorKeys.errorMessage, ErrorKeys.errorTime)
+            results = pipeline.execute()
+
+            pipeline = redis_store.pipeline(transaction=False)
+            for error_key, (author, error_message, error_time) in zip(error_keys, results):
+                if author is None or error_message in (None, "null"):
+                    continue
+                index_error(author, error_key, _parse_time(error_time), pipeline=pipeline)
+                indexed += 1
+            pipeline.execute()
+
+            progress(f"{indexed} errors indexed so far")
+
+    return indexed
+
+def migrate_priority_queues(progress: ProgressCallback) -> int:
+    """
+    Move the tasks queued in the lists per priority (used before the single queue) to the
+    queue, keeping their order, and remove the lists.
+
+    Return the number of tasks moved.
+    """
+    keys = get_key_schema()
+    tasks = get_task_store()
+    moved = 0
+    for priority in redis_store.zrange(keys.priorities, 0, -1):
+        priority_queue = keys.priority_queue(priority)
+        # The tasks were pushed with LPUSH and popped with RPOP, so the oldest is the last one
+        task_identifiers = redis_store.lrange(priority_queue, 0, -1)[::-1]
+
+        pipeline = redis_store.pipeline()
+        for task_identifier in task_identifiers:
+            task = tasks.get(task_identifier, 'priority', 'author', 'session_id')
+            if task is not None:
+                tasks.enqueue(task, pipeline=pipeline)
+        pipeline.unlink(priority_queue)
+        pipeline.zrem(keys.priorities, priority)
+        scripts.execute_pipeline(pipeline)
+
+        moved += len(task_identifiers)
+        progress(f"Priority {priority}: {len(task_identifiers)} tasks moved")
+
+    return moved
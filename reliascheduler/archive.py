@@ -0,0 +1,360 @@
+"""
+Archive of the finished tasks in compressed segment files on the local disk.
+
+Otherwise, the finished tasks (completed, deleted or with an error) stay in Redis
+with their GRC files until the garbage collector removes them. If ARCHIVE_DIRECTORY
+is set, every ARCHIVE_INTERVAL seconds a single worker (the one holding a lock in
+Redis) moves the tasks finished and not polled in ARCHIVE_AFTER seconds to the
+archive and removes them from Redis, so Redis only keeps the working set while
+user_get_task still finds them (in the archive). It can also be run with
+'flask tasks archive'.
+
+The archive is a sequence of segments, each one a pair of files:
+
+ - segment-NNNNNN.data: append-only records, each one a 4-byte length followed
+   by the task hash as JSON (with the contents of its files instead of their
+   digests), compressed with zlib.
+ - segment-NNNNNN.index: a header followed by fixed-size entries (a 16-byte hash
+   of the task identifier, the offset and the length of its record), sorted by
+   hash. After every append it is written to a temporary file and renamed, so
+   readers always see a complete index.
+
+A new segment is started once the data file reaches ARCHIVE_SEGMENT_SIZE bytes.
+Readers memory-map the indexes (mapping them again when they are replaced) and
+binary search them, newest segment first, so a lookup reads a single record.
+
+The records are written and synced before the tasks are removed from Redis, so a
+crash can only leave a task in both places (and it is not archived again).
+
+The archive is local to the host: the workers looking up tasks must be able to
+read ARCHIVE_DIRECTORY (run them in the same host, or use shared storage).
+"""
+import os
+import re
+import json
+import mmap
+import time
+import zlib
+import struct
+import hashlib
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from flask import Flask, current_app
+
+from reliascheduler import redis_store, scripts
+from reliascheduler.collector import FINISHED_STATUSES
+from reliascheduler.keys import TaskKeys, FileKeys
+from reliascheduler.schema import decode_file, get_key_schema
+from reliascheduler.store import Task, get_task_store
+
+logger = logging.getLogger(__name__)
+
+_INDEX_HEADER = b'RELIAIX1'
+# Hash of the task identifier, offset and length of the record
+_INDEX_ENTRY = struct.Struct('>16sQI')
+_RECORD_LENGTH = struct.Struct('>I')
+_INDEX_FILENAME = re.compile(r'^segment-(\d{6})\.index$')
+
+# The directory might have changed without changing its modification time if it was
+# modified less than this ago (the timestamps are coarse), so it is listed again
+_MTIME_GRANULARITY = 0.1
+
+# (task hash field, file content field) of each side
+_FILE_FIELDS = (
+    (TaskKeys.transmitterFileDigest, TaskKeys.transmitterFile),
+    (TaskKeys.receiverFileDigest, TaskKeys.receiverFile),
+)
+
+def _task_hash(task_identifier: str) -> bytes:
+    return hashlib.blake2b(task_identifier.encode(), digest_size=16).digest()
+
+class _Segment:
+    __slots__ = ('number', 'data_filename', 'index_stat', 'index', 'count')
+
+    def __init__(self, number: int, data_filename: str, index_filename: str):
+        self.number = number
+        self.data_filename = data_filename
+        with open(index_filename, 'rb') as index_file:
+            stat = os.fstat(index_file.fileno())
+            self.index_stat = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            # The mapping stays valid after the file is replaced (and closed once unused)
+            self.index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.index[:len(_INDEX_HEADER)] != _INDEX_HEADER:
+            raise ValueError(f"Invalid archive index {index_filename}")
+        self.count = (len(self.index) - len(_INDEX_HEADER)) // _INDEX_ENTRY.size
+
+    def find(self, task_hash: bytes) -> Optional[Tuple[int, int]]:
+        """
+        Return the offset and the length of the record of the task, or None if it is not in the segment
+        """
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            position = len(_INDEX_HEADER) + middle * _INDEX_ENTRY.size
+            entry_hash = self.index[position:position + 16]
+            if entry_hash < task_hash:
+                low = middle + 1
+            elif entry_hash > task_hash:
+                high = middle
+            else:
+                _, offset, length = _INDEX_ENTRY.unpack_from(self.index, position)
+                return offset, length
+        return None
+
+    def entries(self) -> List[Tuple[bytes, int, int]]:
+        return [ _INDEX_ENTRY.unpack_from(self.index, len(_INDEX_HEADER) + i * _INDEX_ENTRY.size) for i in range(self.count) ]
+
+class TaskArchive:
+    def __init__(self, directory: str, segment_size: int):
+        self.directory = directory
+        self.segment_size = segment_size
+        # Newest first
+        self._segments: List[_Segment] = []
+        self._directory_mtime: Optional[int] = None
+        self._trusted = False
+        self._lock = threading.Lock()
+
+    def _filename(self, number: int, extension: str) -> str:
+        return os.path.join(self.directory, f'segment-{number:06d}.{extension}')
+
+    def _get_segments(self, force: bool = False) -> List[_Segment]:
+        """
+        Return the segments, newest first, mapping the indexes that changed since the last call
+        """
+        try:
+            directory_mtime = os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            return []
+
+        with self._lock:
+            if not force and self._trusted and directory_mtime == self._directory_mtime:
+                return self._segments
+
+            current = { segment.number: segment for segment in self._segments }
+            segments = []
+            for filename in os.listdir(self.directory):
+                match = _INDEX_FILENAME.match(filename)
+                if match is None:
+                    continue
+                number = int(match.group(1))
+                index_filename = os.path.join(self.directory, filename)
+                segment = current.get(number)
+                if segment is not None:
+                    stat = os.stat(index_filename)
+                    if segment.index_stat == (stat.st_ino, stat.st_size, stat.st_mtime_ns):
+                        segments.append(segment)
+                        continue
+                segments.append(_Segment(number, self._filename(number, 'data'), index_filename))
+
+            segments.sort(key=lambda segment: segment.number, reverse=True)
+            self._segments = segments
+            self._directory_mtime = directory_mtime
+            self._trusted = time.time_ns() - directory_mtime > _MTIME_GRANULARITY * 1e9
+            return segments
+
+    def _locate(self, task_identifier: str) -> Optional[Tuple[_Segment, int, int]]:
+        task_hash = _task_hash(task_identifier)
+        for segment in self._get_segments():
+            location = segment.find(task_hash)
+            if location is not None:
+                return (segment,) + location
+        return None
+
+    def contains(self, task_identifier: str) -> bool:
+        return self._locate(task_identifier) is not None
+
+    def get_mapping(self, task_identifier: str) -> Optional[Dict[str, str]]:
+        """
+        Return the archived hash of the task (with the contents of its files), or None if it is not archived
+        """
+        location = self._locate(task_identifier)
+        if location is None:
+            return None
+
+        segment, offset, length = location
+        with open(segment.data_filename, 'rb') as data_file:
+            record = os.pread(data_file.fileno(), length, offset)
+        payload_length, = _RECORD_LENGTH.unpack_from(record)
+        mapping = json.loads(zlib.decompress(record[_RECORD_LENGTH.size:_RECORD_LENGTH.size + payload_length]))
+        # Another identifier with the same hash
+        if mapping.get(TaskKeys.uniqueIdentifier) != task_identifier:
+            return None
+        return mapping
+
+    def get(self, task_identifier: str) -> Optional[Task]:
+        mapping = self.get_mapping(task_identifier)
+        if mapping is None:
+            return None
+        return Task.from_mapping(mapping)
+
+    def append(self, mappings: List[Dict[str, str]]) -> int:
+        """
+        Add the task hashes (which must have uniqueIdentifier) to the last segment, or to a new one
+        if it is full, skipping those already archived. Return the number of tasks added.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        segments = self._get_segments(force=True)
+
+        new_mappings = {}
+        for mapping in mappings:
+            task_identifier = mapping[TaskKeys.uniqueIdentifier]
+            if task_identifier not in new_mappings and not self.contains(task_identifier):
+                new_mappings[task_identifier] = mapping
+        if not new_mappings:
+            return 0
+
+        entries = []
+        number = segments[0].number if segments else 0
+        if not segments or os.path.getsize(segments[0].data_filename) >= self.segment_size:
+            number += 1
+        else:
+            entries = segments[0].entries()
+
+        with open(self._filename(number, 'data'), 'ab') as data_file:
+            offset = data_file.seek(0, os.SEEK_END)
+            for task_identifier, mapping in new_mappings.items():
+                payload = zlib.compress(json.dumps(mapping, separators=(',', ':')).encode())
+                record = _RECORD_LENGTH.pack(len(payload)) + payload
+                data_file.write(record)
+                entries.append((_task_hash(task_identifier), offset, len(record)))
+                offset += len(record)
+            data_file.flush()
+            os.fsync(data_file.fileno())
+
+        entries.sort()
+        index_filename = self._filename(number, 'index')
+        temporary_filename = index_filename + '.tmp'
+        with open(temporary_filename, 'wb') as index_file:
+            index_file.write(_INDEX_HEADER + b''.join(_INDEX_ENTRY.pack(*entry) for entry in entries))
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        os.replace(temporary_filename, index_filename)
+
+        directory_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+
+        self._get_segments(force=True)
+        return len(new_mappings)
+
+def _is_task_archivable(status: Optional[str], inactive_since: Optional[str], error_message: Optional[str], min_timestamp: float) -> bool:
+    if inactive_since is None or float(inactive_since) > min_timestamp:
+        return False
+    return status in FINISHED_STATUSES or (error_message is not None and error_message != "null")
+
+def _archive_task_batch(archive: TaskArchive, task_identifiers: List[str], min_timestamp: float) -> int:
+    keys = get_key_schema()
+    tasks = get_task_store()
+
+    pipeline = redis_store.pipeline(transaction=False)
+    for task_identifier in task_identifiers:
+        pipeline.hmget(keys.task(task_identifier), TaskKeys.status, TaskKeys.inactiveSince, TaskKeys.errorMessage)
+    results = pipeline.execute()
+
+    archivable = [
+        task_identifier
+        for task_identifier, (status, inactive_since, error_message) in zip(task_identifiers, results)
+        if _is_task_archivable(status, inactive_since, error_message, min_timestamp)
+    ]
+    if not archivable:
+        return 0
+
+    pipeline = redis_store.pipeline(transaction=False)
+    for task_identifier in archivable:
+        pipeline.hgetall(keys.task(task_identifier))
+    mappings = [ mapping for mapping in pipeline.execute() if mapping.get(TaskKeys.uniqueIdentifier) ]
+
+    # The files are archived with each task, since they are released from Redis
+    digests = sorted({ mapping[digest_field] for mapping in mappings for digest_field, _ in _FILE_FIELDS if mapping.get(digest_field) })
+    pipeline = redis_store.pipeline(transaction=False)
+    for digest in digests:
+        pipeline.hget(keys.file(digest), FileKeys.content)
+    contents = dict(zip(digests, pipeline.execute()))
+    for mapping in mappings:
+        for digest_field, content_field in _FILE_FIELDS:
+            digest = mapping.pop(digest_field, None)
+            if digest is not None and contents.get(digest) is not None:
+                mapping[content_field] = decode_file(contents[digest])
+
+    archive.append(mappings)
+
+    pipeline = redis_store.pipeline()
+    for mapping in mappings:
+        task_identifier = mapping[TaskKeys.uniqueIdentifier]
+        tasks.release_files(task_identifier, pipeline=pipeline)
+        pipeline.zrem(keys.user_errors(str(mapping.get(TaskKeys.author))), keys.task(task_identifier))
+    pipeline.unlink(*[ keys.task(mapping[TaskKeys.uniqueIdentifier]) for mapping in mappings ])
+    pipeline.srem(keys.tasks, *[ mapping[TaskKeys.uniqueIdentifier] for mapping in mappings ])
+    scripts.execute_pipeline(pipeline)
+    return len(mappings)
+
+def archive_finished_tasks(after: Optional[float] = None) -> Optional[int]:
+    """
+    Move the tasks finished and not polled in after seconds (ARCHIVE_AFTER by default) from
+    Redis to the archive.
+
+    Return the number of tasks archived, or None if another process is already archiving.
+    """
+    archive = get_archive()
+    if archive is None:
+        raise RuntimeError("ARCHIVE_DIRECTORY is not set")
+    if after is None:
+        after = current_app.config['ARCHIVE_AFTER']
+    batch_size = current_app.config['GC_BATCH_SIZE']
+    min_timestamp = time.time() - after
+
+    keys = get_key_schema()
+    lock = redis_store.lock(keys.archive_lock, timeout=3600, blocking_timeout=0)
+    if not lock.acquire(blocking=False):
+        return None
+
+    try:
+        archived = 0
+        batch = []
+        for task_identifier in redis_store.sscan_iter(keys.tasks, count=batch_size):
+            batch.append(task_identifier)
+            if len(batch) >= batch_size:
+                archived += _archive_task_batch(archive, batch, min_timestamp)
+                batch = []
+        if batch:
+            archived += _archive_task_batch(archive, batch, min_timestamp)
+        return archived
+    finally:
+        lock.release()
+
+def get_archive() -> Optional[TaskArchive]:
+    """
+    Return the archive, or None if ARCHIVE_DIRECTORY is not set
+    """
+    return current_app.extensions.get('reliascheduler-archive')
+
+def init_archive(app: Flask):
+    directory = app.config['ARCHIVE_DIRECTORY']
+    if directory:
+        app.extensions['reliascheduler-archive'] = TaskArchive(directory, app.config['ARCHIVE_SEGMENT_SIZE'])
+
+def _run_periodically(app: Flask, interval: float):
+    while True:
+        time.sleep(interval)
+        try:
+            with app.app_context():
+                archived = archive_finished_tasks()
+            if archived:
+                logger.info(f"{archived} tasks archived")
+        except Exception:
+            logger.warning("Error archiving the finished tasks", exc_info=True)
+
+def start_archiver(app: Flask):
+    """
+    Start the background archiver if ARCHIVE_DIRECTORY and ARCHIVE_INTERVAL are set
+    """
+    interval = app.config['ARCHIVE_INTERVAL']
+    if not app.config['ARCHIVE_DIRECTORY'] or not interval:
+        return
+
+    thread = threading.Thread(target=_run_periodically, args=(app, interval), name='relia-scheduler-archiver', daemon=True)
+    thread.start()
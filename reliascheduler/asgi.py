@@ -0,0 +1,278 @@
+"""
+ASGI application for serving the device long-polls without a thread per device.
+
+In the WSGI app, each device waiting for a task (/scheduler/devices/tasks/receiver
+and /scheduler/devices/tasks/transmitter) blocks a worker thread for up to 25
+seconds. Here those two routes run the same logic as the blueprint (the
+assign_receiver_steps and assign_transmitter_steps generators), but the waits
+(BRPOP on the queue wake-ups and on the handoff) are awaited with an asyncio Redis
+client in the event loop, and only the short steps in between run in a thread
+(with the sync client and a request context), so thousands of devices can wait
+in a single process.
+
+The task events streams (/scheduler/user/tasks/<task_identifier>/events) are served
+the same way (the task_events_steps generator), waiting for the changes of status
+with an asyncio pub/sub, so the open streams do not hold any thread either.
+
+Both run in a single request context, with the request hooks of the app, so they are
+also measured (see reliascheduler.metrics, the asyncio client is instrumented too)
+and recorded (see reliascheduler.recorder) as in the WSGI app.
+
+Any other request is passed to the Flask app as a WSGI server would, in a thread
+of its own pool (ASGI_THREADS). The whole response is produced in that thread, and
+the chunks of streamed responses are passed to the event loop through a queue.
+
+It is created in asgi_app.py, and can be run with any ASGI server, e.g.:
+
+    uvicorn asgi_app:application --workers 2
+"""
+import io
+import re
+import sys
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from flask import Flask, Response, jsonify
+
+from reliascheduler.metrics import InstrumentedAsyncRedis
+from reliascheduler.store import get_task_store
+from reliascheduler.views.scheduler import TASK_EVENTS_HEADERS, EventsWait, assign_receiver_steps, assign_transmitter_steps, task_events_steps
+
+_TASK_EVENTS_PATH = re.compile(r'^/scheduler/user/tasks/([^/]+)/events$')
+
+def create_async_redis(app: Flask):
+    """
+    Return an asyncio Redis client for the app (a connection per waiting device and per
+    open task events stream)
+    """
+    return InstrumentedAsyncRedis.from_url(app.config['REDIS_URL'], decode_responses=True)
+
+class SchedulerASGI:
+    def __init__(self, app: Flask):
+        self.app = app
+        self._async_redis = None
+        self._wsgi_executor = ThreadPoolExecutor(app.config['ASGI_THREADS'], thread_name_prefix='relia-scheduler-wsgi')
+        # Paths (relative to the root path of the server) served in the event loop
+        self.device_routes: Dict[str, Callable] = {
+            '/scheduler/devices/tasks/receiver': assign_receiver_steps,
+            '/scheduler/devices/tasks/transmitter': assign_transmitter_steps,
+        }
+
+    @property
+    def async_redis(self):
+        # Created in the event loop where it will be used
+        if self._async_redis is None:
+            self._async_redis = create_async_redis(self.app)
+        return self._async_redis
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+
+        if scope['type'] != 'http':
+            return
+
+        body = await self._read_body(receive)
+        environ = _build_environ(scope, body)
+
+        steps_function = self.device_routes.get(environ['PATH_INFO'])
+        task_events = _TASK_EVENTS_PATH.match(environ['PATH_INFO'])
+        if steps_function is not None and scope['method'] == 'GET':
+            await self._run_device_steps(steps_function, environ, send)
+        elif task_events is not None and scope['method'] == 'GET':
+            await self._run_task_events(task_events.group(1), environ, receive, send)
+        else:
+            await self._run_wsgi(environ, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({ 'type': 'lifespan.startup.complete' })
+            elif message['type'] == 'lifespan.shutdown':
+                if self._async_redis is not None:
+                    await self._async_redis.close()
+                self._wsgi_executor.shutdown(wait=False)
+                await send({ 'type': 'lifespan.shutdown.complete' })
+                return
+
+    async def _read_body(self, receive) -> bytes:
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    def _step(self, steps, value: Any, first: bool) -> Tuple[Any, Optional[Response]]:
+        """
+        Run the generator until its next yield, in the request context of the runner. Return
+        what it yielded, or the response if it finished (None if it finished without one).
+        """
+        try:
+            return (next(steps) if first else steps.send(value)), None
+        except StopIteration as stop:
+            if stop.value is None:
+                return None, None
+            fields, status_code = stop.value
+            return None, self.app.make_response((jsonify(**fields), status_code))
+
+    async def _run_device_steps(self, steps_function: Callable, environ: dict, send):
+        # A single request context for the steps and the waits, with the request hooks of the
+        # app (the metrics and the recorder), which are run here since they are not blocking
+        with self.app.request_context(environ):
+            response = self.app.preprocess_request()
+            if response is None:
+                steps = steps_function()
+                device_wait, response = await asyncio.to_thread(self._step, steps, None, True)
+                while response is None:
+                    value = await device_wait.wait_async(self.async_redis)
+                    device_wait, response = await asyncio.to_thread(self._step, steps, value, False)
+            else:
+                response = self.app.make_response(response)
+            response = self.app.process_response(response)
+
+        await _send_response(send, response)
+
+    async def _run_task_events(self, task_identifier: str, environ: dict, receive, send):
+        # As in _run_device_steps, with the hooks run before the stream is sent
+        with self.app.request_context(environ):
+            response = self.app.preprocess_request()
+            if response is not None:
+                await _send_response(send, self.app.process_response(self.app.make_response(response)))
+                return
+
+            # Subscribe before the first step reads the task, so no change is lost in between
+            pubsub = await get_task_store().subscribe_async(self.async_redis, task_identifier)
+            disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+            try:
+                steps = task_events_steps(task_identifier)
+                chunk, response = await asyncio.to_thread(self._step, steps, None, True)
+                if response is not None:
+                    await _send_response(send, self.app.process_response(response))
+                    return
+
+                response = self.app.process_response(self.app.response_class(mimetype='text/event-stream', headers=TASK_EVENTS_HEADERS))
+                await send({ 'type': 'http.response.start', 'status': response.status_code, 'headers': _encode_headers(response.headers.items()) })
+                while chunk is not None:
+                    if isinstance(chunk, EventsWait):
+                        message = asyncio.ensure_future(pubsub.get_message(timeout=chunk.timeout))
+                        await asyncio.wait({ message, disconnected }, return_when=asyncio.FIRST_COMPLETED)
+                        if disconnected.done():
+                            # Otherwise the stream would keep the task alive
+                            message.cancel()
+                            return
+                        value = message.result() is not None
+                    else:
+                        await send({ 'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True })
+                        value = None
+                    chunk, _ = await asyncio.to_thread(self._step, steps, value, False)
+                await send({ 'type': 'http.response.body', 'body': b'' })
+            finally:
+                disconnected.cancel()
+                await pubsub.close()
+
+    def _serve_wsgi(self, environ: dict, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue, cancelled: threading.Event):
+        """
+        Run the Flask app and iterate its response in this thread, passing the start of the
+        response, the chunks and the end (or the error) to the event loop through the queue
+        """
+        def put(*message):
+            loop.call_soon_threadsafe(queue.put_nowait, message)
+
+        def start_response(status, headers, exc_info=None):
+            put('start', int(status.split(' ', 1)[0]), _encode_headers(headers))
+
+        try:
+            iterable = self.app.wsgi_app(environ, start_response)
+            try:
+                for chunk in iterable:
+                    # The client disconnected
+                    if cancelled.is_set():
+                        break
+                    if chunk:
+                        put('body', chunk)
+            finally:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+        except BaseException as err:
+            put('error', err)
+            return
+        put('end')
+
+    async def _run_wsgi(self, environ: dict, send):
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        cancelled = threading.Event()
+        loop.run_in_executor(self._wsgi_executor, self._serve_wsgi, environ, loop, queue, cancelled)
+        try:
+            # Chunk by chunk, so streamed responses (e.g., the task events) are sent as they are generated
+            while True:
+                message = await queue.get()
+                if message[0] == 'start':
+                    await send({ 'type': 'http.response.start', 'status': message[1], 'headers': message[2] })
+                elif message[0] == 'body':
+                    await send({ 'type': 'http.response.body', 'body': message[1], 'more_body': True })
+                elif message[0] == 'error':
+                    raise message[1]
+                else:
+                    await send({ 'type': 'http.response.body', 'body': b'' })
+                    return
+        finally:
+            cancelled.set()
+
+def _encode_headers(headers) -> List[Tuple[bytes, bytes]]:
+    return [ (name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers ]
+
+async def _send_response(send, response: Response):
+    await send({ 'type': 'http.response.start', 'status': response.status_code, 'headers': _encode_headers(response.headers.items()) })
+    await send({ 'type': 'http.response.body', 'body': response.get_data() })
+
+async def _wait_for_disconnect(receive):
+    # The body was already read, so the next message is the disconnection
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+def _build_environ(scope, body: bytes) -> dict:
+    """
+    Build the WSGI environ of an ASGI HTTP request
+    """
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = f'HTTP_{name}'
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+def create_asgi_app(app: Flask) -> SchedulerASGI:
+    return SchedulerASGI(app)
@@ -1,12 +1,57 @@
+import time
 import hashlib
+import threading
 
-from typing import Optional
+from typing import Dict, Optional, Tuple
 
 from flask import current_app, request
 
 from reliascheduler import redis_store
 from reliascheduler.keys import DeviceKeys
 
+class _VerifiedCredentialsCache:
+    """
+    Per-worker cache of credentials that have been successfully verified, so device
+    requests do not need to go to Redis and calculate a SHA-512 every time.
+
+    Entries expire after DEVICE_CREDENTIALS_CACHE_TTL seconds. Every time the credentials
+    are pushed to Redis, a version counter is increased; the cache checks it at most every
+    DEVICE_CREDENTIALS_VERSION_CHECK_INTERVAL seconds and discards everything if it changed.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (device_base, password digest) -> expiration time
+        self._verified: Dict[Tuple[str, bytes], float] = {}
+        self._version: Optional[str] = None
+        self._version_checked_at: float = 0
+
+    def _check_version(self, now: float):
+        if now - self._version_checked_at < current_app.config['DEVICE_CREDENTIALS_VERSION_CHECK_INTERVAL']:
+            return
+
+        version = redis_store.get(DeviceKeys.credentials_version())
+        with self._lock:
+            if version != self._version:
+                self._verified.clear()
+                self._version = version
+            self._version_checked_at = now
+
+    def is_verified(self, device_base: str, password_digest: bytes) -> bool:
+        now = time.time()
+        self._check_version(now)
+        expiration = self._verified.get((device_base, password_digest))
+        return expiration is not None and expiration > now
+
+    def add(self, device_base: str, password_digest: bytes):
+        with self._lock:
+            self._verified[(device_base, password_digest)] = time.time() + current_app.config['DEVICE_CREDENTIALS_CACHE_TTL']
+
+def _get_verified_credentials_cache() -> _VerifiedCredentialsCache:
+    cache = current_app.extensions.get('reliascheduler-credentials-cache')
+    if cache is None:
+        cache = current_app.extensions.setdefault('reliascheduler-credentials-cache', _VerifiedCredentialsCache())
+    return cache
+
 def check_device_credentials() -> Optional[str]:
     """
     Check if it is a request from an authenticated device.
@@ -32,12 +77,19 @@ def check_device_credentials() -> Optional[str]:
     if device_type not in ('r', 't'):
         return None
 
+    # Only successful verifications are cached, so a new or updated password is never rejected
+    cache = _get_verified_credentials_cache()
+    password_digest = hashlib.sha256(password.encode()).digest()
+    if cache.is_verified(device_base, password_digest):
+        return device
+
     salt_and_salted_password = redis_store.hget(DeviceKeys.credentials(), device_base)
     if not salt_and_salted_password:
         return None
 
     salt, salted_password = salt_and_salted_password.split('$')
     if hashlib.sha512((salt + password).encode()).hexdigest() == salted_password:
+        cache.add(device_base, password_digest)
         return device
     return None
 
@@ -0,0 +1,221 @@
+"""
+Garbage collector for the finished tasks and the error records.
+
+Nothing else removes the tasks from Redis, so this walks TaskKeys.tasks() and
+ErrorKeys.errors() with SSCAN in batches of GC_BATCH_SIZE, and UNLINKs those
+older than TASK_RETENTION / ERROR_RETENTION seconds. It can be run with
+'flask tasks gc' or periodically (every GC_INTERVAL seconds) in a background
+thread of the app. A lock in Redis avoids several workers collecting at the
+same time, and the totals collected are kept in Redis. It also forgets the
+devices not seen in LAST_CHECKS_MAX_AGE seconds (see reliascheduler.store).
+"""
+import time
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from flask import Flask, current_app
+
+from reliascheduler import redis_store, scripts
+from reliascheduler.keys import ErrorKeys, TaskKeys
+from reliascheduler.schema import get_key_schema
+from reliascheduler.store import Task, get_device_store, get_task_store
+
+logger = logging.getLogger(__name__)
+
+# Tasks with this status do not need to stay in Redis after the retention time
+FINISHED_STATUSES = (TaskKeys.Status.completed, TaskKeys.Status.deleted, TaskKeys.Status.error)
+
+class CollectionStats:
+    __slots__ = ('tasks', 'errors', 'keys', 'bytes')
+
+    def __init__(self):
+        self.tasks = 0
+        self.errors = 0
+        self.keys = 0
+        self.bytes = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return { name: getattr(self, name) for name in self.__slots__ }
+
+def _memory_usage(keys: List[str]) -> int:
+    """
+    Approximate size of the keys. MEMORY USAGE might not be available (e.g., old Redis versions)
+    """
+    pipeline = redis_store.pipeline(transaction=False)
+    for key in keys:
+        pipeline.memory_usage(key)
+    return sum(size for size in pipeline.execute(raise_on_error=False) if isinstance(size, int))
+
+def _is_task_collectable(status: Optional[str], inactive_since: Optional[str], error_message: Optional[str], min_timestamp: float) -> bool:
+    if inactive_since is None or float(inactive_since) > min_timestamp:
+        return False
+
+    if status in FINISHED_STATUSES or (error_message is not None and error_message != "null"):
+        return True
+
+    # Nobody will run a queued task of a user who left long ago (it is skipped anyway)
+    return status == TaskKeys.Status.queued
+
+def _collect_tasks(stats: CollectionStats, retention: float, batch_size: int):
+    keys = get_key_schema()
+    min_timestamp = time.time() - retention
+
+    batch = []
+    for task_identifier in redis_store.sscan_iter(keys.tasks, count=batch_size):
+        batch.append(task_identifier)
+        if len(batch) >= batch_size:
+            _collect_task_batch(stats, batch, min_timestamp)
+            batch = []
+    if batch:
+        _collect_task_batch(stats, batch, min_timestamp)
+
+def _collect_task_batch(stats: CollectionStats, task_identifiers: List[str], min_timestamp: float):
+    keys = get_key_schema()
+    tasks = get_task_store()
+
+    pipeline = redis_store.pipeline(transaction=False)
+    for task_identifier in task_identifiers:
+        pipeline.hmget(keys.task(task_identifier), TaskKeys.uniqueIdentifier, TaskKeys.status, TaskKeys.inactiveSince, TaskKeys.errorMessage, TaskKeys.author, TaskKeys.sessionId)
+    results = pipeline.execute()
+
+    collectable = []
+    orphans = []
+    for task_identifier, (unique_identifier, status, inactive_since, error_message, author, session_id) in zip(task_identifiers, results):
+        if unique_identifier is None:
+            # The identifier was reserved but the task was never created (e.g., invalid request)
+            orphans.append(task_identifier)
+        elif _is_task_collectable(status, inactive_since, error_message, min_timestamp):
+            collectable.append((Task(identifier=task_identifier, author=author, session_id=session_id), status))
+
+    if not collectable and not orphans:
+        return
+
+    task_keys = [ keys.task(task.identifier) for task, _ in collectable ]
+    stats.bytes += _memory_usage(task_keys)
+
+    pipeline = redis_store.pipeline()
+    for task, _ in collectable:
+        tasks.release_files(task.identifier, pipeline=pipeline)
+        pipeline.zrem(keys.user_errors(str(task.author)), keys.task(task.identifier))
+    # Otherwise they would stay in the queue (and in the rounds of their owners) without their hashes
+    queued_tasks = [ task for task, status in collectable if status == TaskKeys.Status.queued ]
+    if queued_tasks:
+        tasks.dequeue(queued_tasks, pipeline=pipeline)
+    if task_keys:
+        pipeline.unlink(*task_keys)
+    pipeline.srem(keys.tasks, *([ task.identifier for task, _ in collectable ] + orphans))
+    scripts.execute_pipeline(pipeline)
+
+    stats.tasks += len(collectable)
+    stats.keys += len(task_keys)
+
+def _error_timestamp(error_time: Optional[str]) -> Optional[float]:
+    try:
+        return datetime.fromisoformat(error_time).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+def _collect_errors(stats: CollectionStats, retention: float, batch_size: int):
+    keys = get_key_schema()
+    min_timestamp = time.time() - retention
+
+    batch = []
+    for task_identifier in redis_store.sscan_iter(keys.errors, count=batch_size):
+        batch.append(task_identifier)
+        if len(batch) >= batch_size:
+            _collect_error_batch(stats, batch, min_timestamp)
+            batch = []
+    if batch:
+        _collect_error_batch(stats, batch, min_timestamp)
+
+def _collect_error_batch(stats: CollectionStats, task_identifiers: List[str], min_timestamp: float):
+    keys = get_key_schema()
+
+    pipeline = redis_store.pipeline(transaction=False)
+    for task_identifier in task_identifiers:
+        pipeline.hmget(keys.error(task_identifier), ErrorKeys.author, ErrorKeys.errorTime)
+    results = pipeline.execute()
+
+    collectable = []
+    for task_identifier, (author, error_time) in zip(task_identifiers, results):
+        error_timestamp = _error_timestamp(error_time)
+        if error_timestamp is None or error_timestamp < min_timestamp:
+            collectable.append((task_identifier, author))
+
+    if not collectable:
+        return
+
+    error_keys = [ keys.error(task_identifier) for task_identifier, _ in collectable ]
+    stats.bytes += _memory_usage(error_keys)
+
+    pipeline = redis_store.pipeline()
+    for task_identifier, author in collectable:
+        pipeline.zrem(keys.user_errors(str(author)), keys.error(task_identifier))
+    pipeline.unlink(*error_keys)
+    pipeline.srem(keys.errors, *[ task_identifier for task_identifier, _ in collectable ])
+    pipeline.execute()
+
+    stats.errors += len(collectable)
+    stats.keys += len(error_keys)
+
+def collect_garbage(task_retention: Optional[float] = None, error_retention: Optional[float] = None) -> Optional[CollectionStats]:
+    """
+    Remove the finished tasks and the errors older than the retention times.
+
+    Return what was collected, or None if another process is already collecting.
+    """
+    if task_retention is None:
+        task_retention = current_app.config['TASK_RETENTION']
+    if error_retention is None:
+        error_retention = current_app.config['ERROR_RETENTION']
+    batch_size = current_app.config['GC_BATCH_SIZE']
+
+    keys = get_key_schema()
+    lock = redis_store.lock(keys.gc_lock, timeout=3600, blocking_timeout=0)
+    if not lock.acquire(blocking=False):
+        return None
+
+    try:
+        stats = CollectionStats()
+        _collect_tasks(stats, task_retention, batch_size)
+        _collect_errors(stats, error_retention, batch_size)
+        get_device_store().forget_unseen()
+
+        pipeline = redis_store.pipeline()
+        for name, value in stats.as_dict().items():
+            pipeline.hincrby(keys.gc_stats, name, value)
+        pipeline.hset(keys.gc_stats, 'lastRun', datetime.now().isoformat())
+        pipeline.execute()
+        return stats
+    finally:
+        lock.release()
+
+def get_collection_totals() -> Dict[str, str]:
+    """
+    Return what has been collected since the stats were created, and the time of the last run
+    """
+    return redis_store.hgetall(get_key_schema().gc_stats)
+
+def _run_periodically(app: Flask, interval: float):
+    while True:
+        time.sleep(interval)
+        try:
+            with app.app_context():
+                stats = collect_garbage()
+            if stats is not None:
+                logger.info(f"Garbage collected: {stats.as_dict()}")
+        except Exception:
+            logger.warning("Error collecting garbage", exc_info=True)
+
+def start_garbage_collector(app: Flask):
+    """
+    Start the background garbage collector if GC_INTERVAL is set
+    """
+    interval = app.config['GC_INTERVAL']
+    if not interval:
+        return
+
+    thread = threading.Thread(target=_run_periodically, args=(app, interval), name='relia-scheduler-gc', daemon=True)
+    thread.start()
@@ -0,0 +1,72 @@
+import time
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from flask import current_app
+
+from reliascheduler import redis_store
+from reliascheduler.keys import ErrorKeys
+from reliascheduler.schema import get_key_schema
+
+def store_error(task_identifier: str, author: Optional[str], error_message: str, pipeline=None):
+    """
+    Store an error for a task identifier and add it to the error index of the author.
+
+    If a pipeline is provided, the commands are added to it (and the caller must execute it).
+    """
+    execute = pipeline is None
+    if pipeline is None:
+        pipeline = redis_store.pipeline()
+
+    keys = get_key_schema()
+    error_key = keys.error(task_identifier)
+    pipeline.sadd(keys.errors, task_identifier)
+    pipeline.hset(error_key, mapping={
+        ErrorKeys.uniqueIdentifier: task_identifier,
+        ErrorKeys.author: str(author),
+        ErrorKeys.errorMessage: error_message,
+        ErrorKeys.errorTime: datetime.now().isoformat(),
+    })
+    index_error(author, error_key, pipeline=pipeline)
+
+    if execute:
+        pipeline.execute()
+
+def index_error(author: Optional[str], error_key: str, error_timestamp: Optional[float] = None, pipeline=None):
+    """
+    Add the key of a hash with an error (the error itself, or a task with an error message) to
+    the error index of the author: a sorted set by time, capped to MAX_ERRORS_PER_USER elements.
+
+    If a pipeline is provided, the commands are added to it (and the caller must execute it).
+    """
+    execute = pipeline is None
+    if pipeline is None:
+        pipeline = redis_store.pipeline()
+
+    user_errors_key = get_key_schema().user_errors(str(author))
+    pipeline.zadd(user_errors_key, { error_key: error_timestamp or time.time() })
+    pipeline.zremrangebyrank(user_errors_key, 0, -current_app.config['MAX_ERRORS_PER_USER'] - 1)
+
+    if execute:
+        pipeline.execute()
+
+def get_latest_errors(author: str, count: int = 5) -> List[Tuple[str, str]]:
+    """
+    Return the last errors of the author as (task identifier, error message), oldest first
+    """
+    error_keys = redis_store.zrange(get_key_schema().user_errors(author), -count, -1)
+    if not error_keys:
+        return []
+
+    # Both the error hashes and the task hashes use the same field names
+    pipeline = redis_store.pipeline()
+    for error_key in error_keys:
+        pipeline.hmget(error_key, ErrorKeys.uniqueIdentifier, ErrorKeys.errorMessage)
+
+    errors = []
+    for unique_identifier, error_message in pipeline.execute():
+        # It might have been removed in the meanwhile
+        if unique_identifier is None or error_message in (None, "null"):
+            continue
+        errors.append((unique_identifier, error_message))
+    return errors
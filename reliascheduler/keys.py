@@ -15,6 +15,10 @@ class ErrorKeys:
     def identifier(identifier) -> str:
         return f"{ErrorKeys.base_key()}:relia:scheduler:errors:{identifier}"
 
+    @staticmethod
+    def user_errors(author) -> str:
+        return f"{ErrorKeys.base_key()}:relia:scheduler:user-errors:{author}"
+
     @staticmethod
     def base_key():
         return current_app.config.get('BASE_KEY') or 'base'
@@ -42,6 +46,8 @@ class TaskKeys:
     inactiveSince = "inactiveSince"
     transmitterFiletype = "transmitterFiletype"
     receiverFiletype = "receiverFiletype"
+    transmitterFileDigest = "transmitterFileDigest"
+    receiverFileDigest = "receiverFileDigest"
 
     class Status:
         completed = 'completed'
@@ -65,6 +71,25 @@ class TaskKeys:
     def base_key():
         return current_app.config.get('BASE_KEY') or 'base'
 
+    @staticmethod
+    def queue() -> str:
+        return f"{TaskKeys.base_key()}:relia:scheduler:queue"
+
+    @staticmethod
+    def queue_sequence() -> str:
+        return f"{TaskKeys.base_key()}:relia:scheduler:queue:sequence"
+
+    @staticmethod
+    def queue_fair_share() -> str:
+        return f"{TaskKeys.base_key()}:relia:scheduler:queue:fair-share"
+
+    # A list with an element per task queued, for waking up the receivers waiting
+    @staticmethod
+    def queue_wakeups() -> str:
+        return f"{TaskKeys.base_key()}:relia:scheduler:queue:wakeups"
+
+    # The lists per priority (and the set of priorities) used before the single
+    # queue, only needed for migrating the tasks queued in them
     @staticmethod
     def priority_queue(priority: int) -> str:
         return f"{TaskKeys.base_key()}:relia:scheduler:tasks:queues:{priority}"
@@ -73,6 +98,47 @@ class TaskKeys:
     def priorities() -> str:
         return f"{TaskKeys.base_key()}:relia:scheduler:priorities"
 
+    @staticmethod
+    def gc_lock() -> str:
+        return f"{TaskKeys.base_key()}:relia:scheduler:gc:lock"
+
+    @staticmethod
+    def gc_stats() -> str:
+        return f"{TaskKeys.base_key()}:relia:scheduler:gc:stats"
+
+    @staticmethod
+    def polling_deadlines() -> str:
+        return f"{TaskKeys.base_key()}:relia:scheduler:deadlines:polling"
+
+    @staticmethod
+    def running_deadlines() -> str:
+        return f"{TaskKeys.base_key()}:relia:scheduler:deadlines:running"
+
+    @staticmethod
+    def reaper_lock() -> str:
+        return f"{TaskKeys.base_key()}:relia:scheduler:reaper:lock"
+
+    @staticmethod
+    def archive_lock() -> str:
+        return f"{TaskKeys.base_key()}:relia:scheduler:archive:lock"
+
+    @staticmethod
+    def lifecycle_events() -> str:
+        return f"{TaskKeys.base_key()}:relia:scheduler:lifecycle-events"
+
+class FileKeys:
+
+    content = "content"
+    references = "references"
+
+    @staticmethod
+    def file(digest) -> str:
+        return f"{FileKeys.base_key()}:relia:scheduler:files:{digest}"
+
+    @staticmethod
+    def base_key():
+        return current_app.config.get('BASE_KEY') or 'base'
+
 class DeviceKeys:
     def __init__(self, device_id):
         self.base_key = current_app.config.get('BASE_KEY') or 'base'
@@ -84,14 +150,30 @@ class DeviceKeys:
     def last_check(self):
         return f"{self.base_key}:relia:scheduler:devices:{self.device_id}:last_check"
 
+    @staticmethod
+    def last_checks():
+        return f"{DeviceKeys.base_key()}:relia:scheduler:devices-last-check"
+
+    @staticmethod
+    def run_durations():
+        return f"{DeviceKeys.base_key()}:relia:scheduler:devices-run-duration"
+
     @staticmethod
     def device_assignment(device_id):
         return f'{DeviceKeys.base_key()}:relia:scheduler:devices:{device_id}:assigned_task'
 
+    @staticmethod
+    def transmitter_handoff(device_id):
+        return f'{DeviceKeys.base_key()}:relia:scheduler:devices:{device_id}:transmitter_handoff'
+
     @staticmethod
     def credentials():
         return f"{DeviceKeys.base_key()}:relia:scheduler:device-credentials"
 
+    @staticmethod
+    def credentials_version():
+        return f"{DeviceKeys.base_key()}:relia:scheduler:device-credentials:version"
+
     @staticmethod
     def base_key():
         return current_app.config.get('BASE_KEY') or 'base'
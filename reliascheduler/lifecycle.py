@@ -0,0 +1,126 @@
+"""
+Stream of the lifecycle events of the tasks, for dashboards, archivers and notifiers.
+
+Every change of status of a task (queued, assigned to the receiver and to the
+transmitter, completed by each side, stopped, deleted) and every error message
+reported by a device is added to a Redis Stream (TaskKeys.lifecycle_events), in
+the same script or pipeline as the change itself. Each entry has:
+
+ - event: the new status (see TaskKeys.Status), or ERROR_MESSAGE_EVENT
+ - task: the task identifier
+ - priority: the priority of the task
+ - device: the device that took the task or reported the error (otherwise, the
+   device base assigned, if any)
+ - reason: only if the scheduler stopped the task, 'inactive' (the user stopped
+   polling) or 'timeout' (running for more than MAX_TIME_RUNNING)
+
+The entry identifier starts with the time of the event in milliseconds. The stream
+is capped to approximately LIFECYCLE_EVENTS_MAXLEN entries, so a consumer that falls
+further behind loses the oldest events.
+
+Consumers read the events incrementally with consumer groups (XREADGROUP) instead of
+scanning the tasks: the workers of a group share its events, acknowledging those they
+processed, while each group (e.g., a dashboard and an archiver) gets all of them:
+
+    create_consumer_group('archiver')
+    while True:
+        events = read_events('archiver', 'worker-1', block=5)
+        ...
+        ack_events('archiver', [ event.identifier for event in events ])
+
+The events delivered to a worker that crashed before acknowledging them are taken
+over by another one with claim_pending_events.
+"""
+from typing import Dict, List, Optional, Tuple
+
+from redis.exceptions import ResponseError
+
+from reliascheduler import redis_store
+from reliascheduler.schema import get_key_schema
+
+# Event added when a device reports an error message (the status does not change)
+ERROR_MESSAGE_EVENT = 'error-message'
+
+class LifecycleEvent:
+    __slots__ = ('identifier', 'event', 'task', 'priority', 'device', 'reason')
+
+    def __init__(self, identifier: str, fields: Dict[str, str]):
+        self.identifier = identifier
+        self.event = fields.get('event')
+        self.task = fields.get('task')
+        self.priority = int(fields['priority']) if fields.get('priority') is not None else None
+        self.device = fields.get('device')
+        self.reason = fields.get('reason')
+
+    @property
+    def timestamp(self) -> float:
+        """
+        Time of the event (epoch), from the entry identifier
+        """
+        return int(self.identifier.split('-')[0]) / 1000
+
+    def as_dict(self) -> Dict[str, object]:
+        return { name: getattr(self, name) for name in self.__slots__ }
+
+def _to_events(entries: List[Tuple[str, Dict[str, str]]]) -> List[LifecycleEvent]:
+    # Entries of events trimmed while pending are returned without fields
+    return [ LifecycleEvent(identifier, fields) for identifier, fields in entries if fields ]
+
+def create_consumer_group(group: str, start: str = '$') -> bool:
+    """
+    Create a consumer group reading the events after start ('$': only the new ones, '0':
+    all those in the stream). Return False if it already existed.
+    """
+    try:
+        redis_store.xgroup_create(get_key_schema().lifecycle_events, group, id=start, mkstream=True)
+    except ResponseError as err:
+        if 'BUSYGROUP' not in str(err):
+            raise
+        return False
+    return True
+
+def read_events(group: str, consumer: str, count: int = 100, block: Optional[float] = None) -> List[LifecycleEvent]:
+    """
+    Return up to count events not delivered yet to the group, waiting up to block seconds
+    if there are none (and block is not None). They stay pending for the consumer until
+    they are acknowledged with ack_events.
+    """
+    stream_key = get_key_schema().lifecycle_events
+    block_milliseconds = max(int(block * 1000), 1) if block is not None else None
+    response = redis_store.xreadgroup(group, consumer, { stream_key: '>' }, count=count, block=block_milliseconds)
+    if not response:
+        return []
+    return _to_events(response[0][1])
+
+def ack_events(group: str, identifiers: List[str]) -> int:
+    """
+    Acknowledge the events processed by the group. Return the number acknowledged.
+    """
+    if not identifiers:
+        return 0
+    return redis_store.xack(get_key_schema().lifecycle_events, group, *identifiers)
+
+def claim_pending_events(group: str, consumer: str, min_idle_time: float, count: int = 100) -> List[LifecycleEvent]:
+    """
+    Take over up to count events delivered to other consumers of the group more than
+    min_idle_time seconds ago and not acknowledged yet (e.g., the consumer crashed)
+    """
+    response = redis_store.xautoclaim(get_key_schema().lifecycle_events, group, consumer, int(min_idle_time * 1000), start_id='0-0', count=count)
+    return _to_events(response[1])
+
+def get_latest_events(count: int = 20) -> List[LifecycleEvent]:
+    """
+    Return the last count events, oldest first, without a consumer group
+    """
+    entries = redis_store.xrevrange(get_key_schema().lifecycle_events, count=count)
+    return _to_events(list(reversed(entries)))
+
+def get_consumer_groups() -> List[Dict[str, object]]:
+    """
+    Return the consumer groups of the stream, with their consumers and pending events
+    """
+    try:
+        return redis_store.xinfo_groups(get_key_schema().lifecycle_events)
+    except ResponseError:
+        # The stream does not exist yet
+        return []
@@ -0,0 +1,94 @@
+import os
+import time
+import signal
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+from flask import Flask, current_app
+
+logger = logging.getLogger(__name__)
+
+class DeviceMetadataRegistry:
+    """
+    Metadata of the devices (e.g., the camera URL), as defined in DEVICE_METADATA_FILENAME:
+
+        uw-s1i1:
+            camera: https://...
+
+    The file is loaded once per worker, and only reloaded if its modification time
+    changes (checked at most every DEVICE_METADATA_CHECK_INTERVAL seconds) or if the
+    process receives a SIGHUP.
+    """
+    def __init__(self, filename: str, check_interval: float):
+        self.filename = filename
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._devices: Dict[str, Dict[str, Any]] = {}
+        self._mtime: Optional[float] = None
+        self._checked_at: float = 0
+        self._reload_requested = True
+
+    def request_reload(self):
+        self._reload_requested = True
+
+    def _get_mtime(self) -> Optional[float]:
+        try:
+            return os.stat(self.filename).st_mtime
+        except OSError:
+            return None
+
+    def _refresh(self):
+        now = time.time()
+        if not self._reload_requested and now - self._checked_at < self.check_interval:
+            return
+
+        with self._lock:
+            mtime = self._get_mtime()
+            if self._reload_requested or mtime != self._mtime:
+                self._devices = self._load() if mtime is not None else {}
+                self._mtime = mtime
+            self._reload_requested = False
+            self._checked_at = now
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self.filename) as f:
+                devices_metadata = yaml.load(f, Loader=SafeLoader) or {}
+        except Exception:
+            logger.warning(f"Could not load the device metadata from {self.filename}", exc_info=True)
+            return self._devices
+
+        return {
+            str(device_base): (device_metadata if isinstance(device_metadata, dict) else {})
+            for device_base, device_metadata in devices_metadata.items()
+        }
+
+    def get(self, device_base: str) -> Dict[str, Any]:
+        self._refresh()
+        return self._devices.get(device_base, {})
+
+    def get_camera_url(self, device_base: str) -> Optional[str]:
+        return self.get(device_base).get('camera')
+
+def init_device_metadata(app: Flask):
+    registry = DeviceMetadataRegistry(app.config['DEVICE_METADATA_FILENAME'], app.config['DEVICE_METADATA_CHECK_INTERVAL'])
+    app.extensions['reliascheduler-device-metadata'] = registry
+
+    # Allow forcing a reload with SIGHUP, unless someone else (e.g., the server) is using it
+    if hasattr(signal, 'SIGHUP'):
+        try:
+            if signal.getsignal(signal.SIGHUP) in (signal.SIG_DFL, None):
+                signal.signal(signal.SIGHUP, lambda signum, frame: registry.request_reload())
+        except ValueError:
+            # Not running in the main thread
+            pass
+
+def get_device_metadata() -> DeviceMetadataRegistry:
+    return current_app.extensions['reliascheduler-device-metadata']
@@ -0,0 +1,312 @@
+"""
+Instrumentation of the hot paths: Redis round-trips and latency per request.
+
+redis_store is created with the InstrumentedRedis client class (and the asyncio client
+of reliascheduler.asgi with InstrumentedAsyncRedis), so every command (including the
+EVALSHA of the scripts, and the SCRIPT EXISTS and SCRIPT LOAD that redis-py sends
+before the pipelines with Script objects) and every pipeline executed while handling a request is
+counted and timed, and recorded per route (the URL rule, not the URL, so the
+task identifiers do not create new series). Each command, pipeline or subscription
+is a round-trip (a pipeline is one, see scripts.execute_pipeline):
+
+- reliascheduler_request_duration_seconds: time handling the request
+- reliascheduler_request_redis_seconds: time waiting for Redis (including the
+  blocking waits of the devices, BZPOPMIN and BRPOP)
+- reliascheduler_request_redis_commands: Redis commands per request
+- reliascheduler_request_redis_round_trips: Redis round-trips per request
+- reliascheduler_redis_commands_total / reliascheduler_redis_round_trips_total /
+  reliascheduler_redis_pipelines_total
+
+The task lifecycle is recorded by the scripts when the transitions happen:
+
+- reliascheduler_queue_wait_seconds: from the creation to the receiver assignment
+- reliascheduler_handoff_delay_seconds: from the receiver to the transmitter assignment
+- reliascheduler_run_time_seconds: from the receiver assignment to its completion
+
+They are kept in memory in each process (nothing else is sent to Redis), and
+exposed in the Prometheus text format in /scheduler/metrics, with the worker
+label (host and process identifier) in every series: with several workers each
+scrape returns the metrics of one of them, so aggregate them with sum without
+(worker). If METRICS_DEBUG_HEADER is set, every response includes the
+X-Relia-Redis header with the commands, round-trips, pipelines and Redis time
+of the request.
+"""
+import os
+import math
+import time
+import socket
+import threading
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+import redis
+import redis.asyncio
+from flask import Flask, current_app, g, request
+
+# Upper bounds of the histogram buckets (+Inf is added)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COMMAND_BUCKETS = (1, 2, 3, 4, 6, 8, 12, 16, 32, 64)
+LIFECYCLE_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 1800, 3600)
+
+class RequestStats:
+    """
+    Redis usage of the request being handled
+    """
+    def __init__(self):
+        self.commands = 0
+        self.round_trips = 0
+        self.pipelines = 0
+        self.redis_time = 0.0
+
+_request_stats: ContextVar[Optional[RequestStats]] = ContextVar('reliascheduler_request_stats', default=None)
+
+class Histogram:
+    def __init__(self, name: str, description: str, buckets: Tuple[float, ...], label: Optional[str] = None):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.label = label
+        # label value: (cumulative counts per bucket, [ sum, count ])
+        self.series: Dict[Optional[str], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, label_value: Optional[str] = None):
+        counts, totals = self.series.setdefault(label_value, ([ 0 ] * len(self.buckets), [ 0.0, 0 ]))
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[position] += 1
+        totals[0] += value
+        totals[1] += 1
+
+    def _labels(self, label_value: Optional[str], worker: str, **extra) -> str:
+        labels = [ f'worker="{_escape(worker)}"' ]
+        if self.label is not None:
+            labels.append(f'{self.label}="{_escape(label_value)}"')
+        labels.extend(f'{name}="{value}"' for name, value in extra.items())
+        return '{' + ','.join(labels) + '}'
+
+    def render(self, worker: str) -> List[str]:
+        lines = [ f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram' ]
+        for label_value, (counts, (total, count)) in sorted(self.series.items(), key=lambda item: item[0] or ''):
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{self._labels(label_value, worker, le=_format(bound))} {bucket_count}')
+            lines.append(f'{self.name}_bucket{self._labels(label_value, worker, le="+Inf")} {count}')
+            lines.append(f'{self.name}_sum{self._labels(label_value, worker)} {_format(total)}')
+            lines.append(f'{self.name}_count{self._labels(label_value, worker)} {count}')
+        return lines
+
+class Counter:
+    def __init__(self, name: str, description: str, label: str):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.series: Dict[str, float] = {}
+
+    def increase(self, label_value: str, amount: float = 1):
+        self.series[label_value] = self.series.get(label_value, 0) + amount
+
+    def render(self, worker: str) -> List[str]:
+        lines = [ f'# HELP {self.name} {self.description}', f'# TYPE {self.name} counter' ]
+        for label_value, value in sorted(self.series.items()):
+            lines.append(f'{self.name}{{worker="{_escape(worker)}",{self.label}="{_escape(label_value)}"}} {_format(value)}')
+        return lines
+
+def _escape(value: Optional[str]) -> str:
+    return (value or '').replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format(value: float) -> str:
+    if isinstance(value, int) or (math.isfinite(value) and value == int(value)):
+        return str(int(value))
+    return repr(value)
+
+class Metrics:
+    """
+    Metrics of this process (see the module documentation)
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.request_duration = Histogram('reliascheduler_request_duration_seconds', "Time handling the request", LATENCY_BUCKETS, 'route')
+        self.request_redis_time = Histogram('reliascheduler_request_redis_seconds', "Time waiting for Redis while handling the request", LATENCY_BUCKETS, 'route')
+        self.request_redis_commands = Histogram('reliascheduler_request_redis_commands', "Redis commands sent while handling the request", COMMAND_BUCKETS, 'route')
+        self.request_redis_round_trips = Histogram('reliascheduler_request_redis_round_trips', "Redis round-trips while handling the request", COMMAND_BUCKETS, 'route')
+        self.redis_commands = Counter('reliascheduler_redis_commands_total', "Redis commands sent", 'route')
+        self.redis_round_trips = Counter('reliascheduler_redis_round_trips_total', "Redis round-trips", 'route')
+        self.redis_pipelines = Counter('reliascheduler_redis_pipelines_total', "Redis pipelines executed", 'route')
+        self.lifecycle = {
+            'queue_wait': Histogram('reliascheduler_queue_wait_seconds', "Time from the creation of the task to the receiver assignment", LIFECYCLE_BUCKETS),
+            'handoff_delay': Histogram('reliascheduler_handoff_delay_seconds', "Time from the receiver assignment to the transmitter assignment", LIFECYCLE_BUCKETS),
+            'run_time': Histogram('reliascheduler_run_time_seconds', "Time from the receiver assignment to its completion", LIFECYCLE_BUCKETS),
+        }
+
+    def observe_request(self, route: str, duration: float, stats: RequestStats):
+        with self._lock:
+            self.request_duration.observe(duration, route)
+            self.request_redis_time.observe(stats.redis_time, route)
+            self.request_redis_commands.observe(stats.commands, route)
+            self.request_redis_round_trips.observe(stats.round_trips, route)
+            self.redis_commands.increase(route, stats.commands)
+            self.redis_round_trips.increase(route, stats.round_trips)
+            self.redis_pipelines.increase(route, stats.pipelines)
+
+    def observe_lifecycle(self, name: str, seconds: float):
+        with self._lock:
+            self.lifecycle[name].observe(max(seconds, 0.0))
+
+    def render(self) -> str:
+        # Taken when rendering: the workers may be forked after the app is created
+        worker = f'{socket.gethostname()}:{os.getpid()}'
+        with self._lock:
+            lines = []
+            for metric in [ self.request_duration, self.request_redis_time, self.request_redis_commands, self.request_redis_round_trips,
+                            self.redis_commands, self.redis_round_trips, self.redis_pipelines ] + list(self.lifecycle.values()):
+                lines.extend(metric.render(worker))
+        return '\n'.join(lines) + '\n'
+
+def get_metrics() -> Optional[Metrics]:
+    """
+    Return the metrics of the current app (None if METRICS_ENABLED is not set)
+    """
+    return current_app.extensions.get('reliascheduler-metrics')
+
+def observe_lifecycle(name: str, seconds: Optional[float]):
+    """
+    Record the duration of a step of the task lifecycle ('queue_wait', 'handoff_delay' or 'run_time')
+    """
+    metrics = get_metrics()
+    if metrics is not None and seconds is not None:
+        metrics.observe_lifecycle(name, seconds)
+
+class RedisInstrumentation:
+    """
+    Mixin of the Redis client classes (redis.Redis or fakeredis.FakeStrictRedis) that counts
+    and times the commands and the pipelines sent while a request is handled. Each command,
+    pipeline (MULTI and EXEC included) or subscription of the streamed events is written to
+    the server at once, so it is a round-trip.
+    """
+    def execute_command(self, *args, **options):
+        stats = _request_stats.get()
+        if stats is None:
+            return super().execute_command(*args, **options)
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            stats.redis_time += time.perf_counter() - start
+            stats.commands += 1
+            stats.round_trips += 1
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+    def pubsub(self, **kwargs):
+        return InstrumentedPubSub(self.connection_pool, **kwargs)
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    def execute(self, raise_on_error=True):
+        stats = _request_stats.get()
+        if stats is None or not self.command_stack:
+            return super().execute(raise_on_error)
+        commands = len(self.command_stack)
+        start = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            stats.redis_time += time.perf_counter() - start
+            stats.commands += commands
+            stats.pipelines += 1
+            stats.round_trips += 1
+
+    def immediate_execute_command(self, *args, **options):
+        # Sent outside of the command stack: SCRIPT EXISTS and SCRIPT LOAD before
+        # the scripts of the pipeline (timed with the pipeline), and WATCH
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.commands += 1
+            stats.round_trips += 1
+        return super().immediate_execute_command(*args, **options)
+
+class InstrumentedPubSub(redis.client.PubSub):
+    def execute_command(self, *args):
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.round_trips += 1
+        return super().execute_command(*args)
+
+class InstrumentedRedis(RedisInstrumentation, redis.StrictRedis):
+    """
+    Client of redis_store (see reliascheduler/__init__.py)
+    """
+
+class AsyncRedisInstrumentation:
+    """
+    Same as RedisInstrumentation, for the asyncio Redis client classes (see reliascheduler.asgi),
+    so the blocking waits of the devices are counted too
+    """
+    async def execute_command(self, *args, **options):
+        stats = _request_stats.get()
+        if stats is None:
+            return await super().execute_command(*args, **options)
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            stats.redis_time += time.perf_counter() - start
+            stats.commands += 1
+            stats.round_trips += 1
+
+    def pubsub(self, **kwargs):
+        return InstrumentedAsyncPubSub(self.connection_pool, **kwargs)
+
+class InstrumentedAsyncPubSub(redis.asyncio.client.PubSub):
+    async def execute_command(self, *args):
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.round_trips += 1
+        return await super().execute_command(*args)
+
+class InstrumentedAsyncRedis(AsyncRedisInstrumentation, redis.asyncio.Redis):
+    """
+    Client of the device waits and the task events streams (see reliascheduler.asgi)
+    """
+
+def instrumented(client_class: type) -> type:
+    """
+    Return a subclass of the (sync or asyncio) Redis client class with the instrumentation,
+    e.g., to use fakeredis instead of InstrumentedRedis and InstrumentedAsyncRedis
+    """
+    mixin = AsyncRedisInstrumentation if issubclass(client_class, redis.asyncio.Redis) else RedisInstrumentation
+    return type(client_class.__name__, (mixin, client_class), {})
+
+def init_metrics(app: Flask):
+    """
+    Record the Redis usage and the duration of the requests of the app if METRICS_ENABLED is set
+    """
+    if not app.config['METRICS_ENABLED']:
+        return
+
+    metrics = Metrics()
+    app.extensions['reliascheduler-metrics'] = metrics
+    debug_header = app.config['METRICS_DEBUG_HEADER']
+
+    @app.before_request
+    def start_request_stats():
+        g.reliascheduler_request_start = time.perf_counter()
+        g.reliascheduler_request_stats = RequestStats()
+        _request_stats.set(g.reliascheduler_request_stats)
+
+    @app.after_request
+    def record_request_stats(response):
+        stats = g.get('reliascheduler_request_stats')
+        if stats is None:
+            return response
+
+        route = request.url_rule.rule if request.url_rule is not None else 'unknown'
+        if route != '/scheduler/metrics':
+            metrics.observe_request(route, time.perf_counter() - g.reliascheduler_request_start, stats)
+        if debug_header:
+            response.headers['X-Relia-Redis'] = f'commands={stats.commands}; round-trips={stats.round_trips}; pipelines={stats.pipelines}; time={stats.redis_time * 1000:.2f}ms'
+        return response
+
+    @app.teardown_request
+    def stop_request_stats(exception=None):
+        # Not reset with a token: streamed responses are closed in another context in the ASGI app
+        _request_stats.set(None)
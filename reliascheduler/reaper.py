@@ -0,0 +1,92 @@
+"""
+Reaper for the tasks whose user stopped polling and the tasks that overrun.
+
+Otherwise, inactivity (MAX_TIME_WITHOUT_POLLING) and overruns (MAX_TIME_RUNNING)
+are only detected when the device itself polls the status of the task or asks
+for a new one, so a crashed device or an abandoned session holds the device
+until then. The assignment of a receiver indexes the task in two sorted sets
+(by the last poll of the user and by the time the receiver started), and every
+REAPER_INTERVAL seconds a single worker (the one holding a lock in Redis)
+stops the expired tasks and frees their devices with the 'reap' script, which
+only reads the range of expired entries.
+"""
+import time
+import logging
+import threading
+from typing import List, Tuple
+
+from flask import Flask
+from redis.exceptions import LockError
+
+from reliascheduler import redis_store, scripts
+from reliascheduler.errors import store_error
+from reliascheduler.schema import get_key_schema
+
+logger = logging.getLogger(__name__)
+
+# Maximum tasks of each kind processed in a single script call
+REAP_BATCH_SIZE = 100
+
+def reap() -> Tuple[List[str], List[str]]:
+    """
+    Stop all the tasks whose user is not polling anymore and complete the tasks running for
+    too long (storing an error for them), releasing their devices.
+
+    Return the identifiers of the stopped tasks and of the timed out tasks.
+    """
+    all_stopped = []
+    all_timed_out = []
+    while True:
+        stopped, timed_out = scripts.reap(REAP_BATCH_SIZE)
+        all_stopped.extend(stopped)
+
+        if timed_out:
+            pipeline = redis_store.pipeline()
+            for task_identifier, author in timed_out:
+                store_error(task_identifier, author, "Receiver side: task timed out", pipeline=pipeline)
+                all_timed_out.append(task_identifier)
+            pipeline.execute()
+
+        if len(stopped) < REAP_BATCH_SIZE and len(timed_out) < REAP_BATCH_SIZE:
+            return all_stopped, all_timed_out
+
+def _run_as_leader(app: Flask, interval: float):
+    with app.app_context():
+        # If the leader dies, another worker takes over once the lock expires
+        lock = redis_store.lock(get_key_schema().reaper_lock, timeout=max(3 * interval, 1), blocking_timeout=0)
+
+    leader = False
+    while True:
+        try:
+            with app.app_context():
+                if leader:
+                    lock.reacquire()
+                else:
+                    leader = lock.acquire(blocking=False)
+                    if leader:
+                        logger.info("This worker is now reaping the inactive tasks")
+
+                if leader:
+                    stopped, timed_out = reap()
+                    for task_identifier in stopped:
+                        logger.warning(f"Task {task_identifier} stopped: the user is not polling anymore")
+                    for task_identifier in timed_out:
+                        logger.warning(f"Task {task_identifier} timed out")
+        except LockError:
+            logger.warning("This worker is not reaping the inactive tasks anymore")
+            leader = False
+        except Exception:
+            logger.warning("Error reaping the inactive tasks", exc_info=True)
+
+        time.sleep(interval)
+
+def start_reaper(app: Flask):
+    """
+    Start the background reaper if REAPER_INTERVAL is set
+    """
+    interval = app.config['REAPER_INTERVAL']
+    if not interval:
+        return
+
+    thread = threading.Thread(target=_run_as_leader, args=(app, interval), name='relia-scheduler-reaper', daemon=True)
+    thread.start()
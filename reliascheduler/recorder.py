@@ -0,0 +1,159 @@
+"""
+Opt-in recorder of the requests to the scheduler, to replay the load later (see utils/replay.py).
+
+If REQUEST_TRACE_FILENAME is set, every request to the scheduler blueprint is
+recorded as a line of compact JSON: when it started and how long it took, the
+route and its arguments, the device or the author, the size and a hash of the
+body (never the files themselves), the few body fields needed to replay it
+(priority, session_id, user_id, action, taskIdentifiers), and the outcome (the
+status code, the status or message returned and the task identifier assigned or
+created).
+
+The records are added to an in-memory queue and written by a background thread
+every REQUEST_TRACE_FLUSH_INTERVAL seconds, in a single append per batch, so the
+requests never wait for the disk. If the filename ends with .gz, each batch is
+appended as a gzip member (gzip.open reads them as a single file). The filename
+can include {pid}, to have a file per worker.
+"""
+import os
+import gzip
+import json
+import time
+import queue
+import atexit
+import hashlib
+import logging
+import threading
+from typing import Iterator, Optional
+
+from flask import Flask, g, request
+
+logger = logging.getLogger(__name__)
+
+# Fields of the JSON body of the requests recorded (the rest is only hashed)
+RECORDED_BODY_FIELDS = ('priority', 'session_id', 'user_id', 'action', 'taskIdentifiers')
+
+class RequestRecorder:
+    def __init__(self, filename: str, flush_interval: float):
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self._records: queue.SimpleQueue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._writer_pid: Optional[int] = None
+
+    def record(self, record: dict):
+        self._ensure_writer()
+        self._records.put(json.dumps(record, separators=(',', ':')))
+
+    def _ensure_writer(self):
+        # Started in the worker process itself (the app might be created before forking)
+        if self._writer_pid == os.getpid():
+            return
+        with self._lock:
+            if self._writer_pid != os.getpid():
+                self._records = queue.SimpleQueue()
+                filename = self.filename.format(pid=os.getpid())
+                directory = os.path.dirname(filename)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+
+                thread = threading.Thread(target=self._write_forever, args=(filename,), name='relia-scheduler-recorder', daemon=True)
+                thread.start()
+                # The records of the last interval
+                atexit.register(self.flush, filename)
+                self._writer_pid = os.getpid()
+
+    def _write_forever(self, filename: str):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush(filename)
+            except Exception:
+                logger.warning("Error writing the request trace", exc_info=True)
+
+    def flush(self, filename: str):
+        lines = []
+        while True:
+            try:
+                lines.append(self._records.get_nowait())
+            except queue.Empty:
+                break
+        if not lines:
+            return
+
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+        if filename.endswith('.gz'):
+            data = gzip.compress(data)
+        with open(filename, 'ab') as trace_file:
+            trace_file.write(data)
+
+def read_trace(filename: str) -> Iterator[dict]:
+    """
+    Read the records of a trace file written by the recorder
+    """
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rt', encoding='utf-8') as trace_file:
+        for line in trace_file:
+            if line.strip():
+                yield json.loads(line)
+
+def _request_record(response) -> dict:
+    body = request.get_data(cache=True)
+    record = {
+        't': round(g.reliascheduler_trace_start, 6),
+        'd': round(time.perf_counter() - g.reliascheduler_trace_timer, 6),
+        'm': request.method,
+        'r': request.url_rule.rule,
+        's': response.status_code,
+        'n': len(body),
+    }
+    if request.view_args:
+        record['a'] = request.view_args
+    if request.query_string:
+        record['q'] = request.query_string.decode('latin-1')
+    device = request.headers.get('relia-device')
+    if device:
+        record['dev'] = device
+    if body:
+        record['h'] = hashlib.sha256(body).hexdigest()[:16]
+        request_data = request.get_json(silent=True, force=True)
+        if isinstance(request_data, dict):
+            fields = { name: request_data[name] for name in RECORDED_BODY_FIELDS if name in request_data }
+            if fields:
+                record['b'] = fields
+
+    if response.is_json and not response.is_streamed:
+        response_data = response.get_json(silent=True)
+        if isinstance(response_data, dict):
+            outcome = response_data.get('status') or response_data.get('message')
+            if isinstance(outcome, str):
+                record['o'] = outcome
+            if response_data.get('taskIdentifier'):
+                record['tid'] = response_data['taskIdentifier']
+    return record
+
+def init_request_recorder(app: Flask):
+    """
+    Record the requests to the scheduler if REQUEST_TRACE_FILENAME is set
+    """
+    filename = app.config['REQUEST_TRACE_FILENAME']
+    if not filename:
+        return
+
+    recorder = RequestRecorder(filename, app.config['REQUEST_TRACE_FLUSH_INTERVAL'])
+    app.extensions['reliascheduler-recorder'] = recorder
+
+    @app.before_request
+    def start_request_trace():
+        g.reliascheduler_trace_start = time.time()
+        g.reliascheduler_trace_timer = time.perf_counter()
+
+    @app.after_request
+    def record_request_trace(response):
+        if request.blueprint != 'scheduler' or request.endpoint == 'scheduler.scheduler_metrics' or 'reliascheduler_trace_start' not in g:
+            return response
+        try:
+            recorder.record(_request_record(response))
+        except Exception:
+            logger.warning("Error recording the request", exc_info=True)
+        return response
@@ -0,0 +1,137 @@
+"""
+Layout of the scheduler data in Redis, shared by the stores (reliascheduler.store)
+and the Lua scripts (reliascheduler.scripts): the key names, the scores of the queue
+and the encoding of the GRC files.
+"""
+import zlib
+import base64
+from typing import Callable, Tuple
+
+from flask import Flask, current_app
+
+from reliascheduler.keys import ErrorKeys, TaskKeys, FileKeys, DeviceKeys
+
+def _split_key(key_function: Callable[[str], str]) -> Tuple[str, str]:
+    """
+    Return the prefix and the suffix of the key generated by key_function around its argument
+    """
+    marker = '\0'
+    prefix, suffix = key_function(marker).split(marker)
+    return prefix, suffix
+
+# Suffix of the pub/sub channel of a task, added to the task key
+TASK_EVENTS_SUFFIX = ':events'
+
+class KeySchema:
+    """
+    All the key names of the app, precomputed from the functions in reliascheduler.keys
+    """
+    def __init__(self):
+        self.tasks = TaskKeys.tasks()
+        self.queue = TaskKeys.queue()
+        self.queue_sequence = TaskKeys.queue_sequence()
+        self.queue_fair_share = TaskKeys.queue_fair_share()
+        self.queue_wakeups = TaskKeys.queue_wakeups()
+        self.priorities = TaskKeys.priorities()
+        self.gc_lock = TaskKeys.gc_lock()
+        self.gc_stats = TaskKeys.gc_stats()
+        self.polling_deadlines = TaskKeys.polling_deadlines()
+        self.running_deadlines = TaskKeys.running_deadlines()
+        self.reaper_lock = TaskKeys.reaper_lock()
+        self.archive_lock = TaskKeys.archive_lock()
+        self.lifecycle_events = TaskKeys.lifecycle_events()
+        self.errors = ErrorKeys.errors()
+        self.credentials = DeviceKeys.credentials()
+        self.credentials_version = DeviceKeys.credentials_version()
+        self.last_checks = DeviceKeys.last_checks()
+        self.run_durations = DeviceKeys.run_durations()
+
+        self._task_prefix, self._task_suffix = _split_key(TaskKeys.identifier)
+        self._priority_queue_prefix, self._priority_queue_suffix = _split_key(TaskKeys.priority_queue)
+        self._file_prefix, self._file_suffix = _split_key(FileKeys.file)
+        self._error_prefix, self._error_suffix = _split_key(ErrorKeys.identifier)
+        self._user_errors_prefix, self._user_errors_suffix = _split_key(ErrorKeys.user_errors)
+        self._device_assignment_prefix, self._device_assignment_suffix = _split_key(DeviceKeys.device_assignment)
+        self._transmitter_handoff_prefix, self._transmitter_handoff_suffix = _split_key(DeviceKeys.transmitter_handoff)
+
+    def task(self, identifier: str) -> str:
+        return self._task_prefix + identifier + self._task_suffix
+
+    def task_events(self, identifier: str) -> str:
+        """
+        Pub/sub channel where the changes of status of the task are published
+        """
+        return self._task_prefix + identifier + self._task_suffix + TASK_EVENTS_SUFFIX
+
+    def task_affixes(self) -> Tuple[str, str]:
+        """
+        Return the prefix and the suffix of the task keys, for building them in Lua scripts
+        """
+        return self._task_prefix, self._task_suffix
+
+    def file(self, digest: str) -> str:
+        return self._file_prefix + digest + self._file_suffix
+
+    def file_affixes(self) -> Tuple[str, str]:
+        """
+        Return the prefix and the suffix of the file keys, for building them in Lua scripts
+        """
+        return self._file_prefix, self._file_suffix
+
+    def priority_queue(self, priority) -> str:
+        """
+        Key of the list of a priority used before the single queue
+        """
+        return self._priority_queue_prefix + str(priority) + self._priority_queue_suffix
+
+    def error(self, identifier: str) -> str:
+        return self._error_prefix + identifier + self._error_suffix
+
+    def user_errors(self, author: str) -> str:
+        return self._user_errors_prefix + author + self._user_errors_suffix
+
+    def device_assignment(self, device_base: str) -> str:
+        return self._device_assignment_prefix + device_base + self._device_assignment_suffix
+
+    def device_assignment_affixes(self) -> Tuple[str, str]:
+        """
+        Return the prefix and the suffix of the device assignment keys, for building them in Lua scripts
+        """
+        return self._device_assignment_prefix, self._device_assignment_suffix
+
+    def transmitter_handoff(self, device_base: str) -> str:
+        return self._transmitter_handoff_prefix + device_base + self._transmitter_handoff_suffix
+
+# The score of a queued task is priority * 2^QUEUE_SEQUENCE_BITS + the sequence number
+# of its arrival, so the tasks are sorted by priority and then in FIFO order. Scores are
+# doubles, so this is exact while the result is below 2^53 (priorities up to 8191).
+QUEUE_SEQUENCE_BITS = 40
+
+# With a fair share policy, the sequence number is replaced by round * 2^QUEUE_ROUND_BITS
+# + the sequence number of arrival (modulo 2^QUEUE_ROUND_BITS, only used to sort the
+# tasks of the same round), where the round of a task is one more than the round of the
+# previous task of its owner, and at least one more than the round being served.
+QUEUE_ROUND_BITS = 16
+
+def queue_score(priority: int, sequence: int) -> int:
+    return (priority << QUEUE_SEQUENCE_BITS) + sequence
+
+# Weight of the last run in the moving average of the run durations of each device
+RUN_DURATION_SMOOTHING = 0.2
+
+def encode_file(content: str) -> str:
+    """
+    Compress the content of a GRC file with zlib and encode it in base64 (the Redis client
+    decodes every response as text)
+    """
+    return base64.b64encode(zlib.compress(content.encode())).decode()
+
+def decode_file(encoded_content: str) -> str:
+    return zlib.decompress(base64.b64decode(encoded_content)).decode()
+
+def init_key_schema(app: Flask):
+    with app.app_context():
+        app.extensions['reliascheduler-keys'] = KeySchema()
+
+def get_key_schema() -> KeySchema:
+    return current_app.extensions['reliascheduler-keys']
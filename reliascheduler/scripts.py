@@ -0,0 +1,745 @@
+"""
+Server-side Lua scripts for the task state transitions.
+
+Each transition (assigning a task to a receiver or a transmitter, completing it,
+stopping it if the user is not polling anymore) is run in Redis as a single
+atomic script call (EVALSHA), so it is a single round-trip and two workers can
+not assign the same task or read and write the status in between.
+
+The field names and the status values are taken from TaskKeys and FileKeys, so the
+scripts are written with string.Template placeholders ($status, $Status_completed,
+$File_content...).
+
+Every change of status is also added, in the same script, to the stream of lifecycle
+events (see reliascheduler/lifecycle.py). The scripts that change the status receive
+the stream as their last key and its maximum length as their last argument.
+"""
+import time
+import string
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from flask import current_app
+from redis.exceptions import NoScriptError
+
+from reliascheduler import redis_store
+from reliascheduler.keys import TaskKeys, FileKeys
+from reliascheduler.metrics import observe_lifecycle
+from reliascheduler.schema import TASK_EVENTS_SUFFIX, QUEUE_SEQUENCE_BITS, QUEUE_ROUND_BITS, RUN_DURATION_SMOOTHING, decode_file, get_key_schema
+
+# Functions shared by all the scripts
+_PRELUDE = """
+-- Set with use_lifecycle_events by the scripts that change the status
+local lifecycle_events_key = false
+local lifecycle_events_maxlen = 0
+
+local function use_lifecycle_events(key, maxlen)
+    lifecycle_events_key = key
+    lifecycle_events_maxlen = tonumber(maxlen) or 0
+end
+
+-- Add an event of the task to the capped lifecycle events stream (unless its maximum
+-- length is 0), with the priority and the device (by default, the device assigned).
+-- The entry identifier is the time of the event.
+local function add_lifecycle_event(task_key, event, device, reason)
+    if lifecycle_events_maxlen <= 0 then
+        return
+    end
+    local fields = redis.call('HMGET', task_key, '$uniqueIdentifier', '$priority', '$deviceAssigned')
+    if not fields[1] then
+        return
+    end
+    local entry = { 'event', event, 'task', fields[1] }
+    if fields[2] then
+        table.insert(entry, 'priority')
+        table.insert(entry, fields[2])
+    end
+    if not device or device == '' then
+        device = fields[3]
+    end
+    if device and device ~= 'null' then
+        table.insert(entry, 'device')
+        table.insert(entry, device)
+    end
+    if reason and reason ~= '' then
+        table.insert(entry, 'reason')
+        table.insert(entry, reason)
+    end
+    redis.call('XADD', lifecycle_events_key, 'MAXLEN', '~', lifecycle_events_maxlen, '*', unpack(entry))
+end
+
+-- Every change of status is published in the events channel of the task (see
+-- KeySchema.task_events), for the clients following the task, and added to the
+-- lifecycle events
+local function publish_status(task_key, status, device, reason)
+    redis.call('PUBLISH', task_key .. '$task_events_suffix', status)
+    add_lifecycle_event(task_key, status, device, reason)
+end
+
+local function set_status(task_key, status, device, reason)
+    redis.call('HSET', task_key, '$status', status)
+    publish_status(task_key, status, device, reason)
+end
+
+local function complete_receiver(task_key, assignment_key, reason)
+    local status = redis.call('HGET', task_key, '$status')
+    local new_status = '$Status_error'
+    if status == '$Status_receiver_assigned' or status == '$Status_receiver_still_processing' then
+        new_status = '$Status_completed'
+    elseif status == '$Status_fully_assigned' then
+        new_status = '$Status_transmitter_still_processing'
+    end
+    if new_status ~= '$Status_error' then
+        set_status(task_key, new_status, nil, reason)
+    end
+    redis.call('SET', assignment_key, 'null')
+    return new_status
+end
+
+local function complete_transmitter(task_key, reason)
+    local status = redis.call('HGET', task_key, '$status')
+    if status == '$Status_fully_assigned' then
+        set_status(task_key, '$Status_receiver_still_processing', nil, reason)
+        return '$Status_receiver_still_processing'
+    elseif status == '$Status_transmitter_still_processing' then
+        set_status(task_key, '$Status_completed', nil, reason)
+        return '$Status_completed'
+    end
+    return '$Status_error'
+end
+
+-- If the user has not polled in a while, complete the task on both sides
+-- so the device can be used by someone else. Returns true if stopped.
+local function stop_if_inactive(task_key, assignment_key, now, max_time_without_polling)
+    local inactive_since = redis.call('HGET', task_key, '$inactiveSince')
+    if not inactive_since then
+        return false
+    end
+    if now - tonumber(inactive_since) > max_time_without_polling then
+        complete_receiver(task_key, assignment_key, 'inactive')
+        complete_transmitter(task_key, 'inactive')
+        return true
+    end
+    return false
+end
+
+-- The data uploader uses this set to know which devices belong to a session.
+-- The key depends on the task contents, so it can not be passed in KEYS.
+local function add_to_session(task_key, device)
+    local session_id = redis.call('HGET', task_key, '$sessionId') or 'None'
+    redis.call('SADD', 'relia:data-uploader:sessions:' .. session_id .. ':devices', device)
+end
+
+-- Return the stored (compressed) content of a file, given its digest. The
+-- key depends on the task contents, so it can not be passed in KEYS.
+local function get_file(digest, file_key_prefix, file_key_suffix)
+    if not digest then
+        return false
+    end
+    return redis.call('HGET', file_key_prefix .. digest .. file_key_suffix, '$File_content')
+end
+"""
+
+# KEYS: device assignment, transmitter handoff, polling deadlines, running deadlines, queue,
+#       lifecycle events, queue wake-ups
+# ARGV: task identifier (empty to pop from the queues), device, device base,
+#       now (epoch), now (iso), max time without polling, max time running,
+#       task key prefix, task key suffix, file key prefix, file key suffix,
+#       maximum length of the lifecycle events
+#
+# Only the tasks still queued are assigned. Returns nil if there is no valid task,
+# or the task identifier, the filename, the file content (only in old tasks), the
+# session identifier, the file type, the compressed file content and the creation
+# time of the task (iso).
+_ASSIGN_RECEIVER = """
+local assignment_key = KEYS[1]
+local handoff_key = KEYS[2]
+local device = ARGV[2]
+local now = tonumber(ARGV[4])
+local max_time_without_polling = tonumber(ARGV[6])
+local task_key_prefix = ARGV[8]
+local task_key_suffix = ARGV[9]
+use_lifecycle_events(KEYS[6], ARGV[12])
+
+local function assign(task_identifier)
+    local task_key = task_key_prefix .. task_identifier .. task_key_suffix
+    -- Also skips the tasks deleted or completed after they were popped
+    if redis.call('HGET', task_key, '$status') ~= '$Status_queued' then
+        return nil
+    end
+    if stop_if_inactive(task_key, assignment_key, now, max_time_without_polling) then
+        return nil
+    end
+    redis.call('HSET', task_key,
+        '$receiverAssigned', device,
+        '$deviceAssigned', ARGV[3],
+        '$status', '$Status_receiver_assigned',
+        '$receiverProcessingStart', ARGV[5])
+    publish_status(task_key, '$Status_receiver_assigned', device)
+    redis.call('SET', assignment_key, task_identifier)
+    -- Wake up the transmitter of this device, which is blocked waiting for the handoff
+    redis.call('DEL', handoff_key)
+    redis.call('LPUSH', handoff_key, task_identifier)
+    redis.call('EXPIRE', handoff_key, math.max(math.floor(tonumber(ARGV[7])), 1))
+    -- Index the deadlines of the task, so the reaper can stop it even if nobody polls
+    redis.call('ZADD', KEYS[3], redis.call('HGET', task_key, '$inactiveSince') or now, task_key)
+    redis.call('ZADD', KEYS[4], now, task_key)
+    add_to_session(task_key, device)
+    local fields = redis.call('HMGET', task_key, '$receiverFilename', '$receiverFile', '$sessionId', '$receiverFiletype', '$receiverFileDigest', '$startedTime')
+    return { task_identifier, fields[1], fields[2], fields[3], fields[4], get_file(fields[5], ARGV[10], ARGV[11]), fields[6] }
+end
+
+if ARGV[1] ~= '' then
+    return assign(ARGV[1])
+end
+
+local popped = redis.call('ZPOPMIN', KEYS[5])
+while popped[1] do
+    local result = assign(popped[1])
+    if result then
+        return result
+    end
+    popped = redis.call('ZPOPMIN', KEYS[5])
+end
+-- The queue is empty, so the receivers that wake up would not find anything
+redis.call('DEL', KEYS[7])
+return nil
+"""
+
+# KEYS: device assignment, lifecycle events
+# ARGV: task identifier (empty to use the device assignment), device,
+#       now (epoch), now (iso), max time without polling, task key prefix, task key suffix,
+#       file key prefix, file key suffix, maximum length of the lifecycle events
+#
+# Returns nil if the task is not waiting for the transmitter, or the task identifier,
+# the filename, the file content (only in old tasks), the session identifier, the
+# file type, the compressed file content and the receiver assignment time (iso).
+_ASSIGN_TRANSMITTER = """
+local assignment_key = KEYS[1]
+local device = ARGV[2]
+use_lifecycle_events(KEYS[2], ARGV[10])
+local current_assignment = redis.call('GET', assignment_key)
+local task_identifier = ARGV[1]
+if task_identifier == '' then
+    task_identifier = current_assignment
+end
+-- Handoffs might be outdated (e.g., the transmitter already took the task)
+if not task_identifier or task_identifier ~= current_assignment then
+    return nil
+end
+local task_key = ARGV[6] .. task_identifier .. ARGV[7]
+if redis.call('HGET', task_key, '$status') ~= '$Status_receiver_assigned' then
+    return nil
+end
+if stop_if_inactive(task_key, assignment_key, tonumber(ARGV[3]), tonumber(ARGV[5])) then
+    return nil
+end
+redis.call('HSET', task_key,
+    '$transmitterAssigned', device,
+    '$status', '$Status_fully_assigned',
+    '$transmitterProcessingStart', ARGV[4])
+publish_status(task_key, '$Status_fully_assigned', device)
+add_to_session(task_key, device)
+local fields = redis.call('HMGET', task_key, '$transmitterFilename', '$transmitterFile', '$sessionId', '$transmitterFiletype', '$transmitterFileDigest', '$receiverProcessingStart')
+return { task_identifier, fields[1], fields[2], fields[3], fields[4], get_file(fields[5], ARGV[8], ARGV[9]), fields[6] }
+"""
+
+# KEYS: queue, queue sequence, queue wake-ups
+# ARGV: task identifier, priority, 2^QUEUE_SEQUENCE_BITS
+#
+# Adds the task to the queue after the tasks with the same priority, and wakes up
+# a receiver waiting for it
+_ENQUEUE_TASK = """
+local sequence = redis.call('INCR', KEYS[2])
+-- Formatted explicitly, since Lua converts numbers to strings with only 14 digits
+local score = string.format('%.0f', tonumber(ARGV[2]) * tonumber(ARGV[3]) + sequence)
+redis.call('ZADD', KEYS[1], score, ARGV[1])
+redis.call('LPUSH', KEYS[3], sequence)
+return sequence
+"""
+
+# KEYS: queue, queue sequence, fair share rounds, queue wake-ups
+# ARGV: task identifier, priority, 2^QUEUE_SEQUENCE_BITS, 2^QUEUE_ROUND_BITS, owner
+#
+# Adds the task to the queue in the next round of its owner within its priority (see
+# QUEUE_ROUND_BITS). The fair share rounds hash keeps the next round of each owner
+# ('<priority>:<owner>') and the last round assigned in each priority ('<priority>').
+# The round being served is the one of the first task of the priority in the queue,
+# so an owner who was idle does not get the rounds they did not use.
+_ENQUEUE_TASK_FAIR_SHARE = """
+local sequence = redis.call('INCR', KEYS[2])
+local priority = ARGV[2]
+local base = tonumber(priority) * tonumber(ARGV[3])
+local round_size = tonumber(ARGV[4])
+local owner_field = priority .. ':' .. ARGV[5]
+
+local current_round
+local first = redis.call('ZRANGEBYSCORE', KEYS[1], string.format('%.0f', base), '(' .. string.format('%.0f', base + tonumber(ARGV[3])), 'WITHSCORES', 'LIMIT', 0, 1)
+if first[1] then
+    current_round = math.floor((tonumber(first[2]) - base) / round_size)
+else
+    -- Nothing queued with this priority: all the rounds assigned were served
+    current_round = tonumber(redis.call('HGET', KEYS[3], priority) or '0') + 1
+end
+local round = math.max(current_round, tonumber(redis.call('HGET', KEYS[3], owner_field) or '0'))
+redis.call('HSET', KEYS[3], owner_field, round + 1)
+if round > tonumber(redis.call('HGET', KEYS[3], priority) or '0') then
+    redis.call('HSET', KEYS[3], priority, round)
+end
+
+-- Formatted explicitly, since Lua converts numbers to strings with only 14 digits
+local score = string.format('%.0f', base + round * round_size + sequence % round_size)
+redis.call('ZADD', KEYS[1], score, ARGV[1])
+redis.call('LPUSH', KEYS[4], sequence)
+return sequence
+"""
+
+# KEYS: queue, fair share rounds
+# ARGV: 2^QUEUE_SEQUENCE_BITS, 2^QUEUE_ROUND_BITS, then task identifier and owner of each task
+#
+# Removes the tasks from the queue (see _ENQUEUE_TASK_FAIR_SHARE). When a task was in the
+# last round of its owner, the next task of the owner goes to that round, so the owner is
+# not sent to the back for tasks that will not run. The tasks are removed from the last
+# round, so the result does not depend on their order. Returns the tasks removed
+_DEQUEUE_TASKS_FAIR_SHARE = """
+local sequence_size = tonumber(ARGV[1])
+local round_size = tonumber(ARGV[2])
+local queued = {}
+for i = 3, #ARGV, 2 do
+    local score = redis.call('ZSCORE', KEYS[1], ARGV[i])
+    if score then
+        table.insert(queued, { tonumber(score), ARGV[i], ARGV[i + 1] })
+    end
+end
+table.sort(queued, function (a, b) return a[1] > b[1] end)
+
+for _, task in ipairs(queued) do
+    redis.call('ZREM', KEYS[1], task[2])
+    local priority = math.floor(task[1] / sequence_size)
+    local round = math.floor((task[1] - priority * sequence_size) / round_size)
+    local owner_field = string.format('%d', priority) .. ':' .. task[3]
+    if tonumber(redis.call('HGET', KEYS[2], owner_field) or '0') == round + 1 then
+        redis.call('HSET', KEYS[2], owner_field, round)
+    end
+end
+return #queued
+"""
+
+# KEYS: task, device assignment, running deadlines, run durations, lifecycle events
+# ARGV: type (receiver or transmitter), device base, now (epoch), smoothing factor,
+#       maximum length of the lifecycle events
+#
+# When the receiver completes, the time it was running (since the task was added
+# to the running deadlines) is added to the moving average of the device.
+#
+# Returns the new status (or the error status if the transition was not valid) and
+# the time the receiver was running (false if unknown)
+_COMPLETE_TASK = """
+use_lifecycle_events(KEYS[5], ARGV[5])
+if ARGV[1] == 'receiver' then
+    local new_status = complete_receiver(KEYS[1], KEYS[2])
+    local started = redis.call('ZSCORE', KEYS[3], KEYS[1])
+    if new_status ~= '$Status_error' and started then
+        local duration = tonumber(ARGV[3]) - tonumber(started)
+        local average = tonumber(redis.call('HGET', KEYS[4], ARGV[2]) or duration)
+        local smoothing = tonumber(ARGV[4])
+        redis.call('HSET', KEYS[4], ARGV[2], tostring(smoothing * duration + (1 - smoothing) * average))
+        redis.call('ZREM', KEYS[3], KEYS[1])
+        -- As a string, since Lua numbers are truncated to integers in the reply
+        return { new_status, tostring(duration) }
+    end
+    return { new_status, false }
+elseif ARGV[1] == 'transmitter' then
+    return { complete_transmitter(KEYS[1]), false }
+end
+return { '$Status_error', false }
+"""
+
+# KEYS: polling deadlines, queue, run durations, devices last check
+# ARGV: now (epoch), minimum last check (epoch) of the active devices, task key prefix,
+#       task key suffix, number of fields, fields (the first one, uniqueIdentifier),
+#       task identifiers
+#
+# Records that the user is still waiting for each existing task, also in the polling
+# deadlines if the task is running (so the reaper does not stop it).
+# Returns, for each task, nil if it does not exist or the values of the fields followed by
+# its position in the queue; then the run durations of the devices (as HGETALL) and the
+# devices seen since the minimum last check.
+_POLL_TASKS = """
+local now = ARGV[1]
+local field_count = tonumber(ARGV[5])
+local fields = {}
+for i = 1, field_count do
+    fields[i] = ARGV[5 + i]
+end
+
+local tasks = {}
+for i = 6 + field_count, #ARGV do
+    local task_identifier = ARGV[i]
+    local task_key = ARGV[3] .. task_identifier .. ARGV[4]
+    local values = redis.call('HMGET', task_key, unpack(fields))
+    if values[1] then
+        redis.call('HSET', task_key, '$inactiveSince', now)
+        redis.call('ZADD', KEYS[1], 'XX', now, task_key)
+        table.insert(values, redis.call('ZRANK', KEYS[2], task_identifier))
+        table.insert(tasks, values)
+    else
+        table.insert(tasks, false)
+    end
+end
+return { tasks, redis.call('HGETALL', KEYS[3]), redis.call('ZRANGEBYSCORE', KEYS[4], ARGV[2], '+inf') }
+"""
+
+# KEYS: task, device assignment, lifecycle events
+# ARGV: now (epoch), max time without polling, maximum length of the lifecycle events,
+#       fields (the first one, uniqueIdentifier)
+#
+# Returns nil if the task does not exist, otherwise 1 if the task was stopped (0 if not)
+# followed by the values of the fields, once stopped
+_STOP_IF_INACTIVE = """
+use_lifecycle_events(KEYS[3], ARGV[3])
+local stopped = 0
+if stop_if_inactive(KEYS[1], KEYS[2], tonumber(ARGV[1]), tonumber(ARGV[2])) then
+    stopped = 1
+end
+local values = redis.call('HMGET', KEYS[1], unpack(ARGV, 4))
+if not values[1] then
+    return nil
+end
+table.insert(values, 1, stopped)
+return values
+"""
+
+# KEYS: task
+# ARGV: file key prefix, file key suffix
+#
+# Removes the file digests from the task and decreases the references of the
+# files, removing those that are not used anymore. Returns the files removed.
+_RELEASE_TASK_FILES = """
+local removed = 0
+for _, field in ipairs({ '$transmitterFileDigest', '$receiverFileDigest' }) do
+    local digest = redis.call('HGET', KEYS[1], field)
+    if digest then
+        redis.call('HDEL', KEYS[1], field)
+        local file_key = ARGV[1] .. digest .. ARGV[2]
+        if redis.call('HINCRBY', file_key, '$File_references', -1) <= 0 then
+            redis.call('DEL', file_key)
+            removed = removed + 1
+        end
+    end
+end
+return removed
+"""
+
+# KEYS: polling deadlines, running deadlines, lifecycle events
+# ARGV: now (epoch), max time without polling, max time running, limit,
+#       device assignment key prefix, device assignment key suffix,
+#       maximum length of the lifecycle events
+#
+# The deadline indexes are sorted sets of task keys, by the last time the user
+# polled and by the time the receiver started. Stops (on both sides) up to limit
+# tasks whose user has not polled in max time without polling, and completes up
+# to limit tasks running for more than max time running, releasing their devices.
+# Entries of tasks that do not hold a device anymore are just removed.
+#
+# Returns the identifiers of the stopped tasks, and the identifiers and authors
+# (as a flat list) of the tasks that timed out.
+_REAP = """
+use_lifecycle_events(KEYS[3], ARGV[7])
+local now = tonumber(ARGV[1])
+local max_time_without_polling = tonumber(ARGV[2])
+local limit = tonumber(ARGV[4])
+
+-- Return the task identifier, the device assignment key and the author if the task still holds its device
+local function holding_device(task_key)
+    local fields = redis.call('HMGET', task_key, '$uniqueIdentifier', '$deviceAssigned', '$author')
+    if not fields[1] or not fields[2] then
+        return nil
+    end
+    local assignment_key = ARGV[5] .. fields[2] .. ARGV[6]
+    if redis.call('GET', assignment_key) ~= fields[1] then
+        return nil
+    end
+    return fields[1], assignment_key, fields[3]
+end
+
+local function unindex(task_key)
+    redis.call('ZREM', KEYS[1], task_key)
+    redis.call('ZREM', KEYS[2], task_key)
+end
+
+local stopped = {}
+for _, task_key in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now - max_time_without_polling, 'LIMIT', 0, limit)) do
+    local task_identifier, assignment_key = holding_device(task_key)
+    if not task_identifier then
+        unindex(task_key)
+    elseif stop_if_inactive(task_key, assignment_key, now, max_time_without_polling) then
+        table.insert(stopped, task_identifier)
+        unindex(task_key)
+    else
+        -- The user polled in the meanwhile
+        redis.call('ZADD', KEYS[1], redis.call('HGET', task_key, '$inactiveSince') or now, task_key)
+    end
+end
+
+local timed_out = {}
+for _, task_key in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now - tonumber(ARGV[3]), 'LIMIT', 0, limit)) do
+    local task_identifier, assignment_key, author = holding_device(task_key)
+    if task_identifier then
+        set_status(task_key, '$Status_completed', nil, 'timeout')
+        redis.call('SET', assignment_key, 'null')
+        table.insert(timed_out, task_identifier)
+        table.insert(timed_out, author or 'None')
+    end
+    unindex(task_key)
+end
+
+return { stopped, timed_out }
+"""
+
+_SCRIPTS = {
+    'assign_receiver': _ASSIGN_RECEIVER,
+    'assign_transmitter': _ASSIGN_TRANSMITTER,
+    'enqueue_task': _ENQUEUE_TASK,
+    'enqueue_task_fair_share': _ENQUEUE_TASK_FAIR_SHARE,
+    'dequeue_tasks_fair_share': _DEQUEUE_TASKS_FAIR_SHARE,
+    'complete_task': _COMPLETE_TASK,
+    'stop_if_inactive': _STOP_IF_INACTIVE,
+    'release_task_files': _RELEASE_TASK_FILES,
+    'poll_tasks': _POLL_TASKS,
+    'reap': _REAP,
+}
+
+def _render(source: str) -> str:
+    names = {}
+    for name, value in vars(TaskKeys).items():
+        if isinstance(value, str) and not name.startswith('_'):
+            names[name] = value
+    for name, value in vars(TaskKeys.Status).items():
+        if isinstance(value, str) and not name.startswith('_'):
+            names[f'Status_{name}'] = value
+    for name, value in vars(FileKeys).items():
+        if isinstance(value, str) and not name.startswith('_'):
+            names[f'File_{name}'] = value
+    names['task_events_suffix'] = TASK_EVENTS_SUFFIX
+    return string.Template(_PRELUDE + source).substitute(names)
+
+def _get_script(name: str):
+    """
+    Return the registered script for the current app. The Script object runs EVALSHA
+    and only sends the source again if Redis does not have it (e.g., after a restart).
+    """
+    scripts = current_app.extensions.setdefault('reliascheduler-scripts', {})
+    script = scripts.get(name)
+    if script is None:
+        script = redis_store.register_script(_render(_SCRIPTS[name]))
+        scripts[name] = script
+    return script
+
+def _run_script(name: str, keys: List[str], args: List, pipeline=None):
+    """
+    Run the script, or add it to the pipeline, which must be executed with execute_pipeline.
+
+    redis-py sends SCRIPT EXISTS (and SCRIPT LOAD for the missing ones) before executing
+    a pipeline with scripts, so a pipeline would be at least two round-trips. Instead, the
+    script is loaded once per process, the first time it is added to a pipeline, and the
+    pipeline only has its EVALSHA.
+    """
+    script = _get_script(name)
+    if pipeline is None:
+        return script(keys=keys, args=args)
+
+    loaded = current_app.extensions.setdefault('reliascheduler-loaded-scripts', set())
+    if name not in loaded:
+        script.sha = redis_store.script_load(script.script)
+        loaded.add(name)
+    pipeline.evalsha(script.sha, len(keys), *keys, *args)
+    queued_scripts = pipeline.__dict__.setdefault('reliascheduler_scripts', [])
+    queued_scripts.append((len(pipeline.command_stack) - 1, name, keys, args))
+
+def execute_pipeline(pipeline) -> List:
+    """
+    Execute a pipeline with scripts added by the functions of this module, in a single
+    round-trip. If Redis does not have a script anymore (e.g., after a restart), the rest
+    of the pipeline is applied and the script is loaded and run again after it.
+
+    Return the results of the commands, as Pipeline.execute.
+    """
+    queued_scripts = pipeline.__dict__.pop('reliascheduler_scripts', [])
+    results = pipeline.execute(raise_on_error=False)
+    for position, name, keys, args in queued_scripts:
+        if isinstance(results[position], NoScriptError):
+            results[position] = _get_script(name)(keys=keys, args=args)
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return results
+
+def _seconds_since(iso_time: Optional[str]) -> Optional[float]:
+    try:
+        return (datetime.now() - datetime.fromisoformat(iso_time)).total_seconds()
+    except (TypeError, ValueError):
+        return None
+
+def _decode_assignment(result: Optional[List[str]], lifecycle_step: str) -> Optional[List[str]]:
+    """
+    Replace the file content by the decompressed one (unless it is an old task, with the file inline),
+    and record the time since the previous step of the task in the metrics (as lifecycle_step)
+    """
+    if result is None:
+        return None
+    task_identifier, filename, file_content, session_identifier, filetype, encoded_file_content, previous_step_time = result
+    if encoded_file_content is not None:
+        file_content = decode_file(encoded_file_content)
+    observe_lifecycle(lifecycle_step, _seconds_since(previous_step_time))
+    return [ task_identifier, filename, file_content, session_identifier, filetype ]
+
+def assign_receiver(device: str, task_identifier: Optional[str] = None) -> Optional[List[str]]:
+    """
+    Assign a task to the receiver. If task_identifier is None, the next task is popped
+    from the queue; tasks whose user stopped polling are skipped.
+
+    Return None or [ task_identifier, filename, file content, session identifier, file type ]
+    """
+    keys = get_key_schema()
+    device_base = device.split(':')[0]
+    task_key_prefix, task_key_suffix = keys.task_affixes()
+    file_key_prefix, file_key_suffix = keys.file_affixes()
+    return _decode_assignment(_get_script('assign_receiver')(
+        keys=[ keys.device_assignment(device_base), keys.transmitter_handoff(device_base), keys.polling_deadlines, keys.running_deadlines, keys.queue, keys.lifecycle_events, keys.queue_wakeups ],
+        args=[
+            task_identifier or '', device, device_base,
+            repr(time.time()), datetime.now().isoformat(),
+            current_app.config['MAX_TIME_WITHOUT_POLLING'], current_app.config['MAX_TIME_RUNNING'],
+            task_key_prefix, task_key_suffix, file_key_prefix, file_key_suffix,
+            current_app.config['LIFECYCLE_EVENTS_MAXLEN'],
+        ]), 'queue_wait')
+
+def assign_transmitter(device: str, task_identifier: Optional[str] = None) -> Optional[List[str]]:
+    """
+    Assign the task of the paired receiver to the transmitter. If task_identifier is None,
+    the current assignment of the device is used.
+
+    Return None or [ task_identifier, filename, file content, session identifier, file type ]
+    """
+    keys = get_key_schema()
+    device_base = device.split(':')[0]
+    task_key_prefix, task_key_suffix = keys.task_affixes()
+    file_key_prefix, file_key_suffix = keys.file_affixes()
+    return _decode_assignment(_get_script('assign_transmitter')(
+        keys=[ keys.device_assignment(device_base), keys.lifecycle_events ],
+        args=[
+            task_identifier or '', device,
+            repr(time.time()), datetime.now().isoformat(),
+            current_app.config['MAX_TIME_WITHOUT_POLLING'],
+            task_key_prefix, task_key_suffix, file_key_prefix, file_key_suffix,
+            current_app.config['LIFECYCLE_EVENTS_MAXLEN'],
+        ]), 'handoff_delay')
+
+def enqueue_task(task_identifier: str, priority: int, owner: Optional[str] = None, pipeline=None) -> int:
+    """
+    Add the task to the queue after the tasks with the same priority or, if owner is provided,
+    in the next round of the owner among the tasks with the same priority. If a pipeline is
+    provided, the command is added to it (execute it with execute_pipeline).
+
+    Return the sequence number of the task in the queue (if not in a pipeline).
+    """
+    keys = get_key_schema()
+    if owner is None:
+        return _run_script('enqueue_task',
+            keys=[ keys.queue, keys.queue_sequence, keys.queue_wakeups ],
+            args=[ task_identifier, priority, 2 ** QUEUE_SEQUENCE_BITS ],
+            pipeline=pipeline)
+
+    return _run_script('enqueue_task_fair_share',
+        keys=[ keys.queue, keys.queue_sequence, keys.queue_fair_share, keys.queue_wakeups ],
+        args=[ task_identifier, priority, 2 ** QUEUE_SEQUENCE_BITS, 2 ** QUEUE_ROUND_BITS, owner ],
+        pipeline=pipeline)
+
+def dequeue_tasks(task_identifiers: List[str], owners: Optional[List[str]] = None, pipeline=None):
+    """
+    Remove the tasks from the queue and, if their owners are provided, give their rounds back
+    to the owners when they were their last ones. If a pipeline is provided, the command is
+    added to it (execute it with execute_pipeline).
+    """
+    keys = get_key_schema()
+    if owners is None:
+        return (pipeline or redis_store).zrem(keys.queue, *task_identifiers)
+
+    return _run_script('dequeue_tasks_fair_share',
+        keys=[ keys.queue, keys.queue_fair_share ],
+        args=[ 2 ** QUEUE_SEQUENCE_BITS, 2 ** QUEUE_ROUND_BITS ] + [ value for pair in zip(task_identifiers, owners) for value in pair ],
+        pipeline=pipeline)
+
+def complete_task(device_base: str, type: str, task_identifier: str) -> str:
+    """
+    Mark the task as completed by the receiver or the transmitter, and return the new status
+    """
+    keys = get_key_schema()
+    new_status, duration = _get_script('complete_task')(
+        keys=[ keys.task(task_identifier), keys.device_assignment(device_base), keys.running_deadlines, keys.run_durations, keys.lifecycle_events ],
+        args=[ type, device_base, repr(time.time()), RUN_DURATION_SMOOTHING, current_app.config['LIFECYCLE_EVENTS_MAXLEN'] ])
+    if duration is not None:
+        observe_lifecycle('run_time', float(duration))
+    return new_status
+
+def stop_if_inactive(device_base: str, task_identifier: str, fields: List[str]) -> Optional[Tuple[bool, List[Optional[str]]]]:
+    """
+    Complete the task on both sides if the user has not polled in MAX_TIME_WITHOUT_POLLING,
+    and load its fields (the first one must be uniqueIdentifier).
+
+    Return None if the task does not exist, otherwise if it was stopped and the values of the fields.
+    """
+    keys = get_key_schema()
+    result = _get_script('stop_if_inactive')(
+        keys=[ keys.task(task_identifier), keys.device_assignment(device_base), keys.lifecycle_events ],
+        args=[ repr(time.time()), current_app.config['MAX_TIME_WITHOUT_POLLING'], current_app.config['LIFECYCLE_EVENTS_MAXLEN'] ] + fields)
+    if result is None:
+        return None
+    return result[0] == 1, result[1:]
+
+def poll_tasks(task_identifiers: List[str], fields: List[str], min_last_check: float) -> Tuple[List[Optional[List[Optional[str]]]], Dict[str, str], List[str]]:
+    """
+    Mark the tasks as polled and load their fields (the first one must be uniqueIdentifier).
+
+    Return, for each task, None or the values of the fields followed by its position in the
+    queue (None if not queued); the run durations of the devices; and the devices seen since
+    min_last_check.
+    """
+    keys = get_key_schema()
+    task_key_prefix, task_key_suffix = keys.task_affixes()
+    polled, run_durations, active_devices = _get_script('poll_tasks')(
+        keys=[ keys.polling_deadlines, keys.queue, keys.run_durations, keys.last_checks ],
+        args=[ repr(time.time()), repr(min_last_check), task_key_prefix, task_key_suffix, len(fields) ] + fields + list(task_identifiers))
+    return polled, dict(zip(run_durations[0::2], run_durations[1::2])), active_devices
+
+def release_task_files(task_identifier: str, pipeline=None) -> int:
+    """
+    Release the references of the task to its files, removing the files not used by any other
+    task. If a pipeline is provided, the command is added to it (execute it with execute_pipeline).
+
+    Return the number of files removed (if not in a pipeline).
+    """
+    keys = get_key_schema()
+    file_key_prefix, file_key_suffix = keys.file_affixes()
+    return _run_script('release_task_files',
+        keys=[ keys.task(task_identifier) ],
+        args=[ file_key_prefix, file_key_suffix ],
+        pipeline=pipeline)
+
+def reap(limit: int) -> Tuple[List[str], List[Tuple[str, str]]]:
+    """
+    Stop up to limit tasks whose user is not polling anymore, and complete up to limit
+    tasks running for more than MAX_TIME_RUNNING, releasing their devices.
+
+    Return the identifiers of the stopped tasks and (task identifier, author) of the timed out tasks.
+    """
+    keys = get_key_schema()
+    assignment_key_prefix, assignment_key_suffix = keys.device_assignment_affixes()
+    stopped, timed_out = _get_script('reap')(
+        keys=[ keys.polling_deadlines, keys.running_deadlines, keys.lifecycle_events ],
+        args=[
+            repr(time.time()), current_app.config['MAX_TIME_WITHOUT_POLLING'], current_app.config['MAX_TIME_RUNNING'],
+            limit, assignment_key_prefix, assignment_key_suffix, current_app.config['LIFECYCLE_EVENTS_MAXLEN'],
+        ])
+    return stopped, list(zip(timed_out[0::2], timed_out[1::2]))
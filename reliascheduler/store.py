@@ -0,0 +1,478 @@
+"""
+Access to the tasks and devices stored in Redis.
+
+The views go through TaskStore and DeviceStore instead of building keys and
+issuing HGET/HSET commands field by field:
+
+ - The key names are calculated once per app (KeySchema, see reliascheduler.schema),
+   instead of reading BASE_KEY from the config and formatting the key every time.
+ - A task is written with a single HSET (with mapping) and read with a single
+   HMGET or HGETALL, and converted to a Task record.
+ - The contents of the GRC files are stored once per content (FileStore),
+   compressed and reference counted, and the tasks only keep their digest.
+ - The queued tasks are kept in a single sorted set, by priority and then by
+   order of arrival (see reliascheduler.schema.queue_score), so the next task is popped with a single
+   ZPOPMIN / BZPOPMIN regardless of the number of priorities.
+"""
+import math
+import time
+import hashlib
+import secrets
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from flask import Flask, current_app
+
+from reliascheduler import redis_store, scripts
+from reliascheduler.keys import TaskKeys, FileKeys
+from reliascheduler.schema import KeySchema, decode_file, encode_file, get_key_schema, init_key_schema
+
+QUEUE_POLICIES = {
+    'fifo': None,
+    'fair-share-author': 'author',
+    'fair-share-session': 'session_id',
+}
+
+# Devices seen in this time (in seconds) are considered available for the estimations
+ACTIVE_DEVICE_TIME = 60
+
+# Devices not seen in this time (in seconds) are not listed anymore, and the garbage
+# collector forgets them
+LAST_CHECKS_MAX_AGE = 24 * 3600
+
+# (attribute, field in the hash, conversion from the string stored in Redis)
+_TASK_FIELDS: List[Tuple[str, str, Callable[[str], Any]]] = [
+    ('identifier', TaskKeys.uniqueIdentifier, str),
+    ('author', TaskKeys.author, str),
+    # Only in tasks created before the files were stored by digest
+    ('transmitter_file', TaskKeys.transmitterFile, str),
+    ('receiver_file', TaskKeys.receiverFile, str),
+    ('transmitter_file_digest', TaskKeys.transmitterFileDigest, str),
+    ('receiver_file_digest', TaskKeys.receiverFileDigest, str),
+    ('transmitter_filename', TaskKeys.transmitterFilename, str),
+    ('receiver_filename', TaskKeys.receiverFilename, str),
+    ('session_id', TaskKeys.sessionId, str),
+    ('started_time', TaskKeys.startedTime, str),
+    ('priority', TaskKeys.priority, int),
+    ('transmitter_assigned', TaskKeys.transmitterAssigned, str),
+    ('receiver_assigned', TaskKeys.receiverAssigned, str),
+    ('device_assigned', TaskKeys.deviceAssigned, str),
+    ('transmitter_processing_start', TaskKeys.transmitterProcessingStart, str),
+    ('receiver_processing_start', TaskKeys.receiverProcessingStart, str),
+    ('status', TaskKeys.status, str),
+    ('error_message', TaskKeys.errorMessage, str),
+    ('error_time', TaskKeys.errorTime, str),
+    ('local_time_remaining', TaskKeys.localTimeRemaining, str),
+    ('inactive_since', TaskKeys.inactiveSince, float),
+    ('transmitter_filetype', TaskKeys.transmitterFiletype, str),
+    ('receiver_filetype', TaskKeys.receiverFiletype, str),
+]
+
+_FIELD_BY_ATTRIBUTE = { attribute: field for attribute, field, _ in _TASK_FIELDS }
+
+class Task:
+    """
+    A task, as stored in the TaskKeys.identifier hash. Attributes not loaded
+    (or not stored) are None. Unassigned devices and processing times are
+    stored as "null", as the devices and the backend expect.
+    """
+    __slots__ = tuple(attribute for attribute, _, _ in _TASK_FIELDS)
+
+    def __init__(self, **kwargs):
+        for attribute, _, _ in _TASK_FIELDS:
+            setattr(self, attribute, kwargs.pop(attribute, None))
+        if kwargs:
+            raise TypeError(f"Unexpected task attributes: {', '.join(kwargs)}")
+
+    @staticmethod
+    def from_values(attributes: List[str], values: List[Optional[str]]) -> 'Task':
+        task = Task()
+        for attribute, value in zip(attributes, values):
+            if value is not None:
+                setattr(task, attribute, _CONVERSIONS[attribute](value))
+        return task
+
+    @staticmethod
+    def from_mapping(mapping: Dict[str, str]) -> 'Task':
+        task = Task()
+        for attribute, field, conversion in _TASK_FIELDS:
+            value = mapping.get(field)
+            if value is not None:
+                setattr(task, attribute, conversion(value))
+        return task
+
+    def to_mapping(self) -> Dict[str, str]:
+        mapping = {}
+        for attribute, field, _ in _TASK_FIELDS:
+            value = getattr(self, attribute)
+            if value is not None:
+                mapping[field] = str(value)
+        return mapping
+
+_CONVERSIONS = { attribute: conversion for attribute, _, conversion in _TASK_FIELDS }
+
+class FileStore:
+    """
+    The contents of the GRC files, stored in a FileKeys.file hash by their SHA-256 digest,
+    so the same file submitted several times is stored once. The content is compressed
+    (see reliascheduler.schema.encode_file), and the hash counts how many tasks reference it, so it is removed when the last one is released.
+    """
+    def __init__(self, keys: KeySchema):
+        self.keys = keys
+
+    @staticmethod
+    def digest(content: str) -> str:
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def add(self, content: str, pipeline) -> str:
+        """
+        Add a reference to the content (storing it if it is new) and return its digest.
+        The commands are added to the pipeline.
+        """
+        digest = self.digest(content)
+        file_key = self.keys.file(digest)
+        pipeline.hsetnx(file_key, FileKeys.content, encode_file(content))
+        pipeline.hincrby(file_key, FileKeys.references, 1)
+        return digest
+
+    def get(self, digest: str) -> Optional[str]:
+        encoded_content = redis_store.hget(self.keys.file(digest), FileKeys.content)
+        if encoded_content is None:
+            return None
+        return decode_file(encoded_content)
+
+def _estimate_waits(positions: List[Optional[int]], run_durations: Dict[str, str], active_devices: List[str]) -> List[Optional[float]]:
+    """
+    Estimate the seconds until the tasks with the provided positions in the queue start.
+
+    With tasks in the queue, all the devices are busy, so a task starts after position + 1
+    devices finish. Each device finishes a task every average run duration, so that happens
+    in (position + 0.5) * average / devices seconds.
+    """
+    # A receiver and its transmitter share the device base, and run a task at a time
+    active_device_bases = { device.split(':')[0] for device in active_devices }
+    durations = [ float(duration) for device_base, duration in run_durations.items() if device_base in active_device_bases ]
+    if not durations:
+        # Devices that have not finished any task recently: use the rest of devices
+        durations = [ float(duration) for duration in run_durations.values() ]
+
+    if not durations:
+        return [ None for _ in positions ]
+
+    average_duration = sum(durations) / len(durations)
+    devices = max(len(active_device_bases), 1)
+    return [ None if position is None else (position + 0.5) * average_duration / devices for position in positions ]
+
+class TaskStore:
+    def __init__(self, keys: KeySchema, files: FileStore, queue_policy: str = 'fifo'):
+        if queue_policy not in QUEUE_POLICIES:
+            raise ValueError(f"Invalid QUEUE_POLICY {queue_policy!r}. Valid values: {', '.join(QUEUE_POLICIES)}")
+        self.keys = keys
+        self.files = files
+        # Attribute of the task that identifies its owner for the fair share, if any
+        self.fair_share_attribute = QUEUE_POLICIES[queue_policy]
+
+    def reserve_identifier(self) -> str:
+        """
+        Return a new unique task identifier. We rely on a set to know which identifiers
+        have been used: it means that there has been an attempt to create the task, not
+        that the task is currently active (and might need to be cleaned).
+        """
+        task_identifier = secrets.token_urlsafe()
+        while redis_store.sadd(self.keys.tasks, task_identifier) == 0:
+            task_identifier = secrets.token_urlsafe()
+        return task_identifier
+
+    def create(self, task: Task, transmitter_file: str, receiver_file: str):
+        """
+        Store a new task with its files and add it to the queue of its priority, in a single
+        round-trip
+        """
+        pipeline = redis_store.pipeline()
+        task.transmitter_file_digest = self.files.add(transmitter_file, pipeline)
+        task.receiver_file_digest = self.files.add(receiver_file, pipeline)
+        pipeline.hset(self.keys.task(task.identifier), mapping=task.to_mapping())
+        self.enqueue(task, pipeline=pipeline)
+        self.add_event(task.identifier, task.status, task=task, pipeline=pipeline)
+        scripts.execute_pipeline(pipeline)
+
+    def enqueue(self, task: Task, pipeline=None):
+        """
+        Add the task to the queue, after the tasks with its priority (or, with a fair share
+        policy, after the tasks with its priority and its owner, in the next round of the
+        rest of owners). The task must have the priority and the owner (author or session_id)
+        loaded. If a pipeline is provided, the command is added to it (execute it with
+        scripts.execute_pipeline).
+        """
+        owner = None
+        if self.fair_share_attribute is not None:
+            owner = str(getattr(task, self.fair_share_attribute))
+        scripts.enqueue_task(task.identifier, task.priority, owner=owner, pipeline=pipeline)
+
+    def dequeue(self, queued_tasks: List[Task], pipeline=None):
+        """
+        Remove the tasks from the queue (with a fair share policy, also from the rounds of their
+        owners). The tasks must have the owner (author or session_id) loaded. If a pipeline is
+        provided, the command is added to it (execute it with scripts.execute_pipeline).
+        """
+        owners = None
+        if self.fair_share_attribute is not None:
+            owners = [ str(getattr(task, self.fair_share_attribute)) for task in queued_tasks ]
+        scripts.dequeue_tasks([ task.identifier for task in queued_tasks ], owners=owners, pipeline=pipeline)
+
+    def wait_for_queued_task(self, timeout: float) -> Optional[str]:
+        """
+        Block until a task is queued, without generating any traffic while waiting, and
+        return the sequence number it was queued with. Return None if timeout expires.
+
+        The tasks stay in the queue: the receiver pops them in the assignment (see
+        scripts.assign_receiver), so a receiver that dies or stops waiting after waking
+        up can not lose any. Each task queued wakes up a single receiver.
+        """
+        popped = redis_store.brpop([ self.keys.queue_wakeups ], timeout=_blocking_timeout(timeout))
+        if popped is None:
+            return None
+        return popped[1]
+
+    async def wait_for_queued_task_async(self, async_redis, timeout: float) -> Optional[str]:
+        """
+        Same as wait_for_queued_task, with an asyncio Redis client (see reliascheduler.asgi)
+        """
+        popped = await async_redis.brpop([ self.keys.queue_wakeups ], timeout=_blocking_timeout(timeout))
+        if popped is None:
+            return None
+        return popped[1]
+
+    def get_queue_estimates(self, task_identifiers: List[str]) -> List[Tuple[Optional[int], Optional[float]]]:
+        """
+        Return, for each task, the number of tasks before it in the queue and the estimated
+        seconds until it starts (None if it is not queued, or if there is no estimation).
+        """
+        pipeline = redis_store.pipeline(transaction=False)
+        for task_identifier in task_identifiers:
+            pipeline.zrank(self.keys.queue, task_identifier)
+        pipeline.hgetall(self.keys.run_durations)
+        pipeline.zrangebyscore(self.keys.last_checks, time.time() - ACTIVE_DEVICE_TIME, '+inf')
+        results = pipeline.execute()
+        positions, run_durations, active_devices = results[:-2], results[-2], results[-1]
+        return list(zip(positions, _estimate_waits(positions, run_durations, active_devices)))
+
+    def poll(self, task_identifiers: List[str], *attributes: str) -> List[Optional[Tuple[Task, Optional[int], Optional[float]]]]:
+        """
+        Record that the user is still waiting for the tasks (also in the polling deadlines of
+        those running, so the reaper does not stop them) and load the provided attributes, all
+        in a single script call.
+
+        Return, for each task, None if it does not exist, or the task, the number of tasks
+        before it in the queue and the estimated seconds until it starts (see get_queue_estimates).
+        """
+        attributes = ('identifier',) + attributes
+        fields = [ _FIELD_BY_ATTRIBUTE[attribute] for attribute in attributes ]
+        polled, run_durations, active_devices = scripts.poll_tasks(task_identifiers, fields, time.time() - ACTIVE_DEVICE_TIME)
+
+        positions = [ values[-1] if values is not None else None for values in polled ]
+        waits = _estimate_waits(positions, run_durations, active_devices)
+
+        results = []
+        for values, position, wait in zip(polled, positions, waits):
+            if values is None:
+                results.append(None)
+            else:
+                results.append((Task.from_values(attributes, values[:-1]), position, wait))
+        return results
+
+    def stop_if_inactive(self, device_base: str, task_identifier: str, *attributes: str) -> Optional[Tuple[bool, Task]]:
+        """
+        Complete the task on both sides if the user has not polled in a while, and load the
+        provided attributes (once stopped), in a single script call.
+
+        Return None if the task does not exist, otherwise if it was stopped and the task.
+        """
+        attributes = ('identifier',) + attributes
+        result = scripts.stop_if_inactive(device_base, task_identifier, [ _FIELD_BY_ATTRIBUTE[attribute] for attribute in attributes ])
+        if result is None:
+            return None
+        stopped, values = result
+        return stopped, Task.from_values(attributes, values)
+
+    def get(self, task_identifier: str, *attributes: str) -> Optional[Task]:
+        """
+        Load the provided attributes of a task (all of them if none is provided).
+
+        Return None if the task does not exist.
+        """
+        if not attributes:
+            mapping = redis_store.hgetall(self.keys.task(task_identifier))
+            if not mapping:
+                return None
+            return Task.from_mapping(mapping)
+
+        attributes = ('identifier',) + attributes
+        values = redis_store.hmget(self.keys.task(task_identifier), [ _FIELD_BY_ATTRIBUTE[attribute] for attribute in attributes ])
+        if values[0] is None:
+            return None
+        return Task.from_values(attributes, values)
+
+    def update(self, task_identifier: str, pipeline=None, reason: Optional[str] = None, task: Optional[Task] = None, **values):
+        """
+        Update attributes of a task, publishing the change of status if any (and adding it to
+        the lifecycle events, with the reason provided and the priority and device assigned of
+        the task, if loaded). If a pipeline is provided, the commands are added to it.
+        """
+        client = pipeline or redis_store
+        mapping = { _FIELD_BY_ATTRIBUTE[attribute]: str(value) for attribute, value in values.items() }
+        client.hset(self.keys.task(task_identifier), mapping=mapping)
+        if 'status' in values:
+            client.publish(self.keys.task_events(task_identifier), str(values['status']))
+            self.add_event(task_identifier, str(values['status']), task=task, reason=reason, pipeline=client)
+
+    def add_event(self, task_identifier: str, event: str, task: Optional[Task] = None, device: Optional[str] = None,
+                  reason: Optional[str] = None, pipeline=None):
+        """
+        Add an event of the task to the lifecycle events (see reliascheduler/lifecycle.py), with
+        the priority of the task provided and the device (by default, the device assigned to it).
+        Only the fields loaded in the task are sent, so it is a single XADD, not a script.
+        Nothing is sent if LIFECYCLE_EVENTS_MAXLEN is 0. If a pipeline is provided, the command
+        is added to it.
+        """
+        maxlen = current_app.config['LIFECYCLE_EVENTS_MAXLEN']
+        if maxlen <= 0:
+            return
+        fields = { 'event': event, 'task': task_identifier }
+        if task is not None and task.priority is not None:
+            fields['priority'] = str(task.priority)
+        if not device and task is not None:
+            device = task.device_assigned
+        if device and device != 'null':
+            fields['device'] = device
+        if reason:
+            fields['reason'] = reason
+        (pipeline or redis_store).xadd(self.keys.lifecycle_events, fields, maxlen=maxlen, approximate=True)
+
+    def subscribe(self, task_identifier: str):
+        """
+        Return a PubSub (with its own connection, which must be closed) subscribed to the
+        changes of status of the task
+        """
+        pubsub = redis_store.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.keys.task_events(task_identifier))
+        return pubsub
+
+    async def subscribe_async(self, async_redis, task_identifier: str):
+        """
+        Same as subscribe, with an asyncio Redis client (see reliascheduler.asgi)
+        """
+        pubsub = async_redis.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(self.keys.task_events(task_identifier))
+        return pubsub
+
+    def delete(self, task: Task):
+        """
+        Mark the task as deleted, remove it from its queue and release the device if it was assigned.
+        The task must have the owner (author or session_id) loaded, see dequeue.
+        """
+        pipeline = redis_store.pipeline()
+        self.update(task.identifier, status=TaskKeys.Status.deleted, task=task, pipeline=pipeline)
+        self.release_files(task.identifier, pipeline=pipeline)
+        if task.receiver_assigned is not None and task.receiver_assigned != "null":
+            device_base = task.receiver_assigned.split(':')[0]
+            pipeline.set(self.keys.device_assignment(device_base), "null")
+        self.dequeue([ task ], pipeline=pipeline)
+        pipeline.srem(self.keys.tasks, task.identifier)
+        scripts.execute_pipeline(pipeline)
+
+    def release_files(self, task_identifier: str, pipeline=None):
+        """
+        Release the references of the task to its files, removing the files not used by
+        any other task. If a pipeline is provided, the command is added to it (execute it with
+        scripts.execute_pipeline).
+        """
+        scripts.release_task_files(task_identifier, pipeline=pipeline)
+
+class DeviceStore:
+    def __init__(self, keys: KeySchema):
+        self.keys = keys
+
+    def mark_as_seen(self, device: str):
+        """
+        Register the time the device was last seen, in a sorted set of devices by time
+        """
+        redis_store.zadd(self.keys.last_checks, { device: time.time() })
+
+    def get_assignment(self, device_base: str) -> Optional[str]:
+        task_identifier = redis_store.get(self.keys.device_assignment(device_base))
+        if task_identifier == "null":
+            return None
+        return task_identifier
+
+    def release(self, device_base: str, pipeline=None):
+        """
+        Remove the task assigned to the device. If a pipeline is provided, the command is added to it.
+        """
+        (pipeline or redis_store).set(self.keys.device_assignment(device_base), "null")
+
+    def wait_for_handoff(self, device_base: str, timeout: float) -> Optional[str]:
+        """
+        Block until the receiver of the device is assigned a task, and return the task
+        identifier (which might be outdated). Return None if timeout expires.
+        """
+        popped = redis_store.brpop([ self.keys.transmitter_handoff(device_base) ], timeout=_blocking_timeout(timeout))
+        if popped is None:
+            return None
+        return popped[1]
+
+    async def wait_for_handoff_async(self, async_redis, device_base: str, timeout: float) -> Optional[str]:
+        """
+        Same as wait_for_handoff, with an asyncio Redis client (see reliascheduler.asgi)
+        """
+        popped = await async_redis.brpop([ self.keys.transmitter_handoff(device_base) ], timeout=_blocking_timeout(timeout))
+        if popped is None:
+            return None
+        return popped[1]
+
+    def get_last_checks(self, max_age: float = LAST_CHECKS_MAX_AGE) -> List[Tuple[str, float, Optional[str]]]:
+        """
+        Return the devices seen in the last max_age seconds, with the last time they were seen
+        (as a timestamp) and their assignment, sorted by name
+        """
+        last_checks = sorted(redis_store.zrangebyscore(self.keys.last_checks, time.time() - max_age, '+inf', withscores=True))
+        if not last_checks:
+            return []
+
+        pipeline = redis_store.pipeline(transaction=False)
+        for device, _ in last_checks:
+            pipeline.get(self.keys.device_assignment(device.split(':')[0]))
+        assignments = pipeline.execute()
+
+        return [ (device, last_check, assignment) for (device, last_check), assignment in zip(last_checks, assignments) ]
+
+    def forget_unseen(self, max_age: float = LAST_CHECKS_MAX_AGE) -> int:
+        """
+        Remove the devices not seen in the last max_age seconds from the last checks, and
+        return how many were removed
+        """
+        return redis_store.zremrangebyscore(self.keys.last_checks, '-inf', f'({time.time() - max_age}')
+
+def _blocking_timeout(timeout: float) -> int:
+    # Blocking commands take the timeout in seconds, and 0 means forever
+    return max(int(math.ceil(timeout)), 1)
+
+class _Stores:
+    def __init__(self, app: Flask):
+        with app.app_context():
+            self.keys = get_key_schema()
+        self.files = FileStore(self.keys)
+        self.tasks = TaskStore(self.keys, self.files, app.config['QUEUE_POLICY'])
+        self.devices = DeviceStore(self.keys)
+
+def init_stores(app: Flask):
+    init_key_schema(app)
+    app.extensions['reliascheduler-stores'] = _Stores(app)
+
+def get_file_store() -> FileStore:
+    return current_app.extensions['reliascheduler-stores'].files
+
+def get_task_store() -> TaskStore:
+    return current_app.extensions['reliascheduler-stores'].tasks
+
+def get_device_store() -> DeviceStore:
+    return current_app.extensions['reliascheduler-stores'].devices
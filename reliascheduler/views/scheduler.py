@@ -1,107 +1,266 @@
 from collections import OrderedDict
 import json
-import os
 import glob
 import time
-import secrets
 import logging
-from datetime import datetime
-from typing import Dict
+from datetime import datetime, timedelta
+from typing import Dict, Generator, List, Optional, Tuple, Union
 
 import yaml
-import numpy as np
 
-from flask import Blueprint, jsonify, current_app, request
+from flask import Blueprint, Response, jsonify, current_app, request, stream_with_context
 
-from reliascheduler import redis_store
+from reliascheduler import redis_store, scripts
+from reliascheduler.archive import get_archive
 from reliascheduler.auth import check_backend_credentials, check_device_credentials
-from reliascheduler.keys import ErrorKeys, TaskKeys, DeviceKeys
+from reliascheduler.errors import store_error, index_error, get_latest_errors
+from reliascheduler.keys import TaskKeys
+from reliascheduler.lifecycle import ERROR_MESSAGE_EVENT
+from reliascheduler.metadata import get_device_metadata
+from reliascheduler.metrics import get_metrics
+from reliascheduler.store import Task, get_task_store, get_device_store
 
 logger = logging.getLogger(__name__)
 
 scheduler_blueprint = Blueprint('scheduler', __name__)
 
+# Attributes of the task returned to the backend while the user waits
+_USER_TASK_ATTRIBUTES = ('status', 'receiver_assigned', 'transmitter_assigned', 'device_assigned', 'receiver_filename', 'transmitter_filename')
+
 @scheduler_blueprint.route('/user/tasks/<task_identifier>', methods=['GET'])
 def user_get_task(task_identifier):
-    t = TaskKeys.identifier(task_identifier)
-    author = redis_store.hget(t, TaskKeys.author)
-    if author == None:
-        pipeline = redis_store.pipeline()
-        pipeline.sadd(ErrorKeys.errors(), task_identifier)
-        pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.uniqueIdentifier, task_identifier)
-        pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.author, "No author")
-        pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.errorMessage, "Task identifier does not exist")
-        pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.errorTime, datetime.now().isoformat())
-        results = pipeline.execute()
+    polled = get_task_store().poll([ task_identifier ], *_USER_TASK_ATTRIBUTES)[0]
+    if polled is None:
+        polled = _get_archived_task(task_identifier)
+    if polled is None:
+        store_error(task_identifier, "No author", "Task identifier does not exist")
         return jsonify(success=False, status=None, receiver=None, transmitter=None, session_id=None, message="Task identifier does not exist")
-    
-    mark_as_poll(task_identifier)
 
-    pipeline = redis_store.pipeline()
-    pipeline.hget(t, TaskKeys.status)
-    pipeline.hget(t, TaskKeys.receiverAssigned)
-    pipeline.hget(t, TaskKeys.transmitterAssigned)
-    pipeline.hget(t, TaskKeys.deviceAssigned)
-    pipeline.hget(t, TaskKeys.receiverFilename)
-    pipeline.hget(t, TaskKeys.transmitterFilename)
-    status, receiver, transmitter, device, receiver_filename, transmitter_filename  = pipeline.execute()
-
-    metadata_filename = current_app.config['DEVICE_METADATA_FILENAME']
-
-    if device and os.path.exists(metadata_filename):
-        devices_metadata = yaml.safe_load(open(metadata_filename).read())
-        camera_url = devices_metadata.get(device, {}).get('camera')
+    return jsonify(**_user_task_fields(*polled))
+
+def _get_archived_task(task_identifier: str) -> Optional[Tuple[Task, Optional[int], Optional[float]]]:
+    """
+    Return the task (as TaskStore.poll) if it is not in Redis anymore because it was archived
+    """
+    archive = get_archive()
+    task = archive.get(task_identifier) if archive is not None else None
+    if task is None:
+        return None
+    return task, None, None
+
+@scheduler_blueprint.route('/user/tasks/status', methods=['POST'])
+def user_get_tasks_status():
+    """
+    Same as user_get_task for several tasks at once (up to MAX_BATCH_TASKS, marking all of
+    them as polled), e.g.:
+
+    { "taskIdentifiers": [ "identifier1", "identifier2" ] }
+    """
+    authenticated = check_backend_credentials()
+    if not authenticated:
+        return jsonify(success=False, tasks=None), 401
+
+    task_identifiers = _get_task_identifiers()
+    if task_identifiers is None:
+        return jsonify(success=False, tasks=None, message=_invalid_task_identifiers_message()), 400
+
+    polled_tasks = get_task_store().poll(task_identifiers, *_USER_TASK_ATTRIBUTES)
+
+    results = {}
+    missing_task_identifiers = []
+    for task_identifier, polled in zip(task_identifiers, polled_tasks):
+        if polled is None:
+            polled = _get_archived_task(task_identifier)
+        if polled is None:
+            missing_task_identifiers.append(task_identifier)
+            results[task_identifier] = dict(success=False, status=None, receiver=None, transmitter=None, session_id=None, message="Task identifier does not exist")
+        else:
+            results[task_identifier] = _user_task_fields(*polled)
+
+    if missing_task_identifiers:
+        pipeline = redis_store.pipeline()
+        for task_identifier in missing_task_identifiers:
+            store_error(task_identifier, "No author", "Task identifier does not exist", pipeline=pipeline)
+        pipeline.execute()
+
+    return jsonify(success=True, tasks=results)
+
+# After these, the status of a task does not change anymore
+_FINAL_STATUSES = (TaskKeys.Status.completed, TaskKeys.Status.deleted, TaskKeys.Status.error)
+
+TASK_EVENTS_HEADERS = {
+    'Cache-Control': 'no-cache',
+    # Otherwise nginx buffers the events
+    'X-Accel-Buffering': 'no',
+}
+
+@scheduler_blueprint.route('/user/tasks/<task_identifier>/events', methods=['GET'])
+def user_get_task_events(task_identifier):
+    """
+    Server-sent events stream with the task (as in user_get_task) every time its status
+    changes, until it is completed, deleted or failed.
+
+    The changes are published by the scripts and the stores in the events channel of the
+    task. While the stream is open, the task is marked as polled every few seconds, so
+    the client does not need to poll user_get_task to keep the task alive. Here each open
+    stream uses a thread and a Redis connection; reliascheduler.asgi runs the same steps
+    in the event loop instead.
+    """
+    # Subscribe before reading the task, so no change is lost in between
+    pubsub = get_task_store().subscribe(task_identifier)
+    steps = task_events_steps(task_identifier)
+    try:
+        first_chunk = next(steps)
+    except StopIteration as stop:
+        pubsub.close()
+        fields, status_code = stop.value
+        return jsonify(**fields), status_code
+
+    def events():
+        try:
+            chunk = first_chunk
+            while True:
+                if isinstance(chunk, EventsWait):
+                    chunk = steps.send(pubsub.get_message(timeout=chunk.timeout) is not None)
+                else:
+                    yield chunk
+                    chunk = next(steps)
+        except StopIteration:
+            pass
+        finally:
+            pubsub.close()
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream', headers=TASK_EVENTS_HEADERS)
+
+class EventsWait:
+    """
+    What the task events generator (see task_events_steps) is waiting for: a message in
+    the events channel of the task, for up to timeout seconds. The runner sends back if
+    there was a message.
+    """
+    __slots__ = ('timeout',)
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+
+def task_events_steps(task_identifier: str) -> Generator[Union[str, EventsWait], bool, Optional[Tuple[dict, int]]]:
+    """
+    The logic of user_get_task_events, as a generator that yields the chunks of the stream
+    and what it is waiting for, so it can also be run without blocking a thread by
+    reliascheduler.asgi. The runner must be subscribed to the events channel of the task
+    before starting it. If the task does not exist, it returns the response (fields,
+    status code) before yielding anything.
+    """
+    tasks = get_task_store()
+    polled = tasks.poll([ task_identifier ], *_USER_TASK_ATTRIBUTES)[0]
+    if polled is None:
+        store_error(task_identifier, "No author", "Task identifier does not exist")
+        return dict(success=False, status=None, receiver=None, transmitter=None, session_id=None, message="Task identifier does not exist"), 404
+
+    keepalive_interval = current_app.config['MAX_TIME_WITHOUT_POLLING'] / 3
+
+    fields = _user_task_fields(*polled)
+    yield f"event: status\ndata: {json.dumps(fields)}\n\n"
+    last_poll = time.time()
+    while fields['status'] not in _FINAL_STATUSES:
+        remaining_time = keepalive_interval - (time.time() - last_poll)
+        message = (yield EventsWait(remaining_time)) if remaining_time > 0 else False
+        if not message and time.time() - last_poll < keepalive_interval:
+            continue
+
+        # The status changed, or it is time to mark the task as polled again
+        polled_again = tasks.poll([ task_identifier ], *_USER_TASK_ATTRIBUTES)[0]
+        last_poll = time.time()
+        if polled_again is None:
+            # Removed in the meanwhile (e.g., garbage collected)
+            break
+
+        new_fields = _user_task_fields(*polled_again)
+        if not message and new_fields['status'] == fields['status']:
+            yield ": keepalive\n\n"
+        else:
+            fields = new_fields
+            yield f"event: status\ndata: {json.dumps(fields)}\n\n"
+
+def _user_task_fields(task: Task, queue_position: Optional[int], estimated_wait: Optional[float]) -> dict:
+    device = task.device_assigned
+    if device:
+        camera_url = get_device_metadata().get_camera_url(device)
     else:
         camera_url = None
 
-    return jsonify(
+    return dict(
         success=True, 
-        status=status, 
+        status=task.status, 
         assignedInstance=device,
         cameraUrl=camera_url,
-        receiver=receiver, 
-        transmitter=transmitter, 
-        receiverFilename=receiver_filename,
-        transmitterFilename=transmitter_filename,
+        receiver=task.receiver_assigned, 
+        transmitter=task.transmitter_assigned, 
+        receiverFilename=task.receiver_filename,
+        transmitterFilename=task.transmitter_filename,
+        **_queue_estimate_fields(queue_position, estimated_wait),
         message="Success"
     )
 
+def _get_task_identifiers() -> Optional[List[str]]:
+    """
+    Return the taskIdentifiers of the request without duplicates (in their order), or None
+    if it is not a list of strings or it has more than MAX_BATCH_TASKS, since they are all
+    polled in a single script call (and looked up in the archive if they are not in Redis)
+    """
+    request_data = request.get_json(silent=True, force=True) or {}
+    task_identifiers = request_data.get('taskIdentifiers')
+    if not isinstance(task_identifiers, list) or not all(isinstance(task_identifier, str) for task_identifier in task_identifiers):
+        return None
+    task_identifiers = list(dict.fromkeys(task_identifiers))
+    if len(task_identifiers) > current_app.config['MAX_BATCH_TASKS']:
+        return None
+    return task_identifiers
+
+def _invalid_task_identifiers_message() -> str:
+    return f"taskIdentifiers must be a list of at most {current_app.config['MAX_BATCH_TASKS']} task identifiers"
+
+@scheduler_blueprint.route('/user/tasks/estimates', methods=['POST'])
+def user_get_task_estimates():
+    """
+    Queue position and estimated start time of several tasks (up to MAX_BATCH_TASKS), e.g.:
+
+    { "taskIdentifiers": [ "identifier1", "identifier2" ] }
+    """
+    authenticated = check_backend_credentials()
+    if not authenticated:
+        return jsonify(success=False, tasks=None), 401
+
+    task_identifiers = _get_task_identifiers()
+    if task_identifiers is None:
+        return jsonify(success=False, tasks=None, message=_invalid_task_identifiers_message()), 400
+
+    estimates = get_task_store().get_queue_estimates(task_identifiers)
+    return jsonify(success=True, tasks={
+        task_identifier: _queue_estimate_fields(queue_position, estimated_wait)
+        for task_identifier, (queue_position, estimated_wait) in zip(task_identifiers, estimates)
+    })
+
+def _queue_estimate_fields(queue_position: Optional[int], estimated_wait: Optional[float]) -> dict:
+    """
+    queuePosition is the number of tasks before the task (0 if it is the next one), and
+    estimatedWait the seconds until it is expected to start. Both are None if the task
+    is not queued; estimatedWait is also None if there is no estimation yet.
+    """
+    if estimated_wait is None:
+        estimated_start_time = None
+    else:
+        estimated_start_time = (datetime.now() + timedelta(seconds=estimated_wait)).isoformat()
+    return dict(queuePosition=queue_position, estimatedWait=estimated_wait, estimatedStartTime=estimated_start_time)
+
 @scheduler_blueprint.route('/user/error-messages/<user_id>', methods=['GET'])
 def user_get_errors(user_id):
     authenticated = check_backend_credentials()
     if not authenticated:
         return jsonify(success=False, ids=None, errors=None), 401
 
-    task_id = []
-    error_messages = []
-    error_times = []
-
-    for t in redis_store.smembers(TaskKeys.tasks()):
-        if redis_store.hget(TaskKeys.identifier(t), TaskKeys.author) == user_id and redis_store.hget(TaskKeys.identifier(t), TaskKeys.errorMessage) != "null":
-            task_id.append(redis_store.hget(TaskKeys.identifier(t), TaskKeys.uniqueIdentifier))
-            error_messages.append(redis_store.hget(TaskKeys.identifier(t), TaskKeys.errorMessage))
-            error_times.append(redis_store.hget(TaskKeys.identifier(t), TaskKeys.errorTime))
-    for v in redis_store.smembers(ErrorKeys.errors()):
-        if redis_store.hget(ErrorKeys.identifier(v), ErrorKeys.author) == user_id and redis_store.hget(ErrorKeys.identifier(v), ErrorKeys.errorMessage) != "null":
-            task_id.append(redis_store.hget(ErrorKeys.identifier(v), ErrorKeys.uniqueIdentifier))
-            error_messages.append(redis_store.hget(ErrorKeys.identifier(v), ErrorKeys.errorMessage))
-            error_times.append(redis_store.hget(ErrorKeys.identifier(v), ErrorKeys.errorTime))       
-
-    sorted_times = np.argsort([datetime.strptime(x, '%Y-%m-%dT%H:%M:%S.%f') for x in error_times])
-    most_recent = sorted(range(len(sorted_times)), key=lambda i: sorted_times[i])[-5:]
-
-    new_task_id = []
-    new_error_messages = []
-    for i in most_recent:
-            new_task_id.append(task_id[i])
-            new_error_messages.append(error_messages[i])
-    return jsonify(success=True, ids=new_task_id, errors=new_error_messages)
-
-def mark_as_poll(task_id):
-    if redis_store.hget(TaskKeys.identifier(task_id), TaskKeys.uniqueIdentifier) is not None:
-        pipeline = redis_store.pipeline()
-        pipeline.hset(TaskKeys.identifier(task_id), TaskKeys.inactiveSince, str(time.time()))
-        pipeline.execute()
+    errors = get_latest_errors(user_id)
+    return jsonify(success=True, ids=[ task_id for task_id, _ in errors ], errors=[ error_message for _, error_message in errors ])
 
 @scheduler_blueprint.route('/user/tasks/', methods=['POST'])
 def user_create_task():
@@ -144,50 +303,28 @@ def user_create_task():
 
     session_id = request_data.get('session_id')
 
-    task_identifier = secrets.token_urlsafe()
-    while redis_store.sadd(TaskKeys.tasks(), task_identifier) == 0:
-        task_identifier = secrets.token_urlsafe()
+    tasks = get_task_store()
+    task_identifier = tasks.reserve_identifier()
 
     grc_files = request_data.get('grc_files')
     user_id = request_data.get('user_id')
     if not grc_files:
-        pipeline = redis_store.pipeline()
-        pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.uniqueIdentifier, task_identifier)
-        pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.author, user_id)
-        pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.errorMessage, "No grc_files provided")
-        pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.errorTime, datetime.now().isoformat())
-        result = pipeline.execute()
+        store_error(task_identifier, user_id, "No grc_files provided")
         return jsonify(success=False, taskIdentifier=None, status=None, message="No grc_files provided")
 
     for grc_file_type in ('receiver', 'transmitter'):
         grc_file_data = grc_files.get(grc_file_type)
         if not grc_file_data:
-            pipeline = redis_store.pipeline()
-            pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.uniqueIdentifier, task_identifier)
-            pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.author, user_id)
-            pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.errorMessage, f"No {grc_file_type} found in grc_files")
-            pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.errorTime, datetime.now().isoformat())
-            result = pipeline.execute()
+            store_error(task_identifier, user_id, f"No {grc_file_type} found in grc_files")
             return jsonify(success=False, taskIdentifier=None, status=None, message=f"No {grc_file_type} found in grc_files")
 
         filename = grc_file_data.get('filename')
         if not filename:
-            pipeline = redis_store.pipeline()
-            pipeline.sadd(ErrorKeys.errors(), task_identifier)
-            pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.uniqueIdentifier, task_identifier)
-            pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.author, user_id)
-            pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.errorMessage, f"No filename found in {grc_file_type} in grc_files")
-            pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.errorTime, datetime.now().isoformat())
-            result = pipeline.execute()
+            store_error(task_identifier, user_id, f"No filename found in {grc_file_type} in grc_files")
             return jsonify(success=False, taskIdentifier=None, status=None, message=f"No filename found in {grc_file_type} in grc_files")
         content = grc_file_data.get('content')
         if not content:
-            pipeline = redis_store.pipeline()
-            pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.uniqueIdentifier, task_identifier)
-            pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.author, user_id)
-            pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.errorMessage, f"No content found in {grc_file_type} in grc_files")
-            pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.errorTime, datetime.now().isoformat())
-            result = pipeline.execute()
+            store_error(task_identifier, user_id, f"No content found in {grc_file_type} in grc_files")
             return jsonify(success=False, taskIdentifier=None, status=None, message=f"No content found in {grc_file_type} in grc_files")
 
         file_type = grc_file_data.get('type')
@@ -195,90 +332,49 @@ def user_create_task():
             try:
                 yaml.safe_load(content)
             except Exception as err:
-                pipeline = redis_store.pipeline()
-                pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.uniqueIdentifier, task_identifier)
-                pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.author, user_id)
-                pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.errorMessage, f"Invalid content (not yaml) for provided {grc_file_type}")
-                pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.errorTime, datetime.now().isoformat())
-                result = pipeline.execute()
+                store_error(task_identifier, user_id, f"Invalid content (not yaml) for provided {grc_file_type}")
                 return jsonify(success=False, taskIdentifier=None, status=None, message=f"Invalid content (not yaml) for provided {grc_file_type}")
             # in the future we might check more things about the .grc files
 
-    # We have checked the data, so we can now do:
-    transmitter_filename = grc_files['transmitter']['filename']
-    transmitter_file = grc_files['transmitter']['content']
-    transmitter_file_type = grc_files['transmitter']['type']
-    receiver_filename = grc_files['receiver']['filename']
-    receiver_file = grc_files['receiver']['content']
-    receiver_file_type = grc_files['receiver']['type']
-
-    # Load into Redis
-    # We rely on a set to know which keys have been added and are unique.
-    # The key means that there has been an attempt to create the key, it does not
-    # mean that the key is currently active (and might need to be cleaned)
-
-    t = TaskKeys.identifier(task_identifier)
-    pipeline = redis_store.pipeline()
-    pipeline.hset(t, TaskKeys.uniqueIdentifier, task_identifier)
-    pipeline.hset(t, TaskKeys.author, user_id)
-    pipeline.hset(t, TaskKeys.transmitterFilename, transmitter_filename)
-    pipeline.hset(t, TaskKeys.transmitterFile, transmitter_file)
-    pipeline.hset(t, TaskKeys.receiverFilename, receiver_filename)
-    pipeline.hset(t, TaskKeys.receiverFile, receiver_file)
-    pipeline.hset(t, TaskKeys.sessionId, session_id)
-    pipeline.hset(t, TaskKeys.startedTime, datetime.now().isoformat())
-    pipeline.hset(t, TaskKeys.priority, str(priority))
-    pipeline.hset(t, TaskKeys.transmitterAssigned, "null")
-    pipeline.hset(t, TaskKeys.receiverAssigned, "null")
-    pipeline.hset(t, TaskKeys.transmitterProcessingStart, "null")
-    pipeline.hset(t, TaskKeys.receiverProcessingStart, "null")
-    pipeline.hset(t, TaskKeys.status, TaskKeys.Status.queued)
-    pipeline.hset(t, TaskKeys.errorMessage, "null")
-    pipeline.hset(t, TaskKeys.errorTime, "null")
-    pipeline.hset(t, TaskKeys.localTimeRemaining, "0")
-    pipeline.hset(t, TaskKeys.inactiveSince, str(time.time()))
-    pipeline.hset(t, TaskKeys.transmitterFiletype, transmitter_file_type)
-    pipeline.hset(t, TaskKeys.receiverFiletype, receiver_file_type)
-
-    # Add to the corresponding bucket queue the task identifier
-    pipeline.lpush(TaskKeys.priority_queue(priority), task_identifier)
-    pipeline.zadd(TaskKeys.priorities(), { str(priority): priority })
-
-    result = pipeline.execute()
-
+    # We have checked the data, so we can now store it in Redis, and add it to
+    # the corresponding bucket queue.
+    tasks.create(Task(
+        identifier=task_identifier,
+        author=user_id,
+        transmitter_filename=grc_files['transmitter']['filename'],
+        transmitter_filetype=grc_files['transmitter']['type'],
+        receiver_filename=grc_files['receiver']['filename'],
+        receiver_filetype=grc_files['receiver']['type'],
+        session_id=session_id,
+        started_time=datetime.now().isoformat(),
+        priority=priority,
+        transmitter_assigned="null",
+        receiver_assigned="null",
+        transmitter_processing_start="null",
+        receiver_processing_start="null",
+        status=TaskKeys.Status.queued,
+        error_message="null",
+        error_time="null",
+        local_time_remaining="0",
+        inactive_since=time.time(),
+    ), transmitter_file=grc_files['transmitter']['content'], receiver_file=grc_files['receiver']['content'])
+
+    # The devices seen are in /scheduler/devices/available, not logged here since
+    # loading them takes more round-trips than creating the task
     logger.warning(f"Task {task_identifier} queued with priority {priority} created for user {user_id}")
-    logger.warning("Last time we saw each device:")
-    for device_name, device_data in _available_devices_last_check().items():
-        logger.warning(f" - {device_name}: {device_data}.")
-        
-    logger.warning("-")
-     
     return jsonify(success=True, taskIdentifier=task_identifier, status='queued', message="Loading successful")
 
 @scheduler_blueprint.route('/user/tasks/<task_identifier>', methods=['POST'])
 def user_delete_task(task_identifier):
     request_data = request.get_json(silent=True, force=True)
     if request_data.get('action') == "delete":
-        t = TaskKeys.identifier(task_identifier)
-        priority = redis_store.hget(t, TaskKeys.priority)
-        if priority == None:
-            pipeline = redis_store.pipeline()
-            pipeline.sadd(ErrorKeys.errors(), task_identifier)
-            pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.uniqueIdentifier, task_identifier)
-            pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.author, "unknown")
-            pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.errorMessage, "Task identifier does not exist")
-            pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.errorTime, datetime.now().isoformat())
-            results = pipeline.execute()
+        tasks = get_task_store()
+        task = tasks.get(task_identifier, 'receiver_assigned', 'priority', 'device_assigned', 'author', 'session_id')
+        if task is None:
+            store_error(task_identifier, "unknown", "Task identifier does not exist")
             return jsonify(success=False, message="Invalid task identifier")
 
-        redis_store.hset(t, TaskKeys.status, TaskKeys.Status.deleted)
-        if redis_store.hget(t, TaskKeys.status) == TaskKeys.Status.queued:
-            task_identifier = redis_store.rpop(TaskKeys.priority_queue(redis_store.hget(t, TaskKeys.priority)))
-        if redis_store.hget(t, TaskKeys.receiverAssigned) != "null":
-            device_base = redis_store.hget(t, TaskKeys.receiverAssigned).split(':')[0]
-            redis_store.set(DeviceKeys.device_assignment(device_base), "null")
-        redis_store.lrem(TaskKeys.priority_queue(int(priority)), 1, task_identifier)      
-        redis_store.srem(TaskKeys.tasks(), task_identifier)
+        tasks.delete(task)
   
     return jsonify(success=True, message="Successfully deleted")
 
@@ -304,94 +400,40 @@ def devices_get_task_status(type, task_identifier):
 
     device_base: str = device.split(':')[0]
 
-    t = TaskKeys.identifier(task_identifier)
-    author = redis_store.hget(t, TaskKeys.author)
-    if author is None:
-        pipeline = redis_store.pipeline()
-        pipeline.sadd(ErrorKeys.errors(), task_identifier)
-        pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.uniqueIdentifier, task_identifier)
-        pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.author, "None")
-        pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.errorMessage, "Task identifier does not exist")
-        pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.errorTime, datetime.now().isoformat())
-        results = pipeline.execute()
+    # in 10 seconds without any poll from the student, we delete the session to allow someone else to use the lab
+    stopped_task = get_task_store().stop_if_inactive(device_base, task_identifier, 'status', 'receiver_assigned', 'transmitter_assigned', 'session_id')
+    if stopped_task is None:
+        store_error(task_identifier, "None", "Task identifier does not exist")
         return jsonify(success=False, status=None, receiver=None, transmitter=None, session_id=None, message="Task identifier does not exist")
 
-    _stop_task_if_inactive(device_base, task_identifier)
+    _, task = stopped_task
     return jsonify(
         success=True, 
-        status=redis_store.hget(t, TaskKeys.status), 
-        receiver=redis_store.hget(t, TaskKeys.receiverAssigned), 
-        transmitter=redis_store.hget(t, TaskKeys.transmitterAssigned), 
-        session_id=redis_store.hget(t, TaskKeys.sessionId), 
+        status=task.status, 
+        receiver=task.receiver_assigned, 
+        transmitter=task.transmitter_assigned, 
+        session_id=task.session_id, 
         message="Success"
     )
 
-
 def _complete_device_task_impl(device_base: str, type: str, task_identifier: str) -> dict:
-    t = TaskKeys.identifier(task_identifier)
-    status_msg = TaskKeys.Status.error
-    if type == "receiver":
-        if redis_store.hget(t, TaskKeys.status) == TaskKeys.Status.receiver_assigned or redis_store.hget(t, TaskKeys.status) == TaskKeys.Status.receiver_still_processing:
-            status_msg = TaskKeys.Status.completed
-        elif redis_store.hget(t, TaskKeys.status) == TaskKeys.Status.fully_assigned:
-            status_msg = TaskKeys.Status.transmitter_still_processing
-        pipeline = redis_store.pipeline()
-        if status_msg != TaskKeys.Status.error:
-            pipeline.hset(t, TaskKeys.status, status_msg)
-        pipeline.set(DeviceKeys.device_assignment(device_base), "null")
-        results = pipeline.execute()
-    if type == "transmitter":
-        if redis_store.hget(t, TaskKeys.status) == TaskKeys.Status.fully_assigned:
-            redis_store.hset(t, TaskKeys.status, TaskKeys.Status.receiver_still_processing)
-            status_msg = TaskKeys.Status.receiver_still_processing
-        elif redis_store.hget(t, TaskKeys.status) == TaskKeys.Status.transmitter_still_processing:
-            redis_store.hset(t, TaskKeys.status, TaskKeys.Status.completed)
-            status_msg = TaskKeys.Status.completed
+    status_msg = scripts.complete_task(device_base, type, task_identifier)
     return {
         'success': True, 
         'status': status_msg, 
         'message': "Completed",
     }
 
-def _stop_task_if_inactive(device_base: str, task_id: str) -> bool:
-    """
-    Check if the user has not polled in a while, and then remove the task from the receiver and transmitter if that's the case.
-
-    We return if the task is stopped.
-    """
-    inactive_since = redis_store.hget(TaskKeys.identifier(task_id), TaskKeys.inactiveSince)
-    if inactive_since is not None: # i.e., the task still exists
-        current_app.logger.info(inactive_since)
-        inactive_since_timestamp = float(inactive_since)
-        elapsed = time.time() - inactive_since_timestamp
-        # in 10 seconds without any poll from the student, we delete the session to allow someone else to use the lab
-        if elapsed > current_app.config['MAX_TIME_WITHOUT_POLLING']:
-            _complete_device_task_impl(device_base, "receiver", task_id)
-            _complete_device_task_impl(device_base, "transmitter", task_id)
-            return True
-    return False
-
 def _available_devices_last_check() -> Dict[str, Dict[str, str]]:
     """
     Return the device names and the last time they were seen
     """
-    now = datetime.utcnow()
-    device_keys = sorted(list(redis_store.keys(DeviceKeys("*").last_check())))
-    device_names = [ ':'.join(device_key.split(':')[-3:-1]) for device_key in device_keys ]
-    pipeline = redis_store.pipeline()
-    for device in device_keys:
-        pipeline.get(device)
-    
+    now = time.time()
     device_data = OrderedDict()
-    for device_name, last_check in zip(device_names, pipeline.execute()):
-        if last_check:
-            last_check_human = f"{(now - datetime.fromisoformat(last_check)).total_seconds()} seconds ago"
-        else:
-            last_check_human = "Unknown number of seconds ago"
-
+    for device_name, last_check, assignment in get_device_store().get_last_checks():
         device_data[device_name] = {
-            "last_check": last_check_human,
-            "assignment": redis_store.get(DeviceKeys.device_assignment(device_name.split(':')[0])),
+            "last_check": f"{now - last_check} seconds ago",
+            "assignment": assignment,
         }
     return device_data
 
@@ -400,6 +442,68 @@ def available_devices():
     device_data = _available_devices_last_check()
     return json.dumps(dict(success=True, device_data=device_data), indent=4), 200, {"Content-Type": "application/json"}
 
+@scheduler_blueprint.route('/metrics')
+def scheduler_metrics():
+    """
+    Metrics of this worker in the Prometheus text format (see reliascheduler/metrics.py)
+    """
+    metrics = get_metrics()
+    if metrics is None:
+        return Response("Metrics disabled (METRICS_ENABLED)\n", status=404, mimetype='text/plain')
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+class DeviceWait:
+    """
+    What an assignment generator (see assign_receiver_steps) is waiting for: a queued task
+    (device_base is None) or the handoff of the receiver of device_base, for up to timeout
+    seconds. The runner sends back the sequence number of the task queued or the task
+    identifier of the handoff, or None if timeout expires.
+    """
+    __slots__ = ('device_base', 'timeout')
+
+    def __init__(self, device_base: Optional[str], timeout: float):
+        self.device_base = device_base
+        self.timeout = timeout
+
+    def wait(self) -> Optional[str]:
+        if self.device_base is None:
+            return get_task_store().wait_for_queued_task(self.timeout)
+        return get_device_store().wait_for_handoff(self.device_base, self.timeout)
+
+    async def wait_async(self, async_redis) -> Optional[str]:
+        if self.device_base is None:
+            return await get_task_store().wait_for_queued_task_async(async_redis, self.timeout)
+        return await get_device_store().wait_for_handoff_async(async_redis, self.device_base, self.timeout)
+
+# (response fields, status code)
+DeviceResponse = Tuple[dict, int]
+
+def run_device_steps(steps: Generator[DeviceWait, Optional[str], DeviceResponse]):
+    """
+    Run an assignment generator blocking the thread in the waits, and return the response
+    """
+    try:
+        device_wait = next(steps)
+        while True:
+            device_wait = steps.send(device_wait.wait())
+    except StopIteration as stop:
+        fields, status_code = stop.value
+        return jsonify(**fields), status_code
+
+def _get_max_seconds_waiting() -> int:
+    try:
+        max_seconds_waiting = int(request.args.get('max_seconds') or '25')
+    except:
+        max_seconds_waiting = 25
+
+    return max(min(max_seconds_waiting, 25), 1)
+
+def _assignment_fields(assignment: Optional[List[str]]) -> dict:
+    if assignment is None:
+        return dict(success=True, file=None, fileContent=None, taskIdentifier=None, sessionIdentifier=None, message="No tasks in queue")
+
+    task_identifier, filename, file_content, session_identifier, filetype = assignment
+    return dict(success=True, file=filename, fileContent=file_content, sessionIdentifier=session_identifier, filetype=filetype, taskIdentifier=task_identifier, maxTime=current_app.config['MAX_TIME_RUNNING'], message="Successfully assigned")
 
 @scheduler_blueprint.route('/devices/tasks/receiver')
 def devices_assign_task_primary():
@@ -407,82 +511,62 @@ def devices_assign_task_primary():
     Assign a task to the receiver. The receiver is the primary device: only once the receiver has received a taks, the transmitter
     gets the task.
     """
+    return run_device_steps(assign_receiver_steps())
+
+def assign_receiver_steps() -> Generator[DeviceWait, Optional[str], DeviceResponse]:
+    """
+    The logic of devices_assign_task_primary, as a generator that yields what it is waiting
+    for, so it can also be run without blocking a thread by reliascheduler.asgi
+    """
     device = check_device_credentials()
     if device is None:
-        return jsonify(success=False, file=None, fileContent=None, taskIdentifier=None, sessionIdentifier=None, message="Invalid device credentials"), 401
+        return dict(success=False, file=None, fileContent=None, taskIdentifier=None, sessionIdentifier=None, message="Invalid device credentials"), 401
     
-    redis_store.setex(DeviceKeys(device).last_check(), 24 * 3600, datetime.utcnow().isoformat())
+    tasks = get_task_store()
+    devices = get_device_store()
+    devices.mark_as_seen(device)
 
     device_base = device.split(':')[0]
     max_time_running = current_app.config['MAX_TIME_RUNNING']
-    task_identifier = redis_store.get(DeviceKeys.device_assignment(device_base))
-    if task_identifier and task_identifier != "null":
-        user_id = redis_store.hget(TaskKeys.identifier(task_identifier), TaskKeys.author)
-        receiver_processing_start = redis_store.hget(TaskKeys.identifier(task_identifier), TaskKeys.receiverProcessingStart)
-        time_elapsed_since_procsesing_start = (datetime.now() - datetime.fromisoformat(receiver_processing_start)).total_seconds()
-        if time_elapsed_since_procsesing_start < max_time_running:
-            return jsonify(success=False, file=None, fileContent=None, taskIdentifier=None, sessionIdentifier=None, message="Device in use")
+    task_identifier = devices.get_assignment(device_base)
+    if task_identifier is not None:
+        task = tasks.get(task_identifier, 'author', 'receiver_processing_start', 'priority', 'device_assigned')
+        if task is not None and (datetime.now() - datetime.fromisoformat(task.receiver_processing_start)).total_seconds() < max_time_running:
+            return dict(success=False, file=None, fileContent=None, taskIdentifier=None, sessionIdentifier=None, message="Device in use"), 200
         else:
             pipeline = redis_store.pipeline()
-            pipeline.hset(TaskKeys.identifier(task_identifier), TaskKeys.status, TaskKeys.Status.completed)
-            pipeline.set(DeviceKeys.device_assignment(device_base), "null")
-            pipeline.sadd(ErrorKeys.errors(), task_identifier)
-            pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.uniqueIdentifier, task_identifier)
-            pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.author, user_id)
-            pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.errorMessage, "Receiver side: task timed out")
-            pipeline.hset(ErrorKeys.identifier(task_identifier), ErrorKeys.errorTime, datetime.now().isoformat())
-            results = pipeline.execute()
-    try:
-        max_seconds_waiting = int(request.args.get('max_seconds') or '25')
-    except:
-        max_seconds_waiting = 25
-
-    max_seconds_waiting = max(min(max_seconds_waiting, 25), 1)
-
-    task_identifier = None
-    maximum_time = time.time() + max_seconds_waiting
-
-    # Enter in a loop for 25 seconds trying to get a task. If there is a task,
-    # return it immediately. If there is no task, keep trying until there is
-    # a task or 25 seconds have elapsed
-    while task_identifier is None and time.time() <= maximum_time:
-
-        # Check the active priority queues, one by one, in priority, and if we
-        # find a task, then assign it
-        for priority in redis_store.zrange(TaskKeys.priorities(), 0, -1):
-            task_identifier = redis_store.rpop(TaskKeys.priority_queue(priority))
-            if _stop_task_if_inactive(device_base, task_identifier):
-                task_identifier = None
-            if task_identifier is not None:
-                break
-
-        if task_identifier is None:
-            time.sleep(0.1)
-
-    if task_identifier is None:
-        return jsonify(success=True, file=None, fileContent=None, taskIdentifier=None, sessionIdentifier=None, message="No tasks in queue")
-        
-    # at this point, there is a task, which was the next task taking into account
-    # priority and FIFO.
-    pipeline = redis_store.pipeline()
-    t = TaskKeys.identifier(task_identifier)
-    pipeline.hget(t, TaskKeys.receiverFilename)
-    pipeline.hget(t, TaskKeys.receiverFile)
-    pipeline.hget(t, TaskKeys.sessionId)
-    pipeline.hget(t, TaskKeys.receiverFiletype)
-    pipeline.hset(t, TaskKeys.receiverAssigned, device)
-    pipeline.hset(t, TaskKeys.deviceAssigned, device_base)
-    pipeline.hset(t, TaskKeys.status, TaskKeys.Status.receiver_assigned)
-    pipeline.set(DeviceKeys.device_assignment(device_base), task_identifier)
-    results = pipeline.execute()
-
-    redis_store.hset(t, TaskKeys.receiverProcessingStart, datetime.now().isoformat())
-    session_key = f'relia:data-uploader:sessions:{redis_store.hget(t, TaskKeys.sessionId)}:devices'
-    redis_store.sadd(session_key, device)
-
-    logger.warning(f"Task {task_identifier} assigned to setup {device_base}")
-
-    return jsonify(success=True, file=results[0], fileContent=results[1], sessionIdentifier=results[2], filetype=results[3], taskIdentifier=task_identifier, maxTime=max_time_running, message="Successfully assigned")
+            if task is not None:
+                tasks.update(task_identifier, status=TaskKeys.Status.completed, reason='timeout', task=task, pipeline=pipeline)
+                store_error(task_identifier, task.author, "Receiver side: task timed out", pipeline=pipeline)
+            devices.release(device_base, pipeline=pipeline)
+            pipeline.execute()
+
+    maximum_time = time.time() + _get_max_seconds_waiting()
+
+    # The assign_receiver script pops the next task (in priority and FIFO
+    # order), skips those whose user is not polling anymore and assigns it,
+    # all in a single atomic call. If there is nothing queued, block in Redis
+    # for up to 25 seconds until user_create_task queues a task, so idle
+    # receivers do not generate any traffic while waiting. The wait only wakes
+    # up the receiver: the task is popped by the script, so it is not lost if
+    # the receiver goes away in between (and another receiver may get it first).
+    assignment = scripts.assign_receiver(device)
+    while assignment is None:
+        remaining_time = maximum_time - time.time()
+        if remaining_time <= 0:
+            break
+
+        if (yield DeviceWait(None, remaining_time)) is None:
+            break
+
+        assignment = scripts.assign_receiver(device)
+
+    if assignment is not None:
+        # at this point, there is a task, which was the next task taking into account
+        # priority and FIFO.
+        logger.warning(f"Task {assignment[0]} assigned to setup {device_base}")
+
+    return _assignment_fields(assignment), 200
 
 @scheduler_blueprint.route('/devices/tasks/transmitter')
 def devices_assign_task_secondary():
@@ -490,60 +574,41 @@ def devices_assign_task_secondary():
     Assign a task to the transmitter. The transmitter is the secondary device: it waits until the receiver
     is assigned a task to be assigned a task.
     """
+    return run_device_steps(assign_transmitter_steps())
+
+def assign_transmitter_steps() -> Generator[DeviceWait, Optional[str], DeviceResponse]:
+    """
+    The logic of devices_assign_task_secondary, as a generator (see assign_receiver_steps)
+    """
     device = check_device_credentials()
     if device is None:
-        return jsonify(success=False, file=None, fileContent=None, taskIdentifier=None, sessionIdentifier=None, message="Invalid device credentials"), 401
+        return dict(success=False, file=None, fileContent=None, taskIdentifier=None, sessionIdentifier=None, message="Invalid device credentials"), 401
 
-    redis_store.setex(DeviceKeys(device).last_check(), 24 * 3600, datetime.utcnow().isoformat())
+    devices = get_device_store()
+    devices.mark_as_seen(device)
 
     device_base = device.split(':')[0]
-    max_time_running = current_app.config['MAX_TIME_RUNNING']
-    try:
-        max_seconds_waiting = int(request.args.get('max_seconds') or '25')
-    except:
-        max_seconds_waiting = 25
-
-    max_seconds_waiting = max(min(max_seconds_waiting, 25), 1)
-
-    task_identifier = None
-    maximum_time = time.time() + max_seconds_waiting
-
-    # Enter in a loop for 25 seconds trying to get a task. If there is a task,
-
-    # return it immediately. If there is no task, keep trying until there is
-    # a task or 25 seconds have elapsed
-    while task_identifier is None and time.time() <= maximum_time:
-
-        task_identifier = redis_store.get(DeviceKeys.device_assignment(device_base))
-        if task_identifier is not None:
-            t = TaskKeys.identifier(task_identifier)
-            if redis_store.hget(t, TaskKeys.status) != TaskKeys.Status.receiver_assigned:
-                task_identifier = None
-            if task_identifier is not None:
-                if _stop_task_if_inactive(device_base, task_identifier):
-                    task_identifier = None
-
+    maximum_time = time.time() + _get_max_seconds_waiting()
+
+    # First try to take the task currently assigned to the receiver. If there
+    # is none, block for up to 25 seconds on the handoff list, where the
+    # receiver assignment pushes the task identifier. Anything pushed in
+    # between stays in the list, so no handoff is lost. The assign_transmitter
+    # script checks that the task is still waiting for the transmitter (the
+    # handoff might be outdated) and assigns it in a single atomic call.
+    assignment = scripts.assign_transmitter(device)
+    while assignment is None:
+        remaining_time = maximum_time - time.time()
+        if remaining_time <= 0:
+            break
+
+        task_identifier = yield DeviceWait(device_base, remaining_time)
         if task_identifier is None:
-            time.sleep(0.1)
+            break
 
-    if task_identifier is None:
-        return jsonify(success=True, file=None, fileContent=None, taskIdentifier=None, sessionIdentifier=None, message="No tasks in queue")  
+        assignment = scripts.assign_transmitter(device, task_identifier)
 
-    # Store in Redis that the transmitter has been assigned and return the task information to the user
-    pipeline = redis_store.pipeline()
-    t = TaskKeys.identifier(task_identifier)
-    pipeline.hget(t, TaskKeys.transmitterFilename)
-    pipeline.hget(t, TaskKeys.transmitterFile)
-    pipeline.hget(t, TaskKeys.sessionId)
-    pipeline.hget(t, TaskKeys.transmitterFiletype)
-    pipeline.hset(t, TaskKeys.transmitterAssigned, device)
-    pipeline.hset(t, TaskKeys.status, TaskKeys.Status.fully_assigned)
-    results = pipeline.execute()
-
-    redis_store.hset(t, TaskKeys.transmitterProcessingStart, datetime.now().isoformat())
-    session_key = f'relia:data-uploader:sessions:{redis_store.hget(t, TaskKeys.sessionId)}:devices'
-    redis_store.sadd(session_key, device)
-    return jsonify(success=True, file=results[0], fileContent=results[1], sessionIdentifier=results[2], filetype=results[3], taskIdentifier=task_identifier, maxTime=max_time_running, message="Successfully assigned")
+    return _assignment_fields(assignment), 200
 
 @scheduler_blueprint.route('/devices/tasks/error_message/<task_identifier>', methods=['POST'])
 def devices_assign_error_message(task_identifier):
@@ -553,7 +618,13 @@ def devices_assign_error_message(task_identifier):
 
     request_data = request.get_json(silent=True, force=True)
 
-    t = TaskKeys.identifier(task_identifier)
-    redis_store.hset(t, TaskKeys.errorMessage, request_data.get('errorMessage'))
-    redis_store.hset(t, TaskKeys.errorTime, request_data.get('errorTime'))
+    tasks = get_task_store()
+    task = tasks.get(task_identifier, 'author', 'priority')
+    author = task.author if task is not None else None
+    pipeline = redis_store.pipeline()
+    tasks.update(task_identifier, error_message=request_data.get('errorMessage'), error_time=request_data.get('errorTime'), pipeline=pipeline)
+    index_error(author, tasks.keys.task(task_identifier), pipeline=pipeline)
+    if task is not None:
+        tasks.add_event(task_identifier, ERROR_MESSAGE_EVENT, task=task, device=device, pipeline=pipeline)
+    pipeline.execute()
     return jsonify(success=True, message="Success")
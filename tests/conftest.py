@@ -0,0 +1,64 @@
+"""
+Fixtures shared by the tests: an application backed by fakeredis (with Lua) and
+the helpers to create tasks and to authenticate the devices
+"""
+import os
+import sys
+import hashlib
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+os.environ.update({
+    'BASE_KEY': 'relia-test',
+    'BACKGROUND_THREADS_ENABLED': '0',
+    'USE_FAKE_USERS': '0',
+    'DEVICE_CREDENTIALS_FILENAME': os.path.join(tempfile.gettempdir(), 'relia-test-credentials.json'),
+})
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from reliascheduler import create_app, redis_store
+from reliascheduler.keys import DeviceKeys
+from reliascheduler.metrics import instrumented
+
+BACKEND_HEADERS = { 'relia-secret': 'password' }
+DEVICE_PASSWORD = 'password'
+DEVICES = [ 'uw-s1i1', 'uw-s1i2' ]
+
+@pytest.fixture
+def app():
+    redis_store.provider_class = instrumented(fakeredis.FakeStrictRedis)
+    app = create_app('development')
+    with app.app_context():
+        redis_store.flushall()
+        salt = 'abcdef'
+        for device_base in DEVICES:
+            redis_store.hset(DeviceKeys.credentials(), device_base, salt + '$' + hashlib.sha512((salt + DEVICE_PASSWORD).encode()).hexdigest())
+        redis_store.incr(DeviceKeys.credentials_version())
+    return app
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def create_task(client):
+    """
+    Create a task through the API and return its identifier
+    """
+    def create(user_id: str = 'user', priority: int = 5, session_id: str = 'session', content: str = 'a: 1') -> str:
+        response = client.post('/scheduler/user/tasks/', headers=BACKEND_HEADERS, json={
+            'grc_files': {
+                'receiver': { 'filename': 'receiver.grc', 'content': content, 'type': 'grc' },
+                'transmitter': { 'filename': 'transmitter.grc', 'content': content + '\nb: 2', 'type': 'grc' },
+            },
+            'priority': priority, 'session_id': session_id, 'user_id': user_id,
+        })
+        return response.get_json()['taskIdentifier']
+    return create
+
+def device_headers(device: str) -> dict:
+    return { 'relia-device': device, 'relia-password': DEVICE_PASSWORD }
@@ -0,0 +1,20 @@
+"""
+Creation of the app
+"""
+import pytest
+import fakeredis
+
+from config import configurations
+from reliascheduler import create_app, redis_store
+from reliascheduler.metrics import instrumented
+
+@pytest.mark.parametrize('enabled', [ False, True ])
+def test_background_threads(monkeypatch, enabled):
+    started = []
+    for module, function in (('collector', 'start_garbage_collector'), ('archive', 'start_archiver'), ('reaper', 'start_reaper')):
+        monkeypatch.setattr(f'reliascheduler.{module}.{function}', lambda app, function=function: started.append(function))
+    monkeypatch.setattr(configurations['development'], 'BACKGROUND_THREADS_ENABLED', enabled)
+
+    redis_store.provider_class = instrumented(fakeredis.FakeStrictRedis)
+    create_app('development')
+    assert started == ([ 'start_garbage_collector', 'start_archiver', 'start_reaper' ] if enabled else [])
@@ -0,0 +1,70 @@
+"""
+Archive of the finished tasks in segment files, and the lookups that fall back to it
+(reliascheduler/archive.py)
+"""
+import os
+
+import pytest
+
+from conftest import BACKEND_HEADERS, device_headers
+from reliascheduler import redis_store
+from reliascheduler.archive import TaskArchive, archive_finished_tasks, get_archive, init_archive
+from reliascheduler.keys import FileKeys, TaskKeys
+from reliascheduler.schema import get_key_schema
+
+SEGMENT_SIZE = 600
+
+@pytest.fixture
+def archive_app(app, tmp_path):
+    app.config['ARCHIVE_DIRECTORY'] = str(tmp_path / 'archive')
+    app.config['ARCHIVE_SEGMENT_SIZE'] = SEGMENT_SIZE
+    init_archive(app)
+    return app
+
+def _run(client, create_task, content: str) -> str:
+    task_identifier = create_task(content=content)
+    for type in ('receiver', 'transmitter'):
+        client.get(f'/scheduler/devices/tasks/{type}?max_seconds=1', headers=device_headers(f'uw-s1i1:{type[0]}'))
+    for type in ('transmitter', 'receiver'):
+        client.post(f'/scheduler/devices/tasks/{type}/{task_identifier}', headers=device_headers(f'uw-s1i1:{type[0]}'))
+    return task_identifier
+
+def test_finished_tasks_archived(archive_app, client, create_task):
+    finished = [ _run(client, create_task, f'a: {i}') for i in range(4) ]
+    queued = create_task(content='a: queued')
+
+    with archive_app.app_context():
+        keys = get_key_schema()
+        assert archive_finished_tasks(after=3600) == 0
+        assert archive_finished_tasks(after=0) == 4
+        assert archive_finished_tasks(after=0) == 0
+
+        # Only the queued task is left in Redis, with its files
+        assert redis_store.smembers(keys.tasks) == { queued }
+        assert redis_store.exists(*[ keys.task(task_identifier) for task_identifier in finished ]) == 0
+        assert len(redis_store.keys(FileKeys.file('*'))) == 2
+
+        mapping = get_archive().get_mapping(finished[1])
+        assert mapping[TaskKeys.status] == TaskKeys.Status.completed
+        assert (mapping[TaskKeys.receiverFile], mapping[TaskKeys.transmitterFile]) == ('a: 1', 'a: 1\nb: 2')
+        assert TaskKeys.receiverFileDigest not in mapping
+        assert get_archive().get('unknown') is None
+
+def test_lookups_fall_back_to_the_archive(archive_app, client, create_task):
+    finished = []
+    for i in range(6):
+        finished.append(_run(client, create_task, f'a: {i}'))
+        # Archived one by one, so they end up in several segments
+        with archive_app.app_context():
+            assert archive_finished_tasks(after=0) == 1
+    assert len([ filename for filename in os.listdir(archive_app.config['ARCHIVE_DIRECTORY']) if filename.endswith('.index') ]) > 1
+
+    task = client.get(f'/scheduler/user/tasks/{finished[0]}', headers=BACKEND_HEADERS).get_json()
+    assert task['success'] and task['status'] == TaskKeys.Status.completed and task['receiver'] == 'uw-s1i1:r'
+    statuses = client.post('/scheduler/user/tasks/status', headers=BACKEND_HEADERS, json={ 'taskIdentifiers': [ finished[5], 'unknown' ] }).get_json()
+    assert statuses['tasks'][finished[5]]['status'] == TaskKeys.Status.completed
+    assert statuses['tasks']['unknown']['success'] is False
+
+    # e.g. another worker
+    archive = TaskArchive(archive_app.config['ARCHIVE_DIRECTORY'], SEGMENT_SIZE)
+    assert all(archive.get(task_identifier).status == TaskKeys.Status.completed for task_identifier in finished)
@@ -0,0 +1,163 @@
+"""
+Requests served by the ASGI app (reliascheduler/asgi.py), against fakeredis
+"""
+import json
+import asyncio
+
+import pytest
+import fakeredis.aioredis
+
+from conftest import BACKEND_HEADERS, device_headers
+from reliascheduler import asgi
+from reliascheduler.asgi import create_asgi_app
+from reliascheduler.metrics import instrumented
+from reliascheduler.recorder import init_request_recorder, read_trace
+
+@pytest.fixture
+def asgi_app(app, monkeypatch):
+    # The same data as the sync fakeredis client of the app
+    monkeypatch.setattr(asgi, 'create_async_redis', lambda app: instrumented(fakeredis.aioredis.FakeRedis).from_url(app.config['REDIS_URL'], decode_responses=True))
+    return create_asgi_app(app)
+
+@pytest.fixture
+def trace_filename(app, tmp_path):
+    app.config['REQUEST_TRACE_FILENAME'] = str(tmp_path / 'trace.jsonl')
+    init_request_recorder(app)
+    return app.config['REQUEST_TRACE_FILENAME']
+
+def _scope(path: str, headers: dict = BACKEND_HEADERS, query_string: str = '') -> dict:
+    return {
+        'type': 'http', 'method': 'GET', 'path': path,
+        'query_string': query_string.encode(), 'headers': [ (name.encode(), value.encode()) for name, value in headers.items() ],
+        'http_version': '1.1', 'root_path': '',
+    }
+
+def _redis_usage(start: dict) -> dict:
+    header = dict(start['headers'])[b'x-relia-redis'].decode()
+    return dict(item.split('=') for item in header.split('; '))
+
+def _traced(app, filename: str, route: str) -> list:
+    app.extensions['reliascheduler-recorder'].flush(filename)
+    return [ record for record in read_trace(filename) if record['r'] == route ]
+
+def _receive(disconnected: asyncio.Event):
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return { 'type': 'http.request', 'body': b'', 'more_body': False }
+        await disconnected.wait()
+        return { 'type': 'http.disconnect' }
+    return receive
+
+async def _next_event(messages: asyncio.Queue) -> dict:
+    message = await asyncio.wait_for(messages.get(), timeout=10)
+    assert message['type'] == 'http.response.body' and message['more_body']
+    event, data = message['body'].decode().strip().split('\n')
+    assert event == 'event: status'
+    return json.loads(data[len('data: '):])
+
+def test_task_events_stream(asgi_app, client, create_task):
+    task_identifier = create_task()
+
+    async def run():
+        messages: asyncio.Queue = asyncio.Queue()
+        stream = asyncio.create_task(asgi_app(_scope(f'/scheduler/user/tasks/{task_identifier}/events'), _receive(asyncio.Event()), messages.put))
+
+        start = await asyncio.wait_for(messages.get(), timeout=10)
+        assert start['type'] == 'http.response.start' and start['status'] == 200
+        assert (b'content-type', b'text/event-stream; charset=utf-8') in start['headers']
+        assert (await _next_event(messages))['status'] == 'queued'
+
+        assignment = await asyncio.to_thread(lambda: client.get('/scheduler/devices/tasks/receiver?max_seconds=1', headers=device_headers('uw-s1i1:r')).get_json())
+        assert assignment['taskIdentifier'] == task_identifier
+        assert (await _next_event(messages))['status'] == 'receiver-assigned'
+
+        await asyncio.to_thread(lambda: client.post(f'/scheduler/user/tasks/{task_identifier}', headers=BACKEND_HEADERS, json={ 'action': 'delete' }))
+        assert (await _next_event(messages))['status'] == 'deleted'
+        end = await asyncio.wait_for(messages.get(), timeout=10)
+        assert end == { 'type': 'http.response.body', 'body': b'' }
+        await stream
+
+    asyncio.run(run())
+
+def test_task_events_of_unknown_task(asgi_app):
+    async def run():
+        messages: asyncio.Queue = asyncio.Queue()
+        await asyncio.wait_for(asgi_app(_scope('/scheduler/user/tasks/unknown/events'), _receive(asyncio.Event()), messages.put), timeout=10)
+        start, body = messages.get_nowait(), messages.get_nowait()
+        assert start['status'] == 404
+        assert json.loads(body['body'])['success'] is False
+
+    asyncio.run(run())
+
+def test_task_events_streams_do_not_take_threads(app, asgi_app, create_task):
+    task_identifiers = [ create_task() for _ in range(app.config['ASGI_THREADS'] + 1) ]
+
+    async def run():
+        disconnected = asyncio.Event()
+        streams = []
+        for task_identifier in task_identifiers:
+            messages: asyncio.Queue = asyncio.Queue()
+            streams.append(asyncio.create_task(asgi_app(_scope(f'/scheduler/user/tasks/{task_identifier}/events'), _receive(disconnected), messages.put)))
+            assert (await asyncio.wait_for(messages.get(), timeout=10))['status'] == 200
+
+        # With every stream open, the other requests are still served
+        messages = asyncio.Queue()
+        await asyncio.wait_for(asgi_app(_scope(f'/scheduler/user/tasks/{task_identifiers[0]}'), _receive(asyncio.Event()), messages.put), timeout=10)
+        assert messages.get_nowait()['status'] == 200
+        assert json.loads(messages.get_nowait()['body'])['status'] == 'queued'
+
+        # The streams end when the clients disconnect
+        disconnected.set()
+        await asyncio.wait_for(asyncio.gather(*streams), timeout=10)
+
+    asyncio.run(run())
+
+def test_device_long_polls_are_measured_and_recorded(app, asgi_app, create_task, trace_filename):
+    task_identifier = create_task()
+
+    async def run(device: str):
+        messages: asyncio.Queue = asyncio.Queue()
+        scope = _scope('/scheduler/devices/tasks/receiver', device_headers(device), 'max_seconds=1')
+        await asyncio.wait_for(asgi_app(scope, _receive(asyncio.Event()), messages.put), timeout=10)
+        return messages.get_nowait(), json.loads(messages.get_nowait()['body'])
+
+    # Assigned right away, with the sync client
+    start, body = asyncio.run(run('uw-s1i1:r'))
+    assert body['taskIdentifier'] == task_identifier
+    assert int(_redis_usage(start)['commands']) > 0
+
+    # Nothing queued: the wait, in the asyncio client, is counted too
+    start, body = asyncio.run(run('uw-s1i2:r'))
+    assert body['taskIdentifier'] is None
+    assert float(_redis_usage(start)['time'][:-len('ms')]) >= 500
+
+    assert 'route="/scheduler/devices/tasks/receiver"} 2' in app.extensions['reliascheduler-metrics'].render()
+    records = _traced(app, trace_filename, '/scheduler/devices/tasks/receiver')
+    assert [ (record['dev'], record.get('tid')) for record in records ] == [ ('uw-s1i1:r', task_identifier), ('uw-s1i2:r', None) ]
+
+def test_task_events_streams_are_measured_and_recorded(app, asgi_app, create_task, trace_filename):
+    task_identifier = create_task()
+
+    async def run():
+        disconnected = asyncio.Event()
+        messages: asyncio.Queue = asyncio.Queue()
+        stream = asyncio.create_task(asgi_app(_scope(f'/scheduler/user/tasks/{task_identifier}/events'), _receive(disconnected), messages.put))
+        start = await asyncio.wait_for(messages.get(), timeout=10)
+        assert (await _next_event(messages))['status'] == 'queued'
+        disconnected.set()
+        await asyncio.wait_for(stream, timeout=10)
+        return start
+
+    start = asyncio.run(run())
+    assert start['status'] == 200
+    # The subscription and the first poll of the task
+    assert int(_redis_usage(start)['round-trips']) >= 2
+
+    route = '/scheduler/user/tasks/<task_identifier>/events'
+    assert f'route="{route}"}} 1' in app.extensions['reliascheduler-metrics'].render()
+    records = _traced(app, trace_filename, route)
+    assert [ (record['s'], record['a']) for record in records ] == [ (200, { 'task_identifier': task_identifier }) ]
@@ -0,0 +1,93 @@
+"""
+Assignment of the queued tasks to the receivers and handoff to the transmitters
+"""
+import pytest
+
+from conftest import BACKEND_HEADERS, device_headers
+from reliascheduler import redis_store, scripts
+from reliascheduler.keys import TaskKeys
+from reliascheduler.schema import get_key_schema
+from reliascheduler.views.scheduler import assign_receiver_steps, assign_transmitter_steps
+
+def _assign(client, type: str, device: str) -> dict:
+    return client.get(f'/scheduler/devices/tasks/{type}?max_seconds=1', headers=device_headers(device)).get_json()
+
+def _status(client, task_identifier: str) -> str:
+    return client.get(f'/scheduler/user/tasks/{task_identifier}', headers=BACKEND_HEADERS).get_json()['status']
+
+def test_handoff_to_the_transmitter(client, create_task):
+    task_identifier = create_task()
+    assert _assign(client, 'receiver', 'uw-s1i1:r')['taskIdentifier'] == task_identifier
+    # Only the transmitter of the same device gets the task
+    assert _assign(client, 'transmitter', 'uw-s1i2:t')['taskIdentifier'] is None
+    assert _assign(client, 'transmitter', 'uw-s1i1:t')['taskIdentifier'] == task_identifier
+    assert _status(client, task_identifier) == TaskKeys.Status.fully_assigned
+
+def test_transmitter_woken_up_by_the_handoff(app, client, create_task):
+    task_identifier = create_task()
+    with app.test_request_context('/scheduler/devices/tasks/transmitter?max_seconds=5', headers=device_headers('uw-s1i1:t')):
+        steps = assign_transmitter_steps()
+        device_wait = next(steps)
+        assert device_wait.device_base == 'uw-s1i1'
+
+        assert _assign(client, 'receiver', 'uw-s1i1:r')['taskIdentifier'] == task_identifier
+        with pytest.raises(StopIteration) as stop:
+            steps.send(device_wait.wait())
+        fields, _ = stop.value.value
+        assert fields['taskIdentifier'] == task_identifier and fields['fileContent'] == 'a: 1\nb: 2'
+
+def test_outdated_handoff(client, create_task):
+    task_identifier = create_task()
+    assert _assign(client, 'receiver', 'uw-s1i1:r')['taskIdentifier'] == task_identifier
+    client.post(f'/scheduler/user/tasks/{task_identifier}', headers=BACKEND_HEADERS, json={ 'action': 'delete' })
+    # The task is still in the handoff list, but not waiting for the transmitter anymore
+    assert _assign(client, 'transmitter', 'uw-s1i1:t')['taskIdentifier'] is None
+    assert _status(client, task_identifier) == TaskKeys.Status.deleted
+
+def test_popped_task_deleted_before_the_assignment(app, client, create_task):
+    task_identifier = create_task()
+    with app.app_context():
+        # The receiver popped the task, and the user deleted it before the assignment
+        assert redis_store.zpopmin(get_key_schema().queue)[0][0] == task_identifier
+        client.post(f'/scheduler/user/tasks/{task_identifier}', headers=BACKEND_HEADERS, json={ 'action': 'delete' })
+        assert scripts.assign_receiver('uw-s1i1:r', task_identifier) is None
+        assert redis_store.llen(get_key_schema().transmitter_handoff('uw-s1i1')) == 0
+        assert redis_store.zcard(get_key_schema().running_deadlines) == 0
+    assert _assign(client, 'transmitter', 'uw-s1i1:t')['taskIdentifier'] is None
+
+def test_completed_task_is_not_assigned_again(app, client, create_task):
+    task_identifier = create_task()
+    assert _assign(client, 'receiver', 'uw-s1i1:r')['taskIdentifier'] == task_identifier
+    assert _assign(client, 'transmitter', 'uw-s1i1:t')['taskIdentifier'] == task_identifier
+    for type in ('receiver', 'transmitter'):
+        client.post(f'/scheduler/devices/tasks/{type}/{task_identifier}', headers=device_headers(f'uw-s1i1:{type[0]}'))
+    assert _status(client, task_identifier) == TaskKeys.Status.completed
+
+    with app.app_context():
+        assert scripts.assign_receiver('uw-s1i2:r', task_identifier) is None
+    assert _status(client, task_identifier) == TaskKeys.Status.completed
+    assert _assign(client, 'transmitter', 'uw-s1i2:t')['taskIdentifier'] is None
+
+def test_receiver_woken_up_by_a_queued_task(app, create_task):
+    with app.test_request_context('/scheduler/devices/tasks/receiver?max_seconds=5', headers=device_headers('uw-s1i1:r')):
+        steps = assign_receiver_steps()
+        device_wait = next(steps)
+        assert device_wait.device_base is None
+        task_identifier = create_task()
+        with pytest.raises(StopIteration) as stop:
+            steps.send(device_wait.wait())
+        fields, _ = stop.value.value
+        assert fields['taskIdentifier'] == task_identifier
+        # Nothing left queued, so there is nothing to wake up the next receivers for
+        assert redis_store.exists(get_key_schema().queue_wakeups) == 0
+
+def test_receiver_gone_after_waking_up(app, client, create_task):
+    with app.test_request_context('/scheduler/devices/tasks/receiver?max_seconds=5', headers=device_headers('uw-s1i1:r')):
+        steps = assign_receiver_steps()
+        device_wait = next(steps)
+        task_identifier = create_task()
+        assert device_wait.wait() is not None
+        # e.g. the worker died, or the ASGI request was cancelled
+        steps.close()
+        assert redis_store.zscore(get_key_schema().queue, task_identifier) is not None
+    assert _assign(client, 'receiver', 'uw-s1i2:r')['taskIdentifier'] == task_identifier
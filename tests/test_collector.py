@@ -0,0 +1,74 @@
+"""
+Garbage collection of the finished tasks and of the errors (reliascheduler/collector.py)
+"""
+import time
+
+from reliascheduler import redis_store
+from reliascheduler.collector import collect_garbage, get_collection_totals
+from reliascheduler.errors import get_latest_errors, store_error
+from reliascheduler.keys import FileKeys, TaskKeys
+from reliascheduler.schema import get_key_schema
+from reliascheduler.store import init_stores
+
+RETENTION = 3600
+
+def _leave(app, task_identifier: str, status: str = None):
+    """
+    Make the task look abandoned long ago, optionally with another status
+    """
+    with app.app_context():
+        task_key = get_key_schema().task(task_identifier)
+        redis_store.hset(task_key, TaskKeys.inactiveSince, time.time() - 2 * RETENTION)
+        if status is not None:
+            redis_store.hset(task_key, TaskKeys.status, status)
+
+def test_old_finished_tasks_collected(app, create_task):
+    old, recent, queued = create_task(content='a: 1'), create_task(content='a: 2'), create_task(content='a: 3')
+    _leave(app, old, TaskKeys.Status.completed)
+
+    with app.app_context():
+        keys = get_key_schema()
+        redis_store.hset(keys.task(recent), TaskKeys.status, TaskKeys.Status.completed)
+        stats = collect_garbage(task_retention=RETENTION)
+        assert (stats.tasks, stats.keys) == (1, 1)
+        assert redis_store.exists(keys.task(old)) == 0
+        assert redis_store.smembers(keys.tasks) == { recent, queued }
+        # Only the files (receiver and transmitter) of the other tasks are left
+        assert len(redis_store.keys(FileKeys.file('*'))) == 4
+        assert get_collection_totals()['tasks'] == '1'
+
+def test_abandoned_queued_tasks_leave_the_queue(app, create_task):
+    app.config['QUEUE_POLICY'] = 'fair-share-author'
+    init_stores(app)
+    a1, a2, a3 = create_task('A'), create_task('A'), create_task('A')
+    b1 = create_task('B')
+    for task_identifier in (a2, a3):
+        _leave(app, task_identifier)
+
+    with app.app_context():
+        keys = get_key_schema()
+        assert collect_garbage(task_retention=RETENTION).tasks == 2
+        assert redis_store.zrange(keys.queue, 0, -1) == [ a1, b1 ]
+    # The rounds of the tasks collected are given back to their owner
+    a4 = create_task('A')
+    with app.app_context():
+        assert redis_store.zrange(keys.queue, 0, -1) == [ a1, b1, a4 ]
+
+def test_old_errors_collected(app):
+    with app.app_context():
+        keys = get_key_schema()
+        store_error('task', 'user', 'Something failed')
+        assert get_latest_errors('user') == [ ('task', 'Something failed') ]
+        assert collect_garbage(error_retention=RETENTION).errors == 0
+
+        assert collect_garbage(error_retention=0).errors == 1
+        assert get_latest_errors('user') == []
+        assert redis_store.exists(keys.error('task'), keys.user_errors('user'), keys.errors) == 0
+
+def test_single_collector(app):
+    with app.app_context():
+        lock = redis_store.lock(get_key_schema().gc_lock, timeout=60)
+        assert lock.acquire(blocking=False)
+        assert collect_garbage() is None
+        lock.release()
+        assert collect_garbage() is not None
@@ -0,0 +1,24 @@
+"""
+Devices seen by the scheduler
+"""
+import json
+
+from conftest import device_headers
+from reliascheduler import redis_store
+from reliascheduler.collector import collect_garbage
+from reliascheduler.schema import get_key_schema
+
+def test_devices_available(app, client):
+    client.get('/scheduler/devices/tasks/receiver?max_seconds=1', headers=device_headers('uw-s1i1:r'))
+    with app.app_context():
+        keys = get_key_schema()
+        redis_store.zadd(keys.last_checks, { 'uw-s1i9:r': 1 })
+
+    device_data = json.loads(client.get('/scheduler/devices/available').get_data())['device_data']
+    assert list(device_data) == [ 'uw-s1i1:r' ] and device_data['uw-s1i1:r']['assignment'] is None
+
+    with app.app_context():
+        # Listing them does not forget the devices not seen in a while, the garbage collector does
+        assert redis_store.zscore(keys.last_checks, 'uw-s1i9:r') == 1
+        collect_garbage()
+        assert redis_store.zrange(keys.last_checks, 0, -1) == [ 'uw-s1i1:r' ]
@@ -0,0 +1,45 @@
+"""
+Errors of the users, indexed by user in a sorted set by time (reliascheduler/errors.py)
+"""
+from datetime import datetime
+
+from conftest import BACKEND_HEADERS, device_headers
+from reliascheduler import redis_store
+from reliascheduler.admin import reindex_errors
+from reliascheduler.schema import get_key_schema
+
+def _errors(client, user_id: str) -> dict:
+    return client.get(f'/scheduler/user/error-messages/{user_id}', headers=BACKEND_HEADERS).get_json()
+
+def _create_invalid_task(client, user_id: str):
+    client.post('/scheduler/user/tasks/', headers=BACKEND_HEADERS, json={ 'user_id': user_id, 'priority': 1, 'session_id': 'session' })
+
+def test_latest_errors_of_the_user(client, create_task):
+    for _ in range(6):
+        _create_invalid_task(client, 'user')
+    task_identifier = create_task('user')
+    client.post(f'/scheduler/devices/tasks/error_message/{task_identifier}', headers=device_headers('uw-s1i1:r'), json={ 'errorMessage': 'Failed', 'errorTime': '2024-01-01T00:00:00' })
+
+    errors = _errors(client, 'user')
+    # The last five, oldest first, including the error messages of the tasks
+    assert errors['errors'] == [ 'No grc_files provided' ] * 4 + [ 'Failed' ]
+    assert errors['ids'][-1] == task_identifier
+    assert _errors(client, 'other') == { 'success': True, 'ids': [], 'errors': [] }
+
+def test_index_capped(app, client):
+    app.config['MAX_ERRORS_PER_USER'] = 3
+    for _ in range(5):
+        _create_invalid_task(client, 'user')
+    with app.app_context():
+        assert redis_store.zcard(get_key_schema().user_errors('user')) == 3
+
+def test_reindex_errors(app, client, create_task):
+    _create_invalid_task(client, 'user')
+    task_identifier = create_task('user')
+    client.post(f'/scheduler/devices/tasks/error_message/{task_identifier}', headers=device_headers('uw-s1i1:r'), json={ 'errorMessage': 'Failed', 'errorTime': datetime.now().isoformat() })
+    expected = _errors(client, 'user')
+
+    with app.app_context():
+        redis_store.unlink(get_key_schema().user_errors('user'))
+        assert reindex_errors(10, lambda message: None) == 2
+    assert _errors(client, 'user') == expected
@@ -0,0 +1,39 @@
+"""
+Files of the tasks, stored once by their digest and counted by the tasks referencing them
+"""
+from conftest import BACKEND_HEADERS, device_headers
+from reliascheduler import redis_store
+from reliascheduler.keys import FileKeys
+from reliascheduler.schema import get_key_schema
+from reliascheduler.store import get_file_store
+
+CONTENT = "blocks:\n" + "".join(f"- id: block{i}\n  parameters: {{freq: {i}}}\n" for i in range(100))
+
+def _references(app) -> dict:
+    with app.app_context():
+        files = get_file_store()
+        keys = get_key_schema()
+        return { digest: int(redis_store.hget(keys.file(digest), FileKeys.references)) for digest in (files.digest(CONTENT), files.digest(CONTENT + '\nb: 2')) if redis_store.exists(keys.file(digest)) }
+
+def test_files_stored_once(app, client, create_task):
+    task_identifiers = [ create_task(content=CONTENT) for _ in range(3) ]
+    assert list(_references(app).values()) == [ 3, 3 ]
+    with app.app_context():
+        assert get_file_store().get(get_file_store().digest(CONTENT)) == CONTENT
+
+    receiver = client.get('/scheduler/devices/tasks/receiver?max_seconds=1', headers=device_headers('uw-s1i1:r')).get_json()
+    assert receiver['taskIdentifier'] == task_identifiers[0] and receiver['fileContent'] == CONTENT
+    transmitter = client.get('/scheduler/devices/tasks/transmitter?max_seconds=1', headers=device_headers('uw-s1i1:t')).get_json()
+    assert transmitter['fileContent'] == CONTENT + '\nb: 2'
+
+def test_files_removed_with_the_last_task(app, client, create_task):
+    first, second = create_task(content=CONTENT), create_task(content=CONTENT)
+    client.post(f'/scheduler/user/tasks/{first}', headers=BACKEND_HEADERS, json={ 'action': 'delete' })
+    # Deleting it again does not release its files twice
+    client.post(f'/scheduler/user/tasks/{first}', headers=BACKEND_HEADERS, json={ 'action': 'delete' })
+    assert list(_references(app).values()) == [ 1, 1 ]
+
+    client.post(f'/scheduler/user/tasks/{second}', headers=BACKEND_HEADERS, json={ 'action': 'delete' })
+    assert _references(app) == {}
+    with app.app_context():
+        assert redis_store.keys(FileKeys.file('*')) == []
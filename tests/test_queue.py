@@ -0,0 +1,66 @@
+"""
+Order of the queue (a sorted set by priority and sequence) and the fair share policies
+"""
+import pytest
+
+from conftest import BACKEND_HEADERS, device_headers
+from reliascheduler import redis_store
+from reliascheduler.admin import clean_tasks, migrate_priority_queues
+from reliascheduler.keys import TaskKeys
+from reliascheduler.schema import get_key_schema
+from reliascheduler.store import init_stores
+
+@pytest.fixture
+def fair_share_app(app):
+    app.config['QUEUE_POLICY'] = 'fair-share-author'
+    init_stores(app)
+    return app
+
+def _queue(app) -> list:
+    with app.app_context():
+        return redis_store.zrange(get_key_schema().queue, 0, -1)
+
+def test_priority_and_fifo_order(app, client, create_task):
+    low1, high1, low2, high2 = create_task(priority=10), create_task(priority=3), create_task(priority=10), create_task(priority=3)
+    assert _queue(app) == [ high1, high2, low1, low2 ]
+
+    estimates = client.post('/scheduler/user/tasks/estimates', headers=BACKEND_HEADERS, json={ 'taskIdentifiers': [ low1, high1, low2, high2 ] }).get_json()
+    assert [ estimates['tasks'][task_identifier]['queuePosition'] for task_identifier in (low1, high1, low2, high2) ] == [ 2, 0, 3, 1 ]
+
+    # The receivers get them in the same order
+    for task_identifier in (high1, high2, low1):
+        assignment = client.get('/scheduler/devices/tasks/receiver?max_seconds=1', headers=device_headers('uw-s1i1:r')).get_json()
+        assert assignment['taskIdentifier'] == task_identifier
+        client.post(f'/scheduler/user/tasks/{task_identifier}', headers=BACKEND_HEADERS, json={ 'action': 'delete' })
+    assert _queue(app) == [ low2 ]
+
+def test_migrate_priority_queues(app, create_task):
+    queued = create_task(priority=3)
+    old_high, old_low1, old_low2 = create_task(priority=1), create_task(priority=12), create_task(priority=12)
+    with app.app_context():
+        keys = get_key_schema()
+        # As queued before the single queue: LPUSH to the list of the priority
+        redis_store.zrem(keys.queue, old_high, old_low1, old_low2)
+        redis_store.lpush(keys.priority_queue(1), old_high)
+        redis_store.lpush(keys.priority_queue(12), old_low1, old_low2)
+        redis_store.zadd(keys.priorities, { '1': 1, '12': 12 })
+
+        assert migrate_priority_queues(lambda message: None) == 3
+        assert redis_store.exists(keys.priorities, keys.priority_queue(1), keys.priority_queue(12)) == 0
+    assert _queue(app) == [ old_high, queued, old_low1, old_low2 ]
+
+def test_fair_share_round_given_back_on_delete(fair_share_app, client, create_task):
+    a1, a2, a3, a4 = [ create_task('A') for _ in range(4) ]
+    b1 = create_task('B')
+    client.post(f'/scheduler/user/tasks/{b1}', headers=BACKEND_HEADERS, json={ 'action': 'delete' })
+    b2 = create_task('B')
+    assert _queue(fair_share_app) == [ a1, b2, a2, a3, a4 ]
+
+def test_fair_share_round_given_back_on_clean(fair_share_app, create_task):
+    a1, a2, a3, a4 = [ create_task('A') for _ in range(4) ]
+    b1 = create_task('B')
+    with fair_share_app.app_context():
+        redis_store.hset(get_key_schema().task(b1), TaskKeys.startedTime, '2020-01-01T00:00:00')
+        assert clean_tasks(10, lambda message: None, older_than=3600) == 1
+    b2 = create_task('B')
+    assert _queue(fair_share_app) == [ a1, b2, a2, a3, a4 ]
@@ -0,0 +1,74 @@
+"""
+Reaper of the tasks whose user stopped polling and of the tasks that overrun (reliascheduler/reaper.py)
+"""
+from conftest import BACKEND_HEADERS, device_headers
+from reliascheduler import redis_store
+from reliascheduler.keys import TaskKeys
+from reliascheduler.reaper import reap
+from reliascheduler.schema import get_key_schema
+
+def _assign(client, device_base: str) -> str:
+    return client.get('/scheduler/devices/tasks/receiver?max_seconds=1', headers=device_headers(f'{device_base}:r')).get_json()['taskIdentifier']
+
+def test_reap_inactive_and_overrun_tasks(app, client, create_task):
+    abandoned, overrun, running = create_task('A'), create_task('B'), create_task('C')
+    assert [ _assign(client, 'uw-s1i1'), _assign(client, 'uw-s1i2') ] == [ abandoned, overrun ]
+
+    with app.app_context():
+        keys = get_key_schema()
+        assert reap() == ([], [])
+
+        # The user of the first one stops polling, and the second one runs for too long
+        redis_store.hset(keys.task(abandoned), TaskKeys.inactiveSince, '1')
+        redis_store.zadd(keys.polling_deadlines, { keys.task(abandoned): 1 })
+        redis_store.zadd(keys.running_deadlines, { keys.task(overrun): 1 })
+        assert reap() == ([ abandoned ], [ overrun ])
+
+        for task_identifier in (abandoned, overrun):
+            assert redis_store.hget(keys.task(task_identifier), TaskKeys.status) == TaskKeys.Status.completed
+        # The devices are free, and nothing else is left to reap
+        assert redis_store.get(keys.device_assignment('uw-s1i1')) == 'null'
+        assert redis_store.get(keys.device_assignment('uw-s1i2')) == 'null'
+        assert redis_store.zcard(keys.polling_deadlines) == redis_store.zcard(keys.running_deadlines) == 0
+        assert reap() == ([], [])
+
+    assert client.get('/scheduler/user/error-messages/A', headers=BACKEND_HEADERS).get_json()['ids'] == []
+    errors = client.get('/scheduler/user/error-messages/B', headers=BACKEND_HEADERS).get_json()
+    assert errors['ids'] == [ overrun ] and errors['errors'] == [ 'Receiver side: task timed out' ]
+    # So the next task goes to a free device
+    assert _assign(client, 'uw-s1i1') == running
+
+def test_reap_only_the_assigned_tasks(app, client, create_task):
+    task_identifier = create_task()
+    _assign(client, 'uw-s1i1')
+    client.post(f'/scheduler/devices/tasks/receiver/{task_identifier}', headers=device_headers('uw-s1i1:r'))
+    client.post(f'/scheduler/devices/tasks/transmitter/{task_identifier}', headers=device_headers('uw-s1i1:t'))
+
+    with app.app_context():
+        keys = get_key_schema()
+        # Finished before its deadlines: the entries are just removed
+        redis_store.zadd(keys.polling_deadlines, { keys.task(task_identifier): 1 })
+        redis_store.zadd(keys.running_deadlines, { keys.task(task_identifier): 1 })
+        assert reap() == ([], [])
+        assert redis_store.zcard(keys.polling_deadlines) == redis_store.zcard(keys.running_deadlines) == 0
+
+def test_receiver_polling_again_after_an_overrun(app, client, create_task):
+    overrun = create_task('A')
+    assert _assign(client, 'uw-s1i1') == overrun
+    with app.app_context():
+        keys = get_key_schema()
+        redis_store.hset(keys.task(overrun), TaskKeys.receiverProcessingStart, '2020-01-01T00:00:00')
+    # The receiver asks for a new task before the reaper runs
+    assert _assign(client, 'uw-s1i1') is None
+    assert client.get(f'/scheduler/user/tasks/{overrun}', headers=BACKEND_HEADERS).get_json()['status'] == TaskKeys.Status.completed
+    assert client.get('/scheduler/user/error-messages/A', headers=BACKEND_HEADERS).get_json()['errors'] == [ 'Receiver side: task timed out' ]
+
+    # The task assigned was removed in the meanwhile: the device is released without any error
+    removed = create_task('B')
+    assert _assign(client, 'uw-s1i1') == removed
+    with app.app_context():
+        redis_store.unlink(keys.task(removed))
+    assert _assign(client, 'uw-s1i1') is None
+    with app.app_context():
+        assert redis_store.get(keys.device_assignment('uw-s1i1')) == 'null'
+        assert redis_store.exists(keys.error(removed)) == 0
@@ -0,0 +1,358 @@
+"""
+Micro-benchmark of the scheduler routes, with a budget of Redis commands and round-trips
+per route.
+
+Each route of the scheduler blueprint is driven through the Flask test client (no
+HTTP server) against a local Redis, or against an in-process stand-in (fakeredis)
+with --in-process. For every combination of queue depth (tasks waiting in the
+queue, with a lower priority than the benchmarked ones) and history size (finished
+tasks and errors already stored), it runs the lifecycle of a task many times and
+reports, per route, the throughput, the p50 / p99 latency and the Redis commands
+and round-trips per request (taken from the X-Relia-Redis header, see
+reliascheduler/metrics.py).
+
+A route that sends more Redis commands or round-trips than its budget
+(ROUTE_BUDGETS) in any request makes the benchmark fail (exit status 1). The budgets do not depend on
+the queue depth or the history size, so a route that becomes O(n) is detected.
+
+All the keys are created under BASE_KEY (--base-key), which is emptied before and
+after every run, so do not use the BASE_KEY of a deployment. Examples:
+
+    python benchmark.py --in-process
+    python benchmark.py --redis-url redis://localhost/0 --queue-depths 0,1000,10000 --history-sizes 0,10000
+"""
+import os
+import sys
+import time
+import json
+import logging
+import hashlib
+import argparse
+import secrets
+import tempfile
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# Maximum Redis commands and round-trips per request of each route (a pipeline counts
+# as its commands and as one round-trip), once the scripts are loaded and the device
+# credentials are verified. They are what each route sends, counted on the connections
+# (see reliascheduler/metrics.py), so any new command is detected. The benchmark has
+# two device bases, so four devices (two receivers, two transmitters) are seen
+ROUTE_BUDGETS = {
+    # SADD of the identifier; pipeline: HSETNX and HINCRBY per file (2), HSET, EVALSHA
+    # of the enqueue script and XADD of the event
+    'create': (8, 2),
+    # EVALSHA of the poll script
+    'status': (1, 1),
+    'status-batch': (1, 1),
+    # Pipeline: ZRANK in the queue, HGETALL of the run durations, ZRANGEBYSCORE of the devices seen
+    'estimates': (3, 1),
+    # ZADD of the device seen, GET of its assignment, EVALSHA of the assignment script
+    'receiver-assign': (3, 3),
+    # ZADD of the device seen, EVALSHA of the assignment script
+    'transmitter-assign': (2, 2),
+    # EVALSHA of the inactivity script (which returns the status)
+    'device-task-status': (1, 1),
+    # EVALSHA of the completion script
+    'transmitter-complete': (1, 1),
+    'receiver-complete': (1, 1),
+    # HMGET of the task; pipeline: HSET of the error, ZADD and ZREMRANGEBYRANK of the
+    # error index, XADD of the event
+    'error-message': (5, 2),
+    # ZRANGE of the error index; pipeline with an HMGET per error (the last 5)
+    'error-messages': (6, 2),
+    # ZRANGEBYSCORE of the devices seen; pipeline with a GET per device seen (4)
+    'devices-available': (5, 2),
+    # HMGET of the task; pipeline: HSET and PUBLISH of the status, XADD of the event,
+    # EVALSHA of the file release script, ZREM from the queue (EVALSHA of the dequeue
+    # script with a fair share policy), SREM from the tasks
+    'delete': (7, 2),
+}
+
+BACKEND_TOKEN = 'benchmark'
+DEVICE_PASSWORD = 'benchmark'
+DEVICES = ('benchmark-1', 'benchmark-2')
+AUTHOR = 'benchmark-user'
+SESSION = 'benchmark-session'
+# Lower priority (higher number) than the benchmarked tasks, so they stay in the queue
+QUEUED_PRIORITY = 10
+BENCHMARK_PRIORITY = 1
+
+RECEIVER_FILE = "options:\n  parameters:\n    id: receiver\n"
+TRANSMITTER_FILE = "options:\n  parameters:\n    id: transmitter\n"
+
+class RouteResults:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.commands: List[int] = []
+        self.round_trips: List[int] = []
+
+    def add(self, latency: float, commands: int, round_trips: int):
+        self.latencies.append(latency)
+        self.commands.append(commands)
+        self.round_trips.append(round_trips)
+
+def _device_credentials() -> Dict[str, str]:
+    salt = 'abcdef'
+    return { device: salt + '$' + hashlib.sha512((salt + DEVICE_PASSWORD).encode()).hexdigest() for device in DEVICES }
+
+def _configure_environment(args) -> str:
+    """
+    Set the configuration read by config.py (it must be done before importing it).
+    Return the device credentials file created.
+    """
+    credentials = _device_credentials()
+    credentials_file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+    json.dump(credentials, credentials_file)
+    credentials_file.close()
+
+    os.environ.update({
+        'REDIS_URL': args.redis_url,
+        'BASE_KEY': args.base_key,
+        'RELIA_BACKEND_TOKEN': BACKEND_TOKEN,
+        'DEVICE_CREDENTIALS_FILENAME': credentials_file.name,
+        'DEVICE_METADATA_FILENAME': os.path.join(tempfile.gettempdir(), 'relia-benchmark-devices.yml'),
+        'USE_FAKE_USERS': '0',
+        # Nothing else must change the keys while the benchmark runs
+        'BACKGROUND_THREADS_ENABLED': '0',
+        # Otherwise a device request checks the credentials version from time to time
+        'DEVICE_CREDENTIALS_VERSION_CHECK_INTERVAL': str(24 * 3600),
+        'METRICS_ENABLED': '1',
+        'METRICS_DEBUG_HEADER': '1',
+    })
+    return credentials_file.name
+
+def _parse_commands(header: Optional[str]) -> Tuple[int, int]:
+    # e.g., commands=3; round-trips=2; pipelines=1; time=0.52ms
+    values = {}
+    for part in (header or '').split(';'):
+        name, _, value = part.strip().partition('=')
+        values[name] = value
+    if 'commands' not in values or 'round-trips' not in values:
+        raise ValueError(f"Missing Redis commands or round-trips in the X-Relia-Redis header: {header!r}")
+    return int(values['commands']), int(values['round-trips'])
+
+class Benchmark:
+    def __init__(self, app):
+        self.app = app
+        self.client = app.test_client()
+        self.results: Dict[str, RouteResults] = defaultdict(RouteResults)
+
+    def reset(self, keep_credentials: bool = True):
+        """
+        Remove all the keys of the benchmark (those under BASE_KEY, and the session devices)
+        """
+        from reliascheduler import redis_store
+        from reliascheduler.keys import DeviceKeys
+
+        with self.app.app_context():
+            for pattern in (f"{self.app.config['BASE_KEY']}:*", f'relia:data-uploader:sessions:{SESSION}:*'):
+                batch = []
+                for key in redis_store.scan_iter(match=pattern, count=1000):
+                    batch.append(key)
+                    if len(batch) >= 1000:
+                        redis_store.unlink(*batch)
+                        batch = []
+                if batch:
+                    redis_store.unlink(*batch)
+
+            if keep_credentials:
+                # The workers cache the credentials until the version changes
+                pipeline = redis_store.pipeline()
+                pipeline.hset(DeviceKeys.credentials(), mapping=_device_credentials())
+                pipeline.incr(DeviceKeys.credentials_version())
+                pipeline.execute()
+
+    def _task(self, identifier: str, priority: int, status: str):
+        from reliascheduler.keys import TaskKeys
+        from reliascheduler.store import Task
+
+        finished = status == TaskKeys.Status.completed
+        return Task(
+            identifier=identifier, author=AUTHOR, session_id=SESSION,
+            transmitter_filename='transmitter.grc', transmitter_filetype='grc',
+            receiver_filename='receiver.grc', receiver_filetype='grc',
+            started_time=datetime.now().isoformat(), priority=priority,
+            transmitter_assigned=f'{DEVICES[0]}:t' if finished else 'null',
+            receiver_assigned=f'{DEVICES[0]}:r' if finished else 'null',
+            transmitter_processing_start='null', receiver_processing_start='null',
+            status=status, error_message='null', error_time='null',
+            local_time_remaining='0', inactive_since=time.time(),
+        )
+
+    def populate(self, queue_depth: int, history_size: int, batch_size: int = 500):
+        """
+        Add queue_depth queued tasks and history_size finished tasks (each one with an error)
+        """
+        from reliascheduler import redis_store, scripts
+        from reliascheduler.errors import store_error
+        from reliascheduler.keys import TaskKeys
+        from reliascheduler.schema import get_key_schema
+        from reliascheduler.store import get_file_store
+
+        with self.app.app_context():
+            keys = get_key_schema()
+            files = get_file_store()
+            for total, status in ((queue_depth, TaskKeys.Status.queued), (history_size, TaskKeys.Status.completed)):
+                for start in range(0, total, batch_size):
+                    pipeline = redis_store.pipeline()
+                    for _ in range(min(batch_size, total - start)):
+                        task = self._task(secrets.token_urlsafe(), QUEUED_PRIORITY, status)
+                        pipeline.sadd(keys.tasks, task.identifier)
+                        if status == TaskKeys.Status.queued:
+                            task.transmitter_file_digest = files.add(TRANSMITTER_FILE, pipeline)
+                            task.receiver_file_digest = files.add(RECEIVER_FILE, pipeline)
+                            pipeline.hset(keys.task(task.identifier), mapping=task.to_mapping())
+                            scripts.enqueue_task(task.identifier, task.priority, pipeline=pipeline)
+                        else:
+                            pipeline.hset(keys.task(task.identifier), mapping=task.to_mapping())
+                            store_error(task.identifier, AUTHOR, "Receiver side: benchmark error", pipeline=pipeline)
+                    scripts.execute_pipeline(pipeline)
+
+    def request(self, route: str, method: str, url: str, device: Optional[str] = None, **kwargs) -> dict:
+        headers = { 'relia-secret': BACKEND_TOKEN }
+        if device is not None:
+            headers.update({ 'relia-device': device, 'relia-password': DEVICE_PASSWORD })
+
+        start = time.perf_counter()
+        response = self.client.open(url, method=method, headers=headers, **kwargs)
+        latency = time.perf_counter() - start
+
+        if response.status_code != 200:
+            raise RuntimeError(f"{route}: {method} {url} returned {response.status_code}: {response.get_data(as_text=True)}")
+        self.results[route].add(latency, *_parse_commands(response.headers.get('X-Relia-Redis')))
+        return json.loads(response.get_data(as_text=True))
+
+    def create_task(self) -> str:
+        result = self.request('create', 'POST', '/scheduler/user/tasks/', json={
+            'grc_files': {
+                'receiver': { 'filename': 'receiver.grc', 'content': RECEIVER_FILE, 'type': 'grc' },
+                'transmitter': { 'filename': 'transmitter.grc', 'content': TRANSMITTER_FILE, 'type': 'grc' },
+            },
+            'priority': BENCHMARK_PRIORITY, 'session_id': SESSION, 'user_id': AUTHOR,
+        })
+        return result['taskIdentifier']
+
+    def run_task_lifecycle(self, device_base: str):
+        """
+        Create a task and take it through every route until it is completed, then create
+        and delete another one
+        """
+        receiver, transmitter = f'{device_base}:r', f'{device_base}:t'
+
+        task_identifier = self.create_task()
+        self.request('status', 'GET', f'/scheduler/user/tasks/{task_identifier}')
+        self.request('status-batch', 'POST', '/scheduler/user/tasks/status', json={ 'taskIdentifiers': [ task_identifier ] })
+        self.request('estimates', 'POST', '/scheduler/user/tasks/estimates', json={ 'taskIdentifiers': [ task_identifier ] })
+
+        assignment = self.request('receiver-assign', 'GET', '/scheduler/devices/tasks/receiver?max_seconds=1', device=receiver)
+        if assignment['taskIdentifier'] != task_identifier:
+            raise RuntimeError(f"The receiver was assigned {assignment['taskIdentifier']} instead of {task_identifier}")
+        self.request('transmitter-assign', 'GET', '/scheduler/devices/tasks/transmitter?max_seconds=1', device=transmitter)
+        self.request('device-task-status', 'GET', f'/scheduler/devices/tasks/receiver/{task_identifier}', device=receiver)
+        self.request('transmitter-complete', 'POST', f'/scheduler/devices/tasks/transmitter/{task_identifier}', device=transmitter)
+        self.request('receiver-complete', 'POST', f'/scheduler/devices/tasks/receiver/{task_identifier}', device=receiver)
+
+        self.request('error-message', 'POST', f'/scheduler/devices/tasks/error_message/{task_identifier}', device=receiver,
+                     json={ 'errorMessage': 'benchmark error', 'errorTime': datetime.now().isoformat() })
+        self.request('error-messages', 'GET', f'/scheduler/user/error-messages/{AUTHOR}')
+        self.request('devices-available', 'GET', '/scheduler/devices/available')
+
+        deleted_identifier = self.create_task()
+        self.request('delete', 'POST', f'/scheduler/user/tasks/{deleted_identifier}', json={ 'action': 'delete' })
+
+    def run(self, queue_depth: int, history_size: int, iterations: int) -> Dict[str, RouteResults]:
+        self.results = defaultdict(RouteResults)
+        self.reset()
+        self.populate(queue_depth, history_size)
+        try:
+            # Warm up (loading the scripts and verifying the credentials), without recording it
+            for device_base in DEVICES:
+                self.run_task_lifecycle(device_base)
+            self.results = defaultdict(RouteResults)
+
+            for iteration in range(iterations):
+                self.run_task_lifecycle(DEVICES[iteration % len(DEVICES)])
+        finally:
+            self.reset(keep_credentials=False)
+        return self.results
+
+def _report(queue_depth: int, history_size: int, results: Dict[str, RouteResults]) -> List[str]:
+    """
+    Print the results of a run and return the routes over their budget
+    """
+    print(f"\nQueue depth {queue_depth}, history size {history_size}")
+    print(f"{'route':<22} {'requests':>8} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'cmds p50':>8} {'cmds max':>8} {'budget':>6} {'rtts max':>8} {'budget':>6}")
+
+    over_budget = []
+    for route, route_results in results.items():
+        latencies = np.array(route_results.latencies)
+        commands = np.array(route_results.commands)
+        round_trips = np.array(route_results.round_trips)
+        command_budget, round_trip_budget = ROUTE_BUDGETS.get(route, (None, None))
+        exceeded = command_budget is not None and (commands.max() > command_budget or round_trips.max() > round_trip_budget)
+        if exceeded:
+            over_budget.append(f"{route} (queue depth {queue_depth}, history size {history_size}): {commands.max()} commands "
+                               f"and {round_trips.max()} round-trips, budget {command_budget} and {round_trip_budget}")
+
+        print(f"{route:<22} {len(latencies):>8} {len(latencies) / latencies.sum():>9.1f} "
+              f"{np.percentile(latencies, 50) * 1000:>8.2f} {np.percentile(latencies, 99) * 1000:>8.2f} "
+              f"{np.percentile(commands, 50):>8.0f} {commands.max():>8} {command_budget if command_budget is not None else '-':>6} "
+              f"{round_trips.max():>8} {round_trip_budget if round_trip_budget is not None else '-':>6}"
+              f"{'  OVER BUDGET' if exceeded else ''}")
+    return over_budget
+
+def _parse_sizes(value: str) -> List[int]:
+    return [ int(size) for size in value.split(',') if size.strip() ]
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the scheduler routes and check their Redis command and round-trip budgets")
+    parser.add_argument('--redis-url', default='redis://localhost/0', help="Redis server (ignored with --in-process)")
+    parser.add_argument('--in-process', action='store_true', help="Use fakeredis instead of a Redis server")
+    parser.add_argument('--base-key', default='relia-benchmark', help="Prefix of all the keys (emptied before and after each run)")
+    parser.add_argument('--queue-depths', type=_parse_sizes, default=[ 0, 1000 ], help="Comma-separated queued tasks of each run")
+    parser.add_argument('--history-sizes', type=_parse_sizes, default=[ 0, 1000 ], help="Comma-separated finished tasks (with errors) of each run")
+    parser.add_argument('--iterations', type=int, default=200, help="Task lifecycles per run")
+    args = parser.parse_args()
+
+    credentials_filename = _configure_environment(args)
+    # The views log every task created and assigned; only the errors are relevant here
+    logging.getLogger('reliascheduler').setLevel(logging.ERROR)
+
+    from reliascheduler import create_app, redis_store
+    from reliascheduler.metrics import instrumented
+    if args.in_process:
+        try:
+            import fakeredis
+        except ImportError:
+            print("--in-process requires fakeredis (pip install fakeredis[lua])")
+            return 2
+        # Instrumented as the default client, for the X-Relia-Redis header
+        redis_store.provider_class = instrumented(fakeredis.FakeStrictRedis)
+
+    try:
+        app = create_app('development')
+        benchmark = Benchmark(app)
+        over_budget = []
+        for queue_depth in args.queue_depths:
+            for history_size in args.history_sizes:
+                results = benchmark.run(queue_depth, history_size, args.iterations)
+                over_budget.extend(_report(queue_depth, history_size, results))
+    finally:
+        os.unlink(credentials_filename)
+
+    if over_budget:
+        print("\nRoutes over their Redis command or round-trip budget:")
+        for message in over_budget:
+            print(f" - {message}")
+        return 1
+    print("\nAll the routes are within their Redis command and round-trip budgets")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,309 @@
+"""
+Replay of the requests recorded by reliascheduler/recorder.py against a local instance.
+
+The requests of one or more trace files (REQUEST_TRACE_FILENAME) are sent to a
+local app through the Flask test client, against a local Redis (or fakeredis with
+--in-process), at the original pace or accelerated (--speed 10 sends them ten
+times faster, and shortens the long-polls of the devices accordingly). Each
+request runs in its own thread, so the long-polls block as they did originally.
+
+The task identifiers are new in the replay, so they are mapped from the ones in
+the trace (those created before the trace started do not exist). The request
+bodies are rebuilt from the fields recorded, with files of the original size.
+
+At the end, it compares with the trace, per route, the outcome of the requests
+(status code, status or message returned, and the task assigned to the devices)
+and the latency. It exits with status 1 if the mismatches or the p99 latencies
+exceed --max-mismatch-rate or --max-latency-ratio, so a recorded trace can be
+used as a performance regression test. Example:
+
+    python replay.py ../logs/requests-*.jsonl.gz --speed 5 --in-process --max-latency-ratio 2
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import tempfile
+import threading
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+BACKEND_TOKEN = 'replay'
+DEVICE_PASSWORD = 'replay'
+# Seconds to wait for the creation of a task before sending a request about it
+MAPPING_TIMEOUT = 5
+
+class ReplayResult:
+    __slots__ = ('record', 'status_code', 'outcome', 'task_identifier', 'latency')
+
+    def __init__(self, record: dict, status_code: int, outcome: Optional[str], task_identifier: Optional[str], latency: float):
+        self.record = record
+        self.status_code = status_code
+        self.outcome = outcome
+        self.task_identifier = task_identifier
+        self.latency = latency
+
+def load_records(filenames: List[str]) -> List[dict]:
+    from reliascheduler.recorder import read_trace
+
+    records = [ record for filename in filenames for record in read_trace(filename) ]
+    records.sort(key=lambda record: record['t'])
+    return records
+
+def device_credentials(records: List[dict]) -> Dict[str, str]:
+    """
+    Return the credentials of the devices in the trace, all with DEVICE_PASSWORD
+    """
+    salt = 'abcdef'
+    salted_password = salt + '$' + hashlib.sha512((salt + DEVICE_PASSWORD).encode()).hexdigest()
+    return { record['dev'].split(':')[0]: salted_password for record in records if 'dev' in record }
+
+def _configure_environment(args) -> str:
+    """
+    Set the configuration read by config.py (it must be done before importing it).
+    Return the device credentials file, filled once the traces are read.
+    """
+    credentials_file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+    credentials_file.close()
+
+    os.environ.update({
+        'REDIS_URL': args.redis_url,
+        'BASE_KEY': args.base_key,
+        'RELIA_BACKEND_TOKEN': BACKEND_TOKEN,
+        'DEVICE_CREDENTIALS_FILENAME': credentials_file.name,
+        'USE_FAKE_USERS': '0',
+        # Nothing else must change the keys while the replay runs
+        'GC_INTERVAL': '0',
+        'REQUEST_TRACE_FILENAME': args.record or '',
+    })
+    return credentials_file.name
+
+class Replay:
+    def __init__(self, app, records: List[dict], speed: float):
+        self.app = app
+        self.records = records
+        self.speed = speed
+        self.results: List[ReplayResult] = []
+        self._results_lock = threading.Lock()
+        # Task identifier in the trace: task identifier in the replay
+        self.identifiers: Dict[str, str] = {}
+        self._identifiers_condition = threading.Condition()
+        self.credentials = device_credentials(records)
+
+    def reset(self, keep_credentials: bool = True):
+        """
+        Remove all the keys under BASE_KEY, and push the credentials of the devices in the trace
+        """
+        from reliascheduler import redis_store
+        from reliascheduler.keys import DeviceKeys
+
+        with self.app.app_context():
+            batch = []
+            for key in redis_store.scan_iter(match=f"{self.app.config['BASE_KEY']}:*", count=1000):
+                batch.append(key)
+                if len(batch) >= 1000:
+                    redis_store.unlink(*batch)
+                    batch = []
+            if batch:
+                redis_store.unlink(*batch)
+
+            if keep_credentials and self.credentials:
+                # The workers cache the credentials until the version changes
+                pipeline = redis_store.pipeline()
+                pipeline.hset(DeviceKeys.credentials(), mapping=self.credentials)
+                pipeline.incr(DeviceKeys.credentials_version())
+                pipeline.execute()
+
+    def _map_identifier(self, task_identifier: str) -> str:
+        with self._identifiers_condition:
+            self._identifiers_condition.wait_for(lambda: task_identifier in self.identifiers, timeout=MAPPING_TIMEOUT)
+            return self.identifiers.get(task_identifier, task_identifier)
+
+    def _build_request(self, record: dict) -> Tuple[str, dict, Optional[dict]]:
+        """
+        Return the URL, the headers and the JSON body of the request of the record
+        """
+        path = record['r']
+        for name, value in (record.get('a') or {}).items():
+            if name == 'task_identifier':
+                value = self._map_identifier(value)
+            path = path.replace(f'<{name}>', value)
+
+        query = dict(parse_qsl(record.get('q', '')))
+        if 'max_seconds' in query and self.speed:
+            query['max_seconds'] = str(max(1, round(float(query['max_seconds']) / self.speed)))
+        url = path + ('?' + urlencode(query) if query else '')
+
+        headers = { 'relia-secret': BACKEND_TOKEN }
+        if 'dev' in record:
+            headers.update({ 'relia-device': record['dev'], 'relia-password': DEVICE_PASSWORD })
+
+        fields = dict(record.get('b') or {})
+        if 'taskIdentifiers' in fields:
+            fields['taskIdentifiers'] = [ self._map_identifier(task_identifier) for task_identifier in fields['taskIdentifiers'] ]
+
+        body = None
+        if record['m'] == 'POST':
+            if path == '/scheduler/user/tasks/':
+                # Files of the original size (the body has the file of each side, and little else)
+                padding = 'x' * max((record.get('n', 0) - 250) // 2, 0)
+                content = f"options:\n  parameters:\n    id: replay\n# {padding}\n"
+                fields['grc_files'] = {
+                    'receiver': { 'filename': 'receiver.grc', 'content': content, 'type': 'grc' },
+                    'transmitter': { 'filename': 'transmitter.grc', 'content': content, 'type': 'grc' },
+                }
+            elif path.startswith('/scheduler/devices/tasks/error_message/'):
+                fields.update(errorMessage='x' * max(record.get('n', 0) - 60, 1), errorTime=datetime.now().isoformat())
+            body = fields
+        return url, headers, body
+
+    def send(self, record: dict, previous: Optional[Future] = None):
+        if previous is not None:
+            # A device sends its requests one after the other
+            previous.result()
+        url, headers, body = self._build_request(record)
+        client = self.app.test_client()
+
+        start = time.perf_counter()
+        response = client.open(url, method=record['m'], headers=headers, json=body)
+        data = response.get_data()
+        latency = time.perf_counter() - start
+
+        outcome = task_identifier = None
+        if response.is_json and data:
+            response_data = json.loads(data)
+            if isinstance(response_data, dict):
+                outcome = response_data.get('status') or response_data.get('message')
+                task_identifier = response_data.get('taskIdentifier')
+
+        if record['r'] == '/scheduler/user/tasks/' and record.get('tid') and task_identifier:
+            with self._identifiers_condition:
+                self.identifiers[record['tid']] = task_identifier
+                self._identifiers_condition.notify_all()
+
+        with self._results_lock:
+            self.results.append(ReplayResult(record, response.status_code, outcome if isinstance(outcome, str) else None, task_identifier, latency))
+
+    def run(self, workers: int):
+        self.reset()
+        first_time = self.records[0]['t']
+        started = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(workers) as executor:
+                futures = []
+                last_device_requests: Dict[str, Future] = {}
+                for record in self.records:
+                    if self.speed:
+                        delay = (record['t'] - first_time) / self.speed - (time.perf_counter() - started)
+                        if delay > 0:
+                            time.sleep(delay)
+                    future = executor.submit(self.send, record, last_device_requests.get(record.get('dev')))
+                    if 'dev' in record:
+                        last_device_requests[record['dev']] = future
+                    futures.append(future)
+                for future in futures:
+                    future.result()
+        finally:
+            self.reset(keep_credentials=False)
+        return time.perf_counter() - started
+
+    def compare(self, max_mismatches_shown: int) -> Tuple[float, Dict[str, float]]:
+        """
+        Print the comparison with the trace, and return the fraction of mismatches and the
+        p99 latency ratio of each route
+        """
+        by_route: Dict[str, List[ReplayResult]] = defaultdict(list)
+        for result in self.results:
+            by_route[result.record['r']].append(result)
+
+        print(f"{'route':<52} {'requests':>8} {'match':>6} {'orig p50':>9} {'p50':>9} {'orig p99':>9} {'p99':>9} {'p99 ratio':>9}")
+        mismatches = []
+        latency_ratios = {}
+        for route, results in sorted(by_route.items()):
+            matches = 0
+            for result in results:
+                record = result.record
+                expected_task = self.identifiers.get(record['tid'], record['tid']) if record.get('tid') and record['r'] != '/scheduler/user/tasks/' else None
+                if result.status_code == record['s'] and result.outcome == record.get('o') and (expected_task is None or expected_task == result.task_identifier):
+                    matches += 1
+                else:
+                    mismatches.append((record, result))
+
+            original = np.array([ result.record['d'] for result in results ]) * 1000
+            replayed = np.array([ result.latency for result in results ]) * 1000
+            latency_ratios[route] = np.percentile(replayed, 99) / max(np.percentile(original, 99), 1e-6)
+            print(f"{route:<52} {len(results):>8} {matches / len(results):>6.1%} "
+                  f"{np.percentile(original, 50):>9.2f} {np.percentile(replayed, 50):>9.2f} "
+                  f"{np.percentile(original, 99):>9.2f} {np.percentile(replayed, 99):>9.2f} {latency_ratios[route]:>9.2f}")
+
+        if mismatches:
+            print(f"\n{len(mismatches)} requests with a different outcome (first {min(len(mismatches), max_mismatches_shown)}):")
+            for record, result in mismatches[:max_mismatches_shown]:
+                print(f" - {record['m']} {record['r']} {record.get('dev', '')}: {record['s']} {record.get('o')!r} "
+                      f"{record.get('tid', '')} -> {result.status_code} {result.outcome!r} {result.task_identifier or ''}")
+        return len(mismatches) / max(len(self.results), 1), latency_ratios
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Replay a recorded request trace against a local instance")
+    parser.add_argument('traces', nargs='+', help="Trace files (REQUEST_TRACE_FILENAME)")
+    parser.add_argument('--speed', type=float, default=1, help="Speed factor (0: as fast as possible)")
+    parser.add_argument('--redis-url', default='redis://localhost/0', help="Redis server (ignored with --in-process)")
+    parser.add_argument('--in-process', action='store_true', help="Use fakeredis instead of a Redis server")
+    parser.add_argument('--base-key', default='relia-replay', help="Prefix of all the keys (emptied before and after the replay)")
+    parser.add_argument('--workers', type=int, default=512, help="Threads sending the requests (at least the concurrent long-polls)")
+    parser.add_argument('--record', help="Record the replayed requests in this trace file (e.g., as the baseline of the next replay)")
+    parser.add_argument('--max-mismatch-rate', type=float, default=None, help="Fail if more requests than this fraction have a different outcome")
+    parser.add_argument('--max-latency-ratio', type=float, default=None, help="Fail if the p99 latency of a route is this many times the original one")
+    parser.add_argument('--show-mismatches', type=int, default=20, help="Mismatches listed")
+    args = parser.parse_args()
+
+    credentials_filename = _configure_environment(args)
+    logging.getLogger('reliascheduler').setLevel(logging.ERROR)
+
+    from reliascheduler import create_app, redis_store
+    if args.in_process:
+        try:
+            import fakeredis
+        except ImportError:
+            print("--in-process requires fakeredis (pip install fakeredis[lua])")
+            return 2
+        redis_store.provider_class = fakeredis.FakeStrictRedis
+
+    try:
+        records = load_records(args.traces)
+        if not records:
+            print("No requests in the traces")
+            return 2
+        with open(credentials_filename, 'w') as credentials_file:
+            json.dump(device_credentials(records), credentials_file)
+
+        replay = Replay(create_app('development'), records, args.speed)
+        elapsed = replay.run(args.workers)
+    finally:
+        os.unlink(credentials_filename)
+    print(f"{len(records)} requests recorded in {records[-1]['t'] - records[0]['t']:.1f} s replayed in {elapsed:.1f} s\n")
+    mismatch_rate, latency_ratios = replay.compare(args.show_mismatches)
+
+    failed = False
+    if args.max_mismatch_rate is not None and mismatch_rate > args.max_mismatch_rate:
+        print(f"\nMismatch rate {mismatch_rate:.1%} over {args.max_mismatch_rate:.1%}")
+        failed = True
+    if args.max_latency_ratio is not None:
+        for route, ratio in latency_ratios.items():
+            if ratio > args.max_latency_ratio:
+                print(f"\n{route}: p99 latency {ratio:.2f} times the original one")
+                failed = True
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
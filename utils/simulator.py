@@ -0,0 +1,371 @@
+"""
+Discrete-event simulator of the scheduler, to tune its settings offline.
+
+It models the queue and the state machine of reliascheduler/views/scheduler.py
+and reliascheduler/scripts.py:
+
+- a single queue ordered by priority and then by arrival (priorities outside
+  0..MAX_PRIORITY_QUEUE become the default priority, 10, as in user_create_task);
+- each device pair takes the next task when its receiver asks for one: idle
+  receivers long-poll for up to max_seconds (the one waiting longest gets the
+  next task, as with BZPOPMIN) and ask again after poll_gap seconds; then the
+  transmitter is handed the task after handoff_delay;
+- the devices run a task for its run time, up to MAX_TIME_RUNNING (the maxTime
+  returned with the assignment), checking its status every device_poll_interval;
+- the users poll their task every poll_interval until they abandon it, and a task
+  whose user has not polled in MAX_TIME_WITHOUT_POLLING is skipped when it is
+  popped, or stopped (by the device status check, or by the reaper every
+  reaper_interval) while running;
+- a device that crashes keeps its task until MAX_TIME_RUNNING expires (then the
+  receiver itself clears it when it asks again), and is back after restart_delay.
+
+The tasks come from a synthetic trace (Poisson arrivals, with distributions for
+the priorities, the run times, the poll intervals of the users and how long they
+wait before abandoning) or from a CSV trace (--trace). The same trace is
+simulated for every combination of the parameter grid, so they are compared with
+the same arrivals. The randomness is drawn up front with NumPy, and the grid can
+be run in several processes (--jobs).
+
+For each combination it reports the utilization of the devices, the queue wait
+distribution and the wasted device-seconds (running tasks whose user had left or
+was wrongly considered inactive, and held by crashed devices). Example:
+
+    python simulator.py --devices 10 --arrival-rate 0.5 --duration 36000 --run-time lognormal:20,0.8 \\
+        --max-time-running 30,60,120 --max-time-without-polling 5,10,20 --poll-interval uniform:1,12 \\
+        --abandon-rate 0.1 --csv results.csv
+"""
+import sys
+import csv
+import heapq
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, NamedTuple
+
+import numpy as np
+
+DEFAULT_PRIORITY = 10
+
+# Outcome of each task
+QUEUED, COMPLETED, TRUNCATED, SKIPPED, STOPPED_ABANDONED, STOPPED_ACTIVE, CRASHED = range(7)
+OUTCOME_NAMES = ('queued', 'completed', 'truncated', 'skipped', 'stopped_abandoned', 'stopped_active', 'crashed')
+
+class Trace(NamedTuple):
+    arrival: np.ndarray        # seconds since the start
+    priority: np.ndarray
+    owner: np.ndarray
+    run_time: np.ndarray       # seconds the task needs in the device
+    abandon_after: np.ndarray  # seconds after the arrival when the user stops polling (inf: never)
+    poll_interval: np.ndarray  # seconds between the polls of the user
+    crash: np.ndarray          # whether the device crashes when it takes the task
+
+class Parameters(NamedTuple):
+    devices: int
+    max_time_running: float
+    max_time_without_polling: float
+    max_seconds: float
+    max_priority: int
+    reaper_interval: float
+    device_poll_interval: float
+    poll_gap: float
+    handoff_delay: float
+    restart_delay: float
+
+def sample(spec: str, rng: np.random.Generator, size: int) -> np.ndarray:
+    """
+    Sample a distribution: const:V, uniform:MIN,MAX, exp:MEAN, normal:MEAN,STDEV,
+    lognormal:MEAN,SIGMA or inf (never negative)
+    """
+    if spec == 'inf':
+        return np.full(size, np.inf)
+    name, _, parameters = spec.partition(':')
+    arguments = [ float(argument) for argument in parameters.split(',') if argument ]
+    if name == 'const':
+        values = np.full(size, arguments[0])
+    elif name == 'uniform':
+        values = rng.uniform(arguments[0], arguments[1], size)
+    elif name == 'exp':
+        values = rng.exponential(arguments[0], size)
+    elif name == 'normal':
+        values = rng.normal(arguments[0], arguments[1], size)
+    elif name == 'lognormal':
+        mean, sigma = arguments
+        values = rng.lognormal(np.log(mean) - sigma ** 2 / 2, sigma, size)
+    else:
+        raise ValueError(f"Unknown distribution: {spec}")
+    return np.maximum(values, 0.0)
+
+def synthetic_trace(args, rng: np.random.Generator) -> Trace:
+    arrival = np.cumsum(rng.exponential(1 / args.arrival_rate, int(args.arrival_rate * args.duration * 1.2) + 10))
+    arrival = arrival[arrival < args.duration]
+    size = len(arrival)
+
+    priorities, weights = zip(*[ (int(priority), float(weight)) for priority, weight in (item.split(':') for item in args.priorities.split(',')) ])
+    owner = rng.integers(0, args.users, size)
+    # The poll interval is a property of the user (browser, connection), not of the task
+    user_poll_interval = sample(args.poll_interval, rng, args.users)
+    abandon_after = np.where(rng.random(size) < args.abandon_rate, sample(args.patience, rng, size), np.inf)
+    return Trace(
+        arrival=arrival,
+        priority=rng.choice(priorities, size, p=np.array(weights) / sum(weights)),
+        owner=owner,
+        run_time=sample(args.run_time, rng, size),
+        abandon_after=abandon_after,
+        poll_interval=np.maximum(user_poll_interval[owner], 0.01),
+        crash=rng.random(size) < args.crash_rate,
+    )
+
+def load_trace(filename: str, args, rng: np.random.Generator) -> Trace:
+    """
+    Load a CSV trace with the columns arrival (seconds since the start), and optionally priority, owner, run_time,
+    abandon_after, poll_interval and crash (the missing ones are sampled as in a synthetic trace)
+    """
+    with open(filename) as trace_file:
+        rows = list(csv.DictReader(trace_file))
+    rows.sort(key=lambda row: float(row['arrival']))
+    size = len(rows)
+
+    def column(name: str, default: np.ndarray, conversion=float) -> np.ndarray:
+        if rows and rows[0].get(name) not in (None, ''):
+            return np.array([ conversion(row[name]) for row in rows ])
+        return default
+
+    arrival = column('arrival', np.zeros(0))
+    owners = column('owner', rng.integers(0, args.users, size).astype(str), str)
+    _, owner = np.unique(owners, return_inverse=True)
+    user_poll_interval = sample(args.poll_interval, rng, owner.max() + 1 if size else 0)
+    return Trace(
+        arrival=arrival,
+        priority=column('priority', np.full(size, DEFAULT_PRIORITY), int),
+        owner=owner,
+        run_time=column('run_time', sample(args.run_time, rng, size)),
+        abandon_after=column('abandon_after', np.where(rng.random(size) < args.abandon_rate, sample(args.patience, rng, size), np.inf)),
+        poll_interval=column('poll_interval', np.maximum(user_poll_interval[owner], 0.01) if size else np.zeros(0)),
+        crash=column('crash', rng.random(size) < args.crash_rate, lambda value: value.lower() in ('1', 'true')),
+    )
+
+def write_trace(trace: Trace, filename: str):
+    with open(filename, 'w', newline='') as trace_file:
+        writer = csv.writer(trace_file)
+        writer.writerow(Trace._fields)
+        for row in zip(*trace):
+            writer.writerow([ int(value) if isinstance(value, (np.bool_, bool)) else value for value in row ])
+
+def _next_multiple(time: float, interval: float, origin: float = 0.0) -> float:
+    """
+    First time origin + k * interval >= time (inf if interval is 0, i.e., never)
+    """
+    if interval <= 0:
+        return np.inf
+    return origin + np.ceil((time - origin) / interval) * interval
+
+def _inactive_at(time: float, arrival: float, abandon_at: float, poll_interval: float, max_time_without_polling: float) -> bool:
+    last_poll = arrival + np.floor((min(time, abandon_at) - arrival) / poll_interval) * poll_interval
+    return time - last_poll > max_time_without_polling
+
+def _stop_time(start: float, end: float, arrival: float, abandon_at: float, poll_interval: float, parameters: Parameters) -> float:
+    """
+    First time in [start, end) when the task is found inactive (by a status check of the
+    device or by the reaper), or inf
+    """
+    threshold = parameters.max_time_without_polling
+
+    def first_check(time: float) -> float:
+        return min(_next_multiple(time, parameters.device_poll_interval, start), _next_multiple(time, parameters.reaper_interval))
+
+    # While the user polls, only the gaps between polls longer than the threshold count
+    if poll_interval > threshold:
+        last_poll = arrival + np.floor((start - arrival) / poll_interval) * poll_interval
+        while last_poll < min(end, abandon_at):
+            window_start = max(last_poll + threshold, start)
+            window_end = min(last_poll + poll_interval, abandon_at)
+            if window_start < window_end:
+                check = first_check(np.nextafter(window_start, np.inf))
+                if check < window_end and check < end:
+                    return check
+            last_poll += poll_interval
+
+    if abandon_at < end:
+        last_poll = arrival + np.floor((abandon_at - arrival) / poll_interval) * poll_interval
+        check = first_check(np.nextafter(max(last_poll + threshold, start), np.inf))
+        if check < end:
+            return check
+    return np.inf
+
+def simulate(trace: Trace, parameters: Parameters) -> Dict[str, float]:
+    size = len(trace.arrival)
+    priority = np.where((trace.priority < 0) | (trace.priority > parameters.max_priority), DEFAULT_PRIORITY, trace.priority)
+    abandon_at = trace.arrival + trace.abandon_after
+
+    outcome = np.full(size, QUEUED)
+    assigned_at = np.full(size, np.nan)
+    busy = np.zeros(size)
+    wasted = np.zeros(size)
+
+    queue: List = []
+    # (time, order, kind, value): kind 0 = device free, 1 = arrival, 2 = device listens again
+    events: List = [ (0.0, 0, 0, device) for device in range(parameters.devices) ]
+    events.extend((trace.arrival[task], 1, 1, task) for task in range(size))
+    heapq.heapify(events)
+    # device: time since it is waiting for a task
+    idle_since: Dict[int, float] = {}
+    idle_requests = 0
+    cycle = parameters.max_seconds + parameters.poll_gap
+
+    def listening(device: int, time: float) -> bool:
+        return (time - idle_since[device]) % cycle <= parameters.max_seconds if parameters.poll_gap > 0 else True
+
+    def assign(task: int, device: int, time: float):
+        outcome[task] = COMPLETED
+        assigned_at[task] = time
+        if trace.crash[task]:
+            outcome[task] = CRASHED
+            free_at = time + max(parameters.restart_delay, parameters.max_time_running)
+            wasted[task] = free_at - time
+        else:
+            natural_end = time + parameters.handoff_delay + min(trace.run_time[task], parameters.max_time_running)
+            if trace.run_time[task] > parameters.max_time_running:
+                outcome[task] = TRUNCATED
+            free_at = natural_end
+            stop = _stop_time(time, natural_end, trace.arrival[task], abandon_at[task], trace.poll_interval[task], parameters)
+            if stop < natural_end:
+                outcome[task] = STOPPED_ABANDONED if abandon_at[task] <= stop else STOPPED_ACTIVE
+                # The device stops at its next status check (or at the end, if it never checks)
+                free_at = min(_next_multiple(stop, parameters.device_poll_interval, time), natural_end)
+            if outcome[task] == STOPPED_ACTIVE:
+                wasted[task] = free_at - time
+            else:
+                wasted[task] = max(free_at - max(abandon_at[task], time), 0.0)
+        busy[task] = free_at - time
+        heapq.heappush(events, (free_at, 0, 0, device))
+
+    def dispatch(time: float):
+        nonlocal idle_requests
+        while queue and idle_since:
+            candidates = [ device for device in idle_since if listening(device, time) ]
+            if not candidates:
+                # Nobody is waiting right now: the first one asking again takes it
+                resume = min(time + cycle - (time - idle_since[device]) % cycle for device in idle_since)
+                heapq.heappush(events, (resume, 2, 2, -1))
+                return
+            device = min(candidates, key=lambda device: idle_since[device])
+            while queue:
+                _, _, task = heapq.heappop(queue)
+                if _inactive_at(time, trace.arrival[task], abandon_at[task], trace.poll_interval[task], parameters.max_time_without_polling):
+                    outcome[task] = SKIPPED
+                    continue
+                idle_requests += int((time - idle_since.pop(device)) // cycle) + 1 if cycle > 0 else 1
+                assign(task, device, time)
+                break
+
+    end = 0.0
+    while events:
+        time, _, kind, value = heapq.heappop(events)
+        end = max(end, time)
+        if kind == 0:
+            idle_since[value] = time
+        elif kind == 1:
+            heapq.heappush(queue, (priority[value], value, value))
+        dispatch(time)
+
+    end = max(end, trace.arrival[-1] if size else 0.0)
+    assigned = ~np.isnan(assigned_at)
+    waits = assigned_at[assigned] - trace.arrival[assigned]
+    device_seconds = parameters.devices * end if end > 0 else 1.0
+
+    result = dict(parameters._asdict())
+    result.update({
+        'tasks': size,
+        'makespan': end,
+        'utilization': busy.sum() / device_seconds,
+        'useful_utilization': (busy.sum() - wasted.sum()) / device_seconds,
+        'wasted_device_seconds': wasted.sum(),
+        'wait_mean': waits.mean() if len(waits) else np.nan,
+        'wait_p50': np.percentile(waits, 50) if len(waits) else np.nan,
+        'wait_p90': np.percentile(waits, 90) if len(waits) else np.nan,
+        'wait_p99': np.percentile(waits, 99) if len(waits) else np.nan,
+        'idle_requests_per_hour': idle_requests / (end / 3600) if end > 0 else 0.0,
+    })
+    for priority_value in np.unique(priority):
+        selected = assigned & (priority == priority_value)
+        result[f'wait_p90_priority_{priority_value}'] = np.percentile(assigned_at[selected] - trace.arrival[selected], 90) if selected.any() else np.nan
+    for index, name in enumerate(OUTCOME_NAMES):
+        result[name] = int((outcome == index).sum())
+    return result
+
+def _parse_list(conversion):
+    return lambda value: [ conversion(item) for item in value.split(',') if item.strip() ]
+
+def _print_results(results: List[Dict[str, float]]):
+    # The parameters that change in the grid, and then (result field, title, width, format)
+    columns = [ (field, field, max(len(field), 6), 'g') for field in Parameters._fields if len({ result[field] for result in results }) > 1 ]
+    columns += [ ('utilization', 'util', 6, '.3f'), ('useful_utilization', 'useful', 6, '.3f'),
+                 ('wait_p50', 'wait50', 8, '.1f'), ('wait_p90', 'wait90', 8, '.1f'), ('wait_p99', 'wait99', 8, '.1f'),
+                 ('wasted_device_seconds', 'wasted s', 9, '.0f'), ('completed', 'done', 6, 'd'), ('truncated', 'trunc', 6, 'd'),
+                 ('skipped', 'skip', 5, 'd'), ('stopped_abandoned', 'aband', 6, 'd'), ('stopped_active', 'falsest', 7, 'd'),
+                 ('crashed', 'crash', 5, 'd'), ('queued', 'left', 5, 'd'), ('idle_requests_per_hour', 'idle req/h', 10, '.0f') ]
+    print(' '.join(f'{title:>{width}}' for _, title, width, _ in columns))
+    for result in results:
+        print(' '.join(f'{result[name]:>{width}{spec}}' for name, _, width, spec in columns))
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Simulate the scheduler over a grid of settings")
+    trace_group = parser.add_argument_group("trace")
+    trace_group.add_argument('--trace', help="CSV trace (arrival, priority, owner, run_time, abandon_after, poll_interval, crash)")
+    trace_group.add_argument('--write-trace', help="Write the trace simulated to this CSV file")
+    trace_group.add_argument('--duration', type=float, default=8 * 3600, help="Seconds of synthetic arrivals")
+    trace_group.add_argument('--arrival-rate', type=float, default=0.2, help="Synthetic tasks per second")
+    trace_group.add_argument('--users', type=int, default=200, help="Synthetic users")
+    trace_group.add_argument('--priorities', default='5:1', help="Synthetic priorities and weights, e.g., 2:0.1,5:0.6,10:0.3")
+    trace_group.add_argument('--run-time', default='lognormal:20,0.8', help="Run time: const:V, uniform:MIN,MAX, exp:MEAN, normal:MEAN,STDEV, lognormal:MEAN,SIGMA")
+    trace_group.add_argument('--poll-interval', default='const:1', help="Seconds between the polls of each user (same syntax)")
+    trace_group.add_argument('--abandon-rate', type=float, default=0.05, help="Probability of a user abandoning the task")
+    trace_group.add_argument('--patience', default='exp:60', help="Seconds until a user abandons the task (same syntax)")
+    trace_group.add_argument('--crash-rate', type=float, default=0.0, help="Probability of a device crashing when it takes a task")
+    trace_group.add_argument('--seed', type=int, default=0)
+
+    grid_group = parser.add_argument_group("parameter grid (comma-separated values)")
+    grid_group.add_argument('--devices', type=_parse_list(int), default=[ 10 ])
+    grid_group.add_argument('--max-time-running', type=_parse_list(float), default=[ 60 ])
+    grid_group.add_argument('--max-time-without-polling', type=_parse_list(float), default=[ 10 ])
+    grid_group.add_argument('--max-seconds', type=_parse_list(float), default=[ 25 ], help="Long-poll time of the devices")
+    grid_group.add_argument('--max-priority', type=_parse_list(int), default=[ 15 ], help="MAX_PRIORITY_QUEUE")
+    grid_group.add_argument('--reaper-interval', type=_parse_list(float), default=[ 5 ], help="REAPER_INTERVAL (0: no reaper)")
+    grid_group.add_argument('--device-poll-interval', type=_parse_list(float), default=[ 2 ], help="Status checks of a running device (0: never)")
+    grid_group.add_argument('--poll-gap', type=_parse_list(float), default=[ 0.1 ], help="Seconds between the long-polls of an idle device")
+    grid_group.add_argument('--handoff-delay', type=_parse_list(float), default=[ 0.05 ], help="Seconds from the receiver to the transmitter assignment")
+    grid_group.add_argument('--restart-delay', type=_parse_list(float), default=[ 30 ], help="Seconds a crashed device takes to come back")
+
+    parser.add_argument('--jobs', type=int, default=1, help="Processes simulating the grid")
+    parser.add_argument('--csv', help="Write all the results to this CSV file")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    trace = load_trace(args.trace, args, rng) if args.trace else synthetic_trace(args, rng)
+    if args.write_trace:
+        write_trace(trace, args.write_trace)
+    print(f"{len(trace.arrival)} tasks over {trace.arrival[-1] if len(trace.arrival) else 0:.0f} seconds")
+
+    grid = [ Parameters(*values) for values in itertools.product(
+        args.devices, args.max_time_running, args.max_time_without_polling, args.max_seconds, args.max_priority,
+        args.reaper_interval, args.device_poll_interval, args.poll_gap, args.handoff_delay, args.restart_delay) ]
+
+    if args.jobs > 1:
+        with ProcessPoolExecutor(args.jobs) as executor:
+            results = list(executor.map(simulate, itertools.repeat(trace), grid))
+    else:
+        results = [ simulate(trace, parameters) for parameters in grid ]
+
+    _print_results(results)
+
+    if args.csv:
+        fields = list(dict.fromkeys(field for result in results for field in result))
+        with open(args.csv, 'w', newline='') as results_file:
+            writer = csv.DictWriter(results_file, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(results)
+        print(f"Results written in {args.csv}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
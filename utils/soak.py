@@ -0,0 +1,396 @@
+"""
+Soak test of a running scheduler with a simulated fleet of devices and users.
+
+Hundreds of fake receivers and transmitters (pairs of the same device) and fake
+backends (one per simulated user) run concurrently in a single asyncio loop, and
+speak the real HTTP protocol of the scheduler:
+
+- each backend creates a task, polls it (as the backend does while the user
+  waits) until it finishes, waits a bit and creates another one;
+- each receiver / transmitter asks for a task, "runs" it for a time taken from
+  the run time distribution (checking its status as the devices do, and stopping
+  if it was stopped), and completes it.
+
+Failures can be injected: devices that crash after taking a task (and come back
+after a while, without completing it), devices that stall (they stop polling and
+complete the task much later) and users that abandon their task (they stop
+polling right after creating it). At the end it reports the end-to-end throughput,
+the queue wait percentiles, the fraction of time the devices were idle and the
+Redis commands per completed task (from /scheduler/metrics, which only covers the
+worker that answered, or from INFO in Redis with --redis-url, which covers every
+client of the server).
+
+The devices must have credentials in the scheduler. Create them with:
+
+    python soak.py --devices 100 --write-credentials device-credentials.json
+    flask device-credentials push
+
+The crashed and stalled devices are released by the reaper, so the scheduler must
+run its background threads (BACKGROUND_THREADS_ENABLED, as wsgi_app.py and
+asgi_app.py do). And then, for example:
+
+    python soak.py --url http://localhost:6002/ --devices 100 --users 500 --duration 600 \\
+        --run-time exp:10 --crash-rate 0.01 --stall-rate 0.01 --abandon-rate 0.05
+"""
+import sys
+import json
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+from collections import defaultdict
+from typing import Callable, Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import numpy as np
+
+# After these, the status of a task does not change anymore
+FINAL_STATUSES = ('completed', 'deleted', 'error')
+
+RECEIVER_FILE = "options:\n  parameters:\n    id: receiver\n"
+TRANSMITTER_FILE = "options:\n  parameters:\n    id: transmitter\n"
+
+class HttpClient:
+    """
+    Minimal asyncio HTTP/1.1 client for the JSON API of the scheduler (a connection per request)
+    """
+    def __init__(self, base_url: str, timeout: float):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.ssl = parts.scheme == 'https'
+        self.path = parts.path.rstrip('/')
+        self.timeout = timeout
+
+    async def request(self, method: str, path: str, headers: Dict[str, str], body: Optional[dict] = None) -> Tuple[int, str]:
+        return await asyncio.wait_for(self._request(method, path, headers, body), self.timeout)
+
+    async def _request(self, method: str, path: str, headers: Dict[str, str], body: Optional[dict]) -> Tuple[int, str]:
+        reader, writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+        try:
+            content = json.dumps(body).encode() if body is not None else b''
+            lines = [ f'{method} {self.path}{path} HTTP/1.1', f'Host: {self.host}', 'Connection: close', f'Content-Length: {len(content)}' ]
+            if body is not None:
+                lines.append('Content-Type: application/json')
+            lines.extend(f'{name}: {value}' for name, value in headers.items())
+            writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + content)
+            await writer.drain()
+
+            status_line = await reader.readline()
+            status_code = int(status_line.split()[1])
+            response_headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                response_headers[name.strip().lower()] = value.strip()
+
+            if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+                chunks = []
+                while True:
+                    size = int((await reader.readline()).split(b';')[0], 16)
+                    if size == 0:
+                        break
+                    chunks.append(await reader.readexactly(size))
+                    await reader.readline()
+                data = b''.join(chunks)
+            elif 'content-length' in response_headers:
+                data = await reader.readexactly(int(response_headers['content-length']))
+            else:
+                data = await reader.read()
+            return status_code, data.decode('utf-8')
+        finally:
+            writer.close()
+
+    async def json(self, method: str, path: str, headers: Dict[str, str], body: Optional[dict] = None) -> dict:
+        status_code, data = await self.request(method, path, headers, body)
+        if status_code != 200:
+            raise RuntimeError(f"{method} {path} returned {status_code}: {data[:200]}")
+        return json.loads(data)
+
+def parse_distribution(value: str) -> Callable[[], float]:
+    """
+    Parse a run time distribution: const:S, uniform:MIN,MAX, exp:MEAN, normal:MEAN,STDEV
+    or lognormal:MEAN,SIGMA (in seconds, never negative)
+    """
+    name, _, parameters = value.partition(':')
+    arguments = [ float(argument) for argument in parameters.split(',') if argument ]
+    distributions = {
+        'const': lambda seconds: seconds,
+        'uniform': lambda minimum, maximum: random.uniform(minimum, maximum),
+        'exp': lambda mean: random.expovariate(1 / mean),
+        'normal': lambda mean, stdev: random.gauss(mean, stdev),
+        'lognormal': lambda mean, sigma: random.lognormvariate(np.log(mean) - sigma ** 2 / 2, sigma),
+    }
+    if name not in distributions:
+        raise argparse.ArgumentTypeError(f"Unknown distribution {name} (use {', '.join(distributions)})")
+    distribution = distributions[name]
+    try:
+        distribution(*arguments)
+    except TypeError:
+        raise argparse.ArgumentTypeError(f"Invalid parameters for {name}: {parameters}")
+    return lambda: max(distribution(*arguments), 0.0)
+
+class SoakStats:
+    def __init__(self):
+        self.created_at: Dict[str, float] = {}
+        self.assigned_at: Dict[str, float] = {}
+        self.finished: Dict[str, str] = {}
+        self.finished_at: Dict[str, float] = {}
+        self.receiver_busy_time = 0.0
+        self.events: Dict[str, int] = defaultdict(int)
+        self.request_errors: Dict[str, int] = defaultdict(int)
+
+class Soak:
+    def __init__(self, args):
+        self.args = args
+        self.client = HttpClient(args.url, timeout=args.max_seconds + 10)
+        self.stats = SoakStats()
+        self.deadline = 0.0
+
+    def device_headers(self, device: str) -> Dict[str, str]:
+        return { 'relia-device': device, 'relia-password': self.args.device_password }
+
+    @property
+    def backend_headers(self) -> Dict[str, str]:
+        return { 'relia-secret': self.args.backend_token }
+
+    async def _retry_later(self, kind: str, error: Exception):
+        self.stats.request_errors[f'{kind}: {type(error).__name__}'] += 1
+        await asyncio.sleep(1)
+
+    async def run_user(self, user_index: int):
+        """
+        Fake backend of a user: create a task, poll it until it finishes (unless the user
+        abandons it), think, and again
+        """
+        user = f'{self.args.device_prefix}-user-{user_index}'
+        session = f'{self.args.device_prefix}-session-{user_index}'
+        # Not everybody arrives at the same time
+        await asyncio.sleep(random.uniform(0, self.args.think_time))
+        while time.time() < self.deadline:
+            try:
+                result = await self.client.json('POST', '/scheduler/user/tasks/', self.backend_headers, {
+                    'grc_files': {
+                        'receiver': { 'filename': 'receiver.grc', 'content': RECEIVER_FILE, 'type': 'grc' },
+                        'transmitter': { 'filename': 'transmitter.grc', 'content': TRANSMITTER_FILE, 'type': 'grc' },
+                    },
+                    'priority': random.choice(self.args.priorities), 'session_id': session, 'user_id': user,
+                })
+            except (OSError, RuntimeError, asyncio.TimeoutError) as error:
+                await self._retry_later('create', error)
+                continue
+
+            task_identifier = result['taskIdentifier']
+            self.stats.created_at[task_identifier] = time.time()
+            self.stats.events['created'] += 1
+
+            if random.random() < self.args.abandon_rate:
+                # The user closes the browser: nobody polls the task anymore
+                self.stats.events['abandoned'] += 1
+            else:
+                await self._poll_task(task_identifier)
+
+            await asyncio.sleep(random.expovariate(1 / self.args.think_time) if self.args.think_time else 0)
+
+    async def _poll_task(self, task_identifier: str):
+        while True:
+            await asyncio.sleep(self.args.poll_interval)
+            try:
+                result = await self.client.json('GET', f'/scheduler/user/tasks/{task_identifier}', {})
+            except (OSError, RuntimeError, asyncio.TimeoutError) as error:
+                await self._retry_later('poll', error)
+                continue
+
+            status = result.get('status')
+            if status in FINAL_STATUSES or status is None:
+                self.stats.finished[task_identifier] = status or 'missing'
+                self.stats.finished_at[task_identifier] = time.time()
+                self.stats.events[f'finished {status}'] += 1
+                return
+
+    async def run_device(self, device: str, is_receiver: bool):
+        """
+        Fake receiver or transmitter: ask for a task, run it and complete it
+        """
+        device_type = 'receiver' if is_receiver else 'transmitter'
+        while time.time() < self.deadline:
+            try:
+                assignment = await self.client.json('GET', f'/scheduler/devices/tasks/{device_type}?max_seconds={self.args.max_seconds}', self.device_headers(device))
+            except (OSError, RuntimeError, asyncio.TimeoutError) as error:
+                await self._retry_later(device_type, error)
+                continue
+
+            task_identifier = assignment.get('taskIdentifier')
+            if not task_identifier:
+                continue
+
+            assigned_at = time.time()
+            if is_receiver:
+                self.stats.assigned_at.setdefault(task_identifier, assigned_at)
+
+            await self._run_task(device, device_type, task_identifier)
+
+            if is_receiver:
+                self.stats.receiver_busy_time += time.time() - assigned_at
+
+    async def _run_task(self, device: str, device_type: str, task_identifier: str):
+        failure = random.random()
+        if failure < self.args.crash_rate:
+            # The device disappears with the task, and comes back later knowing nothing about it
+            self.stats.events[f'{device_type} crashed'] += 1
+            await asyncio.sleep(self.args.restart_delay)
+            return
+
+        if failure < self.args.crash_rate + self.args.stall_rate:
+            # The device hangs without polling, and completes the task much later
+            self.stats.events[f'{device_type} stalled'] += 1
+            await asyncio.sleep(self.args.stall_time)
+        else:
+            run_time = self.args.run_time()
+            started = time.time()
+            while time.time() - started < run_time:
+                await asyncio.sleep(min(self.args.device_poll_interval, run_time - (time.time() - started)))
+                try:
+                    result = await self.client.json('GET', f'/scheduler/devices/tasks/{device_type}/{task_identifier}', self.device_headers(device))
+                except (OSError, RuntimeError, asyncio.TimeoutError) as error:
+                    await self._retry_later(f'{device_type} status', error)
+                    continue
+                if result.get('status') in FINAL_STATUSES:
+                    # Stopped by the scheduler (e.g., the user is not polling anymore)
+                    self.stats.events[f'{device_type} stopped'] += 1
+                    return
+
+        try:
+            await self.client.json('POST', f'/scheduler/devices/tasks/{device_type}/{task_identifier}', self.device_headers(device))
+            self.stats.events[f'{device_type} completed'] += 1
+        except (OSError, RuntimeError, asyncio.TimeoutError) as error:
+            await self._retry_later(f'{device_type} complete', error)
+
+    async def count_redis_commands(self) -> Optional[float]:
+        """
+        Redis commands processed so far: from INFO with --redis-url, or from /scheduler/metrics
+        """
+        if self.args.redis_url:
+            import redis.asyncio
+            client = redis.asyncio.from_url(self.args.redis_url)
+            try:
+                return float((await client.info('stats'))['total_commands_processed'])
+            finally:
+                await client.close()
+
+        try:
+            status_code, data = await self.client.request('GET', '/scheduler/metrics', {})
+        except (OSError, asyncio.TimeoutError):
+            return None
+        if status_code != 200:
+            return None
+        return sum(float(line.rsplit(' ', 1)[1]) for line in data.splitlines() if line.startswith('reliascheduler_redis_commands_total{'))
+
+    async def run(self):
+        commands_before = await self.count_redis_commands()
+        started = time.time()
+        self.deadline = started + self.args.duration
+
+        agents = [ self.run_user(user_index) for user_index in range(self.args.users) ]
+        for device_index in range(self.args.devices):
+            device_base = f'{self.args.device_prefix}-{device_index}'
+            agents.append(self.run_device(f'{device_base}:r', True))
+            agents.append(self.run_device(f'{device_base}:t', False))
+
+        # The agents stop taking work at the deadline; after the drain time the rest is cancelled
+        tasks = [ asyncio.ensure_future(agent) for agent in agents ]
+        done, pending = await asyncio.wait(tasks, timeout=self.args.duration + self.args.drain)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for task in done:
+            if task.exception() is not None:
+                raise task.exception()
+
+        elapsed = time.time() - started
+        commands_after = await self.count_redis_commands()
+        commands = commands_after - commands_before if commands_before is not None and commands_after is not None else None
+        self.report(elapsed, commands)
+
+    def report(self, elapsed: float, commands: Optional[float]):
+        stats = self.stats
+        completed = [ task_identifier for task_identifier, status in stats.finished.items() if status == 'completed' ]
+        queue_waits = np.array([ stats.assigned_at[task_identifier] - created_at for task_identifier, created_at in stats.created_at.items() if task_identifier in stats.assigned_at ])
+        end_to_end = np.array([ stats.finished_at[task_identifier] - stats.created_at[task_identifier] for task_identifier in completed ])
+
+        print(f"Duration: {elapsed:.1f} s, {self.args.users} users, {self.args.devices} device pairs")
+        print(f"Tasks created: {len(stats.created_at)}, assigned: {len(stats.assigned_at)}, completed (seen by the users): {len(completed)}")
+        print(f"Throughput: {len(completed) / elapsed:.2f} completed tasks/s")
+        for name, values in (('Queue wait', queue_waits), ('End to end', end_to_end)):
+            if len(values):
+                p50, p90, p99 = np.percentile(values, [ 50, 90, 99 ])
+                print(f"{name}: p50 {p50:.2f} s, p90 {p90:.2f} s, p99 {p99:.2f} s, max {values.max():.2f} s")
+        print(f"Device idle fraction: {1 - stats.receiver_busy_time / (self.args.devices * elapsed):.3f}")
+        if commands is None:
+            print("Redis commands per completed task: unknown (metrics not available)")
+        elif completed:
+            print(f"Redis commands per completed task: {commands / len(completed):.1f} ({commands:.0f} commands)")
+
+        print("Events:")
+        for event, count in sorted(stats.events.items()):
+            print(f" - {event}: {count}")
+        if stats.request_errors:
+            print("Request errors:")
+            for error, count in sorted(stats.request_errors.items()):
+                print(f" - {error}: {count}")
+
+def write_credentials(filename: str, device_prefix: str, devices: int, password: str):
+    """
+    Add the credentials of the fake devices to the device credentials file (as 'flask device-credentials add' does)
+    """
+    try:
+        credentials = json.load(open(filename))
+    except FileNotFoundError:
+        credentials = {}
+
+    salt = 'soakts'
+    for device_index in range(devices):
+        credentials[f'{device_prefix}-{device_index}'] = salt + '$' + hashlib.sha512((salt + password).encode()).hexdigest()
+    open(filename, 'w').write(json.dumps(credentials, indent=4))
+    print(f"{devices} device credentials written in {filename}. Push them with: flask device-credentials push")
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Soak test of the scheduler with fake devices and users")
+    parser.add_argument('--url', default='http://localhost:6002/', help="Base URL of the scheduler")
+    parser.add_argument('--backend-token', default='password', help="RELIA_BACKEND_TOKEN of the scheduler")
+    parser.add_argument('--device-prefix', default='soak', help="Prefix of the fake devices, users and sessions")
+    parser.add_argument('--device-password', default='soak-password', help="Password of the fake devices")
+    parser.add_argument('--write-credentials', metavar='FILENAME', help="Add the credentials of the fake devices to this file and exit")
+    parser.add_argument('--devices', type=int, default=10, help="Receiver and transmitter pairs")
+    parser.add_argument('--users', type=int, default=50, help="Users (each one with a task at a time)")
+    parser.add_argument('--duration', type=float, default=60, help="Seconds creating and taking tasks")
+    parser.add_argument('--drain', type=float, default=30, help="Seconds to finish the tasks in progress after the duration")
+    parser.add_argument('--priorities', type=lambda value: [ int(priority) for priority in value.split(',') ], default=[ 5 ], help="Comma-separated priorities, chosen at random")
+    parser.add_argument('--run-time', type=parse_distribution, default=parse_distribution('exp:5'), help="Run time of the tasks: const:S, uniform:MIN,MAX, exp:MEAN, normal:MEAN,STDEV, lognormal:MEAN,SIGMA")
+    parser.add_argument('--think-time', type=float, default=5, help="Mean seconds of a user between tasks")
+    parser.add_argument('--poll-interval', type=float, default=1, help="Seconds between the polls of the backend")
+    parser.add_argument('--device-poll-interval', type=float, default=2, help="Seconds between the status checks of a running device")
+    parser.add_argument('--max-seconds', type=int, default=25, help="Long-poll time of the devices asking for tasks")
+    parser.add_argument('--crash-rate', type=float, default=0, help="Probability of a device crashing after taking a task")
+    parser.add_argument('--restart-delay', type=float, default=30, help="Seconds a crashed device takes to come back")
+    parser.add_argument('--stall-rate', type=float, default=0, help="Probability of a device stalling after taking a task")
+    parser.add_argument('--stall-time', type=float, default=120, help="Seconds a stalled device takes to complete the task")
+    parser.add_argument('--abandon-rate', type=float, default=0, help="Probability of a user not polling the task created")
+    parser.add_argument('--redis-url', help="Count the Redis commands with INFO in this server (all its clients)")
+    parser.add_argument('--seed', type=int, help="Random seed")
+    args = parser.parse_args()
+
+    if args.write_credentials:
+        write_credentials(args.write_credentials, args.device_prefix, args.devices, args.device_password)
+        return 0
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    asyncio.run(Soak(args).run())
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,6 +12,9 @@ if not os.path.exists('logs'):
 sys.stdout = open('logs/stdout.txt', 'a')
 sys.stderr = open('logs/stderr.txt', 'a')
 
+# Read by the configuration (config.py) when importing reliascheduler
+os.environ.setdefault('BACKGROUND_THREADS_ENABLED', '1')
+
 from reliascheduler import create_app
 application = create_app(os.environ['FLASK_CONFIG'])
 